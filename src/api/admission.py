@@ -0,0 +1,163 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, Optional
+
+
+class AdmissionRejected(Exception):
+    """
+    The request was not admitted, because the queue is full or the wait took too long.
+
+    :param retry_after: The time in seconds after which the client should retry.
+    :param reason: "queue_full" or "queue_timeout".
+    """
+
+    def __init__(self, retry_after: int, reason: str) -> None:
+        """Constructor."""
+        super().__init__(f"The server is busy ({reason}), retry after {retry_after} seconds.")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionTicket:
+    """The permission to process one request, which must be released exactly once."""
+
+    def __init__(self, controller: 'AdmissionController') -> None:
+        """Constructor."""
+        self._controller = controller
+        self._started = controller._timer()
+        self._released = False
+
+    def release(self) -> None:
+        """Return the slot to the controller, the repeated calls do nothing."""
+        if not self._released:
+            self._released = True
+            self._controller._release(self._controller._timer() - self._started)
+
+
+class AdmissionController:
+    """
+    The limit of the requests, processed by the worker at the same time.
+
+    Up to max_concurrency requests are processed at once, up to max_queue more requests
+    wait for a slot in the order of arrival. The request is rejected right away if the
+    queue is full, or after it has waited for max_queue_time seconds, so that the admitted
+    requests are served at the normal speed instead of all of them slowing down together.
+
+    :param max_concurrency: The maximal number of requests processed at the same time.
+    :param max_queue: The maximal number of requests waiting for a slot.
+    :param max_queue_time: The maximal time in seconds a request waits for a slot.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int,
+            max_queue: int = 0,
+            max_queue_time: float = 10.0,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if max_concurrency <= 0:
+            raise ValueError("The concurrency must be positive.")
+        self._max_concurrency = max_concurrency
+        self._max_queue = max_queue
+        self._max_queue_time = max_queue_time
+        self._timer = timer
+        self._waiters: deque[asyncio.Future] = deque()
+        self.active = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_service_time = 0.0
+        self.completed = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of requests waiting for a slot."""
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Estimate the time in seconds, after which the queue is expected to have room."""
+        if not self.completed:
+            return 1
+        mean_service_time = self.total_service_time / self.completed
+        return max(1, math.ceil(mean_service_time * (self.queue_depth + 1) / self._max_concurrency))
+
+    async def acquire(self) -> AdmissionTicket:
+        """
+        Wait for the slot to process the request.
+
+        :return: The ticket, which must be released when the request is processed.
+        :raises: AdmissionRejected if the request can not be admitted.
+        """
+        if self.active < self._max_concurrency and not self._waiters:
+            return self._admit(0.0)
+        if len(self._waiters) >= self._max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(self.retry_after(), 'queue_full')
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        started = self._timer()
+        try:
+            # The slot is handed over by _release, it is already counted as active.
+            await asyncio.wait_for(asyncio.shield(future), self._max_queue_time)
+        except asyncio.TimeoutError:
+            self._abandon(future)
+            self.timed_out += 1
+            raise AdmissionRejected(self.retry_after(), 'queue_timeout')
+        except asyncio.CancelledError:
+            self._abandon(future)
+            raise
+        self.active -= 1
+        return self._admit(self._timer() - started)
+
+    def _admit(self, wait_time: float) -> AdmissionTicket:
+        """Take the slot."""
+        self.active += 1
+        self.admitted += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return AdmissionTicket(self)
+
+    def _abandon(self, future: asyncio.Future) -> None:
+        """Leave the queue; if the slot was handed over at the same time, pass it on."""
+        if future.done() and not future.cancelled():
+            self._release(None)
+        else:
+            future.cancel()
+            try:
+                self._waiters.remove(future)
+            except ValueError:
+                pass
+
+    def _release(self, service_time: Optional[float]) -> None:
+        """Hand the slot over to the first waiting request or free it."""
+        self.active -= 1
+        if service_time is not None:
+            self.completed += 1
+            self.total_service_time += service_time
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                self.active += 1
+                future.set_result(None)
+                return
+
+    def stats(self) -> dict[str, float]:
+        """Return the queue metrics."""
+        return {
+            'active': self.active,
+            'queue_depth': self.queue_depth,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'mean_wait_seconds': self.total_wait_time / self.admitted if self.admitted else 0.0,
+            'max_wait_seconds': self.max_wait_time,
+        }
@@ -0,0 +1,144 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import time
+from collections.abc import Sequence
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    The bounded cache, which finds the values by the similarity of their vector keys.
+
+    The value is returned for the query vector if the cosine similarity between it and the
+    vector the value was stored with is not less than the threshold. When the cache is full,
+    the least recently used entry is evicted.
+
+    :param max_size: The maximal number of entries in the cache.
+    :param dimensions: The number of dimensions in the vectors.
+    :param similarity_threshold: The minimal cosine similarity of the vectors to consider them the same.
+    :param ttl: The time in seconds after which the entry expires. If None, entries do not expire.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            max_size: int,
+            dimensions: int,
+            similarity_threshold: float = 0.98,
+            ttl: Optional[float] = None,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if max_size <= 0:
+            raise ValueError("The cache size must be positive.")
+        self._threshold = similarity_threshold
+        self._ttl = ttl
+        self._timer = timer
+        # The unit vectors of the cached entries, one per row.
+        self._vectors = np.zeros((max_size, dimensions), dtype=np.float32)
+        self._values = [None] * max_size
+        self._last_used = np.full(max_size, -np.inf)
+        self._expires_at = np.full(max_size, np.inf)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _normalize(self, vector: Sequence[float]) -> Optional[np.ndarray]:
+        """Return the unit vector or None if the vector can not be used as a key."""
+        vector = np.asarray(vector, dtype=np.float32)
+        if vector.shape != self._vectors.shape[1:]:
+            return None
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return vector / norm
+
+    def get(self, vector: Sequence[float], default: Any = None) -> Any:
+        """
+        Return the value, stored with the vector, most similar to the given one.
+
+        :param vector: The query vector.
+        :param default: The value to return if there is no similar vector in the cache.
+        :return: The cached value or default.
+        """
+        unit = self._normalize(vector)
+        if unit is None or self._size == 0:
+            self.misses += 1
+            return default
+        similarity = self._vectors[:self._size] @ unit
+        # The expired entries never match.
+        similarity[self._expires_at[:self._size] <= self._timer()] = -np.inf
+        best = int(np.argmax(similarity))
+        if similarity[best] < self._threshold:
+            self.misses += 1
+            return default
+        self._last_used[best] = self._timer()
+        self.hits += 1
+        return self._values[best]
+
+    def put(self, vector: Sequence[float], value: Any) -> None:
+        """
+        Add the value to the cache.
+
+        :param vector: The vector key of the value.
+        :param value: The value to be cached.
+        """
+        unit = self._normalize(vector)
+        if unit is None:
+            return
+        now = self._timer()
+        if self._size < len(self._values):
+            slot = self._size
+            self._size += 1
+        else:
+            # Reuse the expired entry or evict the least recently used one.
+            expired = np.flatnonzero(self._expires_at <= now)
+            if expired.size:
+                slot = int(expired[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+        self._vectors[slot] = unit
+        self._values[slot] = value
+        self._last_used[slot] = now
+        self._expires_at[slot] = np.inf if self._ttl is None else now + self._ttl
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._values = [None] * len(self._values)
+        self._last_used[:] = -np.inf
+        self._expires_at[:] = np.inf
+        self._size = 0
+
+    def invalidate(self) -> None:
+        """Remove all entries, because the data they were computed from has changed."""
+        self.clear()
+        self.invalidations += 1
+
+    def stats(self) -> dict[str, int]:
+        """Return the cache counters."""
+        return {
+            'size': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+def normalize_text(text: str) -> str:
+    """
+    Normalize the text to be used as a cache key.
+
+    :param text: The text to be normalized.
+    :return: The text in lower case with whitespaces collapsed.
+    """
+    return ' '.join(text.lower().split())
@@ -0,0 +1,149 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import math
+from collections import deque
+from collections.abc import Iterable, Iterator
+from typing import Callable, Optional
+
+# The input limit of text-embedding-3-small and text-embedding-3-large models.
+EMBEDDING_MAX_TOKENS = 8191
+MIN_DIFF_CHARACTERS_IN_LINE = 5
+MIN_LINE_LENGTH = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens in the text without the tokenizer.
+
+    The estimate is intentionally pessimistic: the tokenizers of OpenAI models
+    produce about one token per four characters of English text, we count one
+    token per three bytes of UTF-8, so the chunk never exceeds the model limit.
+    :param text: The text.
+    :return: The estimated number of tokens.
+    """
+    return math.ceil(len(text.encode('utf-8')) / 3)
+
+
+def punkt_resource() -> str:
+    """
+    Return the name of the nltk data set, which nltk.sent_tokenize uses.
+
+    nltk 3.8.2 and newer read the punkt_tab tables, the older versions the pickled punkt models.
+    """
+    import nltk.tokenize.punkt
+    return 'punkt_tab' if hasattr(nltk.tokenize.punkt, 'PunktTokenizer') else 'punkt'
+
+
+def ensure_punkt() -> None:
+    """
+    Download the nltk data set, needed to split the text into sentences, if it is absent.
+
+    nltk is imported lazily, because it is only needed to build the embeddings.
+    """
+    import nltk
+    resource = punkt_resource()
+    try:
+        nltk.data.find(f'tokenizers/{resource}')
+    except LookupError:
+        nltk.download(resource)
+
+
+def iter_lines(file_name: str) -> Iterator[str]:
+    """
+    Read the informative lines of the file lazily.
+
+    :param file_name: The text file.
+    :return: The iterator over stripped lines, except the too short lines and
+             lines with too few different characters.
+    """
+    with open(file_name) as f:
+        for line in f:
+            line = line.strip()
+            # Skip non informative lines.
+            if len(line) < MIN_LINE_LENGTH or len(set(line)) < MIN_DIFF_CHARACTERS_IN_LINE:
+                continue
+            yield line
+
+
+def iter_sentences(file_name: str, sent_tokenize: Callable[[str], list[str]]) -> Iterator[str]:
+    """
+    Split the file into sentences lazily.
+
+    :param file_name: The text file.
+    :param sent_tokenize: The function splitting the text into sentences, for example nltk.sent_tokenize.
+    :return: The iterator over sentences.
+    """
+    for line in iter_lines(file_name):
+        yield from sent_tokenize(line)
+
+
+def _split_long_sentence(
+        sentence: str,
+        max_tokens: int,
+        count_tokens: Callable[[str], int]) -> Iterator[str]:
+    """Split the sentence, which does not fit the chunk, by words."""
+    piece = []
+    for word in sentence.split():
+        if piece and count_tokens(' '.join(piece + [word])) > max_tokens:
+            yield ' '.join(piece)
+            piece = []
+        while count_tokens(word) > max_tokens:
+            # The word itself is too long, cut it by characters.
+            cut = max(1, len(word) * max_tokens // count_tokens(word))
+            while cut > 1 and count_tokens(word[:cut]) > max_tokens:
+                cut -= 1
+            yield word[:cut]
+            word = word[cut:]
+        piece.append(word)
+    if piece:
+        yield ' '.join(piece)
+
+
+def iter_chunks(
+        sentences: Iterable[str],
+        max_tokens: int = EMBEDDING_MAX_TOKENS,
+        max_sentences: Optional[int] = None,
+        overlap_tokens: int = 0,
+        count_tokens: Callable[[str], int] = estimate_tokens) -> Iterator[str]:
+    """
+    Pack the sentences into chunks lazily.
+
+    The sentences are added to the chunk while it fits into max_tokens and has no more than
+    max_sentences sentences. The sentences longer than max_tokens are split by words.
+    :param sentences: The sentences to be packed.
+    :param max_tokens: The maximal number of tokens in the chunk.
+    :param max_sentences: The maximal number of sentences in the chunk. If None, the
+           chunk size is limited only by max_tokens.
+    :param overlap_tokens: The chunk starts with the last sentences of the previous chunk,
+           taking up to overlap_tokens tokens.
+    :param count_tokens: The function returning the number of tokens in the text.
+    :return: The iterator over chunks.
+    """
+    if overlap_tokens >= max_tokens:
+        raise ValueError("The overlap must be less than the maximal number of tokens in the chunk.")
+    chunk = deque()
+    # The sentences, carried over from the previous chunk, are not counted in max_sentences.
+    carried = 0
+    tokens = 0
+    for sentence in sentences:
+        pieces = [sentence]
+        sentence_tokens = count_tokens(sentence)
+        if sentence_tokens > max_tokens:
+            pieces = list(_split_long_sentence(sentence, max_tokens, count_tokens))
+        for piece in pieces:
+            # Count the space, which joins the piece to the chunk, as a token.
+            piece_tokens = (sentence_tokens if len(pieces) == 1 else count_tokens(piece)) + 1
+            full = len(chunk) > carried and (
+                tokens + piece_tokens > max_tokens
+                or (max_sentences is not None and len(chunk) - carried >= max_sentences))
+            if full:
+                yield ' '.join(s for s, _ in chunk)
+                # Keep the tail of the chunk as the overlap.
+                while chunk and (tokens > overlap_tokens or tokens + piece_tokens > max_tokens):
+                    tokens -= chunk.popleft()[1]
+                carried = len(chunk)
+            chunk.append((piece, piece_tokens))
+            tokens += piece_tokens
+    if len(chunk) > carried:
+        yield ' '.join(s for s, _ in chunk)
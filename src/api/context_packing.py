@@ -0,0 +1,131 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from collections.abc import Sequence
+from typing import Callable, NamedTuple, Optional
+
+import numpy as np
+
+from .cache import normalize_text
+from .chunking import estimate_tokens
+
+
+class PackingResult(NamedTuple):
+    """The chunks selected for the context and the statistics of the selection."""
+    chunks: list[str]
+    candidates: int
+    duplicates: int
+    tokens: int
+    tokens_saved: int
+
+
+class ContextPacker:
+    """
+    The selection of the search results to be put into the prompt.
+
+    The search returns more candidates than needed. The near duplicates are removed, and the
+    chunks are picked one by one by maximal marginal relevance (MMR), which rewards the
+    similarity to the question and penalizes the similarity to the chunks already picked,
+    until either max_results chunks are picked or no other chunk fits the token budget.
+
+    :param token_budget: The maximal number of tokens in the context.
+    :param max_results: The maximal number of chunks in the context.
+    :param candidates: The number of search results to select from.
+    :param diversity: The weight of the similarity to the picked chunks in MMR, from 0 for
+                      ranking by the relevance only to 1 for the most diverse selection.
+    :param duplicate_similarity: The cosine similarity at which two chunks are duplicates.
+    :param count_tokens: The function returning the number of tokens in the text.
+    """
+
+    def __init__(
+            self,
+            token_budget: int,
+            max_results: int = 5,
+            candidates: int = 20,
+            diversity: float = 0.3,
+            duplicate_similarity: float = 0.95,
+            count_tokens: Callable[[str], int] = estimate_tokens,
+        ) -> None:
+        """Constructor."""
+        if not 0 <= diversity <= 1:
+            raise ValueError("The diversity must be between 0 and 1.")
+        self.token_budget = token_budget
+        self.max_results = max_results
+        self.candidates = max(candidates, max_results)
+        self._diversity = diversity
+        self._duplicate_similarity = duplicate_similarity
+        self._count_tokens = count_tokens
+        self.requests = 0
+        self.total_tokens_saved = 0
+
+    def pack(
+            self,
+            query: Sequence[float],
+            chunks: Sequence[str],
+            vectors: Optional[np.ndarray] = None) -> PackingResult:
+        """
+        Select the chunks for the context.
+
+        :param query: The embedded question.
+        :param chunks: The candidate chunks, the most relevant first.
+        :param vectors: The embeddings of the chunks, one per row. If None, the chunks are
+                        deduplicated by their text and taken in the order of relevance.
+        :return: The selected chunks in the order they were picked and the statistics.
+        """
+        tokens = [self._count_tokens(chunk) for chunk in chunks]
+        if vectors is not None and len(chunks):
+            vectors = np.asarray(vectors, dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            vectors = vectors / norms
+            query = np.asarray(query, dtype=np.float32)
+            relevance = vectors @ (query / (np.linalg.norm(query) or 1.0))
+        else:
+            vectors = None
+            # The chunks are sorted by relevance already.
+            relevance = -np.arange(len(chunks), dtype=np.float32)
+
+        # Remove the near duplicates, keeping the most relevant copy.
+        kept = []
+        seen_texts = set()
+        for i in np.argsort(-relevance, kind='stable'):
+            text = normalize_text(chunks[i])
+            if text in seen_texts:
+                continue
+            if vectors is not None and kept and np.max(vectors[kept] @ vectors[i]) >= self._duplicate_similarity:
+                continue
+            seen_texts.add(text)
+            kept.append(int(i))
+        duplicates = len(chunks) - len(kept)
+
+        selected = []
+        budget = self.token_budget
+        # The similarity of every kept candidate to the closest selected chunk.
+        redundancy = np.zeros(len(chunks), dtype=np.float32)
+        while kept and len(selected) < self.max_results:
+            fitting = [i for i in kept if tokens[i] <= budget]
+            if not fitting:
+                break
+            if vectors is None or not selected:
+                best = fitting[0]
+            else:
+                scores = (1 - self._diversity) * relevance[fitting] - self._diversity * redundancy[fitting]
+                best = fitting[int(np.argmax(scores))]
+            selected.append(best)
+            kept.remove(best)
+            budget -= tokens[best]
+            if vectors is not None and kept:
+                redundancy[kept] = np.maximum(redundancy[kept], vectors[kept] @ vectors[best])
+
+        used = sum(tokens[i] for i in selected)
+        # Compare with the top results, which would be put into the prompt without packing.
+        baseline = sum(tokens[:self.max_results])
+        result = PackingResult(
+            chunks=[chunks[i] for i in selected],
+            candidates=len(chunks),
+            duplicates=duplicates,
+            tokens=used,
+            tokens_saved=max(baseline - used, 0))
+        self.requests += 1
+        self.total_tokens_saved += result.tokens_saved
+        return result
@@ -0,0 +1,115 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+from collections.abc import Awaitable
+from typing import Callable, Optional
+
+
+class EmbeddingBatcher:
+    """
+    The coalescer of concurrent embedding requests.
+
+    The texts, requested within max_delay seconds of each other, are embedded by one call
+    of embed_batch, and every caller gets the embedding of its own text. The batch is sent
+    earlier if max_batch_size texts are collected. If the call fails, all callers waiting
+    for the batch get the exception. The caller, which was cancelled, does not cancel the
+    batch, the other callers still get their embeddings.
+
+    :param embed_batch: The coroutine function, returning the embeddings of the list of texts
+                        in the same order.
+    :param max_batch_size: The maximal number of texts in one call.
+    :param max_delay: The time in seconds the first text in the batch waits for the others.
+    """
+
+    def __init__(
+            self,
+            embed_batch: Callable[[list[str]], Awaitable[list[list[float]]]],
+            max_batch_size: int = 16,
+            max_delay: float = 0.005
+        ) -> None:
+        """Constructor."""
+        if max_batch_size <= 0:
+            raise ValueError("The batch size must be positive.")
+        self._embed_batch = embed_batch
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+        self.requests = 0
+        self.batches = 0
+
+    async def embed(self, text: str) -> list[float]:
+        """
+        Get the embedding of the text, sending it in the batch with the concurrent requests.
+
+        :param text: The text to be embedded.
+        :return: The embedding vector.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, future))
+        self.requests += 1
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_delay, self._flush)
+        # If the caller is cancelled, only its future is cancelled, the batch is sent anyway.
+        return await future
+
+    def _flush(self) -> None:
+        """Send the collected texts."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = [(text, future) for text, future in self._pending if not future.done()]
+        self._pending = []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        """Embed the batch and pass the embeddings to the waiting callers."""
+        # The same question may be asked by several users at once.
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        self.batches += 1
+        try:
+            embeddings = await self._embed_batch(texts)
+            if len(embeddings) != len(texts):
+                raise ValueError(f"Got {len(embeddings)} embeddings for {len(texts)} texts.")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        by_text: dict[str, list[float]] = dict(zip(texts, embeddings))
+        for text, future in batch:
+            if not future.done():
+                future.set_result(by_text[text])
+
+    def stats(self) -> dict[str, float]:
+        """Return the batching counters."""
+        return {
+            'requests': self.requests,
+            'batches': self.batches,
+            'mean_batch_size': self.requests / self.batches if self.batches else 0.0,
+        }
+
+    async def close(self) -> None:
+        """Cancel the pending requests and the batches in flight."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for _, future in self._pending:
+            future.cancel()
+        self._pending = []
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,285 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import argparse
+import csv
+import hashlib
+import json
+import mmap
+import os
+from collections.abc import Iterator, Mapping, Sequence
+from typing import Optional
+
+import numpy as np
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def _offsets_file(vectors_file: str) -> str:
+    """Return the name of the token offset table for the vectors file."""
+    return os.path.splitext(vectors_file)[0] + '.offsets.npy'
+
+
+def _tokens_file(vectors_file: str) -> str:
+    """Return the name of the token table for the vectors file."""
+    return os.path.splitext(vectors_file)[0] + '.tokens'
+
+
+def is_binary_embeddings_file(embeddings_file: str) -> bool:
+    """Return True if the embeddings file is in the binary format."""
+    return embeddings_file.endswith('.npy')
+
+
+def default_embeddings_file(directory: str = DATA_DIRECTORY) -> str:
+    """
+    Return the embeddings file shipped with the application.
+
+    The binary file is preferred if it was converted from the csv file after the last
+    change of the csv file. The older binary file is stale and is ignored.
+    :param directory: The directory with the embeddings files.
+    :return: The path to the embeddings file.
+    """
+    csv_file = os.path.join(directory, 'embeddings.csv')
+    binary_file = os.path.join(directory, 'embeddings.npy')
+    if not os.path.isfile(binary_file):
+        return csv_file
+    if os.path.isfile(csv_file) and os.path.getmtime(binary_file) < os.path.getmtime(csv_file):
+        return csv_file
+    return binary_file
+
+
+class TokenTable(Sequence[str]):
+    """
+    The read only list of tokens, decoded on access from the UTF-8 buffer.
+
+    :param buffer: The buffer with all tokens encoded in UTF-8 one after another.
+    :param offsets: The array of len(tokens) + 1 offsets of tokens in the buffer.
+    """
+
+    def __init__(self, buffer: bytes, offsets: np.ndarray) -> None:
+        """Constructor."""
+        self._buffer = buffer
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("The token index is out of range.")
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return bytes(self._buffer[start:end]).decode('utf-8')
+
+
+class EmbeddingsStore:
+    """
+    The binary embeddings store.
+
+    The store consists of three files: the float32 matrix with one embedding
+    per row (<name>.npy), the array of token offsets (<name>.offsets.npy) and
+    the UTF-8 encoded tokens (<name>.tokens). All three files can be memory mapped,
+    so the processes, loading the same store share one copy in the page cache.
+
+    :param tokens: The tokens, one per matrix row.
+    :param vectors: The matrix with embeddings.
+    """
+
+    def __init__(self, tokens: Sequence[str], vectors: np.ndarray) -> None:
+        """Constructor."""
+        if vectors.ndim != 2 or vectors.shape[0] != len(tokens):
+            raise ValueError(
+                "The embeddings must be a two dimensional matrix with one row per token.")
+        self.tokens = tokens
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __iter__(self) -> Iterator[tuple[str, np.ndarray]]:
+        for i in range(len(self)):
+            yield self.tokens[i], self.vectors[i]
+
+    @staticmethod
+    def open(vectors_file: str, use_mmap: bool = True) -> 'EmbeddingsStore':
+        """
+        Open the binary store.
+
+        :param vectors_file: The .npy file with the embeddings.
+        :param use_mmap: If True, map the files into memory instead of reading them.
+        :return: The store.
+        """
+        mmap_mode = 'r' if use_mmap else None
+        vectors = np.load(vectors_file, mmap_mode=mmap_mode)
+        offsets = np.load(_offsets_file(vectors_file), mmap_mode=mmap_mode)
+        with open(_tokens_file(vectors_file), 'rb') as fp:
+            if use_mmap and os.fstat(fp.fileno()).st_size:
+                # The map stays valid after the file is closed.
+                buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                buffer = fp.read()
+        return EmbeddingsStore(TokenTable(buffer, offsets), vectors)
+
+    def save(self, vectors_file: str) -> None:
+        """
+        Save the store in the binary format.
+
+        :param vectors_file: The .npy file to write the embeddings to.
+        """
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        with open(_tokens_file(vectors_file), 'wb') as fp:
+            for i, token in enumerate(self.tokens):
+                offsets[i + 1] = offsets[i] + fp.write(token.encode('utf-8'))
+        np.save(_offsets_file(vectors_file), offsets)
+        np.save(vectors_file, np.ascontiguousarray(self.vectors, dtype=np.float32))
+
+    @staticmethod
+    def from_csv(embeddings_file: str) -> 'EmbeddingsStore':
+        """
+        Load the csv embeddings file, generated by SearchIndexManager.build_embeddings_file.
+
+        :param embeddings_file: The csv file with token and embedding columns.
+        :return: The store.
+        """
+        tokens = []
+        vectors = []
+        for token, vector in _iter_csv(embeddings_file):
+            tokens.append(token)
+            vectors.append(vector)
+        if not tokens:
+            raise ValueError(f"The embeddings file {embeddings_file} is empty.")
+        return EmbeddingsStore(tokens, np.array(vectors, dtype=np.float32))
+
+    @staticmethod
+    def load(embeddings_file: str) -> 'EmbeddingsStore':
+        """
+        Load the embeddings file in either csv or binary format.
+
+        :param embeddings_file: The embeddings file.
+        :return: The store.
+        """
+        if is_binary_embeddings_file(embeddings_file):
+            return EmbeddingsStore.open(embeddings_file)
+        return EmbeddingsStore.from_csv(embeddings_file)
+
+
+def _iter_csv(embeddings_file: str) -> Iterator[tuple[str, list[float]]]:
+    """Read the csv embeddings file row by row."""
+    with open(embeddings_file, newline='') as fp:
+        reader = csv.DictReader(fp)
+        for row in reader:
+            yield row['token'], json.loads(row['embedding'])
+
+
+def iter_embeddings_file(embeddings_file: str) -> Iterator[tuple[str, list[float]]]:
+    """
+    Iterate over tokens and embeddings in the embeddings file of any format.
+
+    :param embeddings_file: The csv or binary embeddings file.
+    :return: The iterator over tokens and embeddings.
+    """
+    if is_binary_embeddings_file(embeddings_file):
+        for token, vector in EmbeddingsStore.open(embeddings_file):
+            yield token, vector.tolist()
+    else:
+        yield from _iter_csv(embeddings_file)
+
+
+def content_id(token: str) -> str:
+    """
+    Return the stable identifier of the chunk, which depends only on its content.
+
+    :param token: The text of the chunk.
+    :return: The identifier, which can be used as the search index document key.
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()[:32]
+
+
+def manifest_file(embeddings_file: str) -> str:
+    """Return the name of the manifest file for the embeddings file."""
+    return embeddings_file + '.manifest.json'
+
+
+class CsvEmbeddings(Mapping[str, str]):
+    """
+    The embeddings of the csv file by the chunk hash, read from the file on access.
+
+    Only the offsets of the rows are kept in memory, so the embeddings of a large file
+    can be reused without loading it.
+
+    :param embeddings_file: The csv file with token and embedding columns.
+    """
+
+    def __init__(self, embeddings_file: str) -> None:
+        """Constructor."""
+        self._fp = open(embeddings_file, 'rb')
+        self._offsets: dict[str, int] = {}
+        # The csv reader takes the lines one by one, so the position of the file is
+        # at the beginning of the next row after each row is read.
+        reader = csv.reader(self._lines())
+        header = next(reader, None)
+        if header is None:
+            return
+        self._token = header.index('token')
+        self._embedding = header.index('embedding')
+        while True:
+            offset = self._fp.tell()
+            row = next(reader, None)
+            if row is None:
+                break
+            self._offsets[content_id(row[self._token])] = offset
+
+    def _lines(self) -> Iterator[str]:
+        """Read the lines of the file from the current position."""
+        for line in iter(self._fp.readline, b''):
+            yield line.decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._offsets)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._offsets
+
+    def __getitem__(self, key: str) -> str:
+        self._fp.seek(self._offsets[key])
+        return next(csv.reader(self._lines()))[self._embedding]
+
+    def close(self) -> None:
+        """Close the file."""
+        self._fp.close()
+
+
+def convert_csv_to_binary(embeddings_file: str, vectors_file: str) -> EmbeddingsStore:
+    """
+    Convert the csv embeddings file to the binary format.
+
+    :param embeddings_file: The csv file with token and embedding columns.
+    :param vectors_file: The .npy file to write the embeddings to.
+    :return: The converted store.
+    """
+    store = EmbeddingsStore.from_csv(embeddings_file)
+    store.save(vectors_file)
+    return store
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """Convert the csv embeddings file to the binary format."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('input', help='The csv embeddings file.')
+    parser.add_argument(
+        'output', nargs='?',
+        help='The .npy file to write. Default: the input file with the .npy extension.')
+    args = parser.parse_args(argv)
+    output = args.output or os.path.splitext(args.input)[0] + '.npy'
+    store = convert_csv_to_binary(args.input, output)
+    print(f"Converted {len(store)} embeddings of {store.vectors.shape[1]} dimensions to {output}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import time
+from collections import deque
+from collections.abc import Awaitable
+from typing import Callable, Optional, TypeVar
+
+import numpy as np
+
+T = TypeVar('T')
+
+
+class DeadlineExceeded(Exception):
+    """The hedged call has not completed before the deadline."""
+
+
+class HedgedCall:
+    """
+    The hedging of slow idempotent calls.
+
+    If the call has not completed within the given percentile of the recent call latencies,
+    the same call is made again, and the result of the one, which completes first, is
+    returned; the other one is cancelled. The hedges are made for no more than
+    max_hedge_ratio of the calls, so that the extra load is bounded. If the deadline is set,
+    the calls, which have not completed in time, are cancelled and DeadlineExceeded is
+    raised. The timeouts of the calls themselves are raised as they are.
+
+    :param percentile: The percentile of the latencies, after which the call is hedged.
+    :param min_delay: The minimal time in seconds before the hedge.
+    :param max_delay: The maximal time in seconds before the hedge, it is also used
+                      until enough latencies are collected.
+    :param max_hedge_ratio: The maximal share of the calls, which are hedged.
+    :param deadline: The time in seconds, after which the call fails. If None, there is no deadline.
+    :param window: The number of recent latencies the percentile is computed over.
+    :param min_samples: The number of latencies needed to compute the percentile.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            percentile: float = 95,
+            min_delay: float = 0.05,
+            max_delay: float = 2.0,
+            max_hedge_ratio: float = 0.1,
+            deadline: Optional[float] = None,
+            window: int = 1000,
+            min_samples: int = 20,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._max_hedge_ratio = max_hedge_ratio
+        self._deadline = deadline
+        self._latencies = deque(maxlen=window)
+        self._min_samples = min_samples
+        self._timer = timer
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+
+    def hedge_delay(self) -> float:
+        """Return the time in seconds after which the call is hedged."""
+        if len(self._latencies) < self._min_samples:
+            return self._max_delay
+        delay = float(np.percentile(self._latencies, self._percentile))
+        return min(max(delay, self._min_delay), self._max_delay)
+
+    async def call(self, function: Callable[[], Awaitable[T]]) -> T:
+        """
+        Call the function, hedging it if it is slow.
+
+        :param function: The coroutine function to be called, it must be safe to call it twice.
+        :return: The result of the call, which has completed first.
+        :raises: DeadlineExceeded if the deadline is exceeded.
+        """
+        self.calls += 1
+        if self._deadline is None:
+            return await self._call(function)
+        call = asyncio.ensure_future(self._call(function))
+        try:
+            done, _ = await asyncio.wait({call}, timeout=self._deadline)
+        finally:
+            if not call.done():
+                call.cancel()
+                await asyncio.gather(call, return_exceptions=True)
+        if not done:
+            self.deadlines_exceeded += 1
+            raise DeadlineExceeded(f"The call has not completed in {self._deadline} seconds.")
+        return call.result()
+
+    async def _call(self, function: Callable[[], Awaitable[T]]) -> T:
+        """Make the call and the hedge if needed."""
+        started = self._timer()
+        primary = asyncio.ensure_future(function())
+        attempts = {primary}
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=self.hedge_delay())
+            if not done and self.hedges < self._max_hedge_ratio * self.calls:
+                self.hedges += 1
+                hedge_started = self._timer()
+                attempts.add(asyncio.ensure_future(function()))
+            while True:
+                done, _ = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+                winner = next(iter(done))
+                attempts.discard(winner)
+                # If one attempt has failed, the other one may still succeed.
+                if winner.exception() is None or not attempts:
+                    break
+            if winner is not primary:
+                self.hedge_wins += 1
+                started = hedge_started
+            result = winner.result()
+            self._latencies.append(self._timer() - started)
+            return result
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def stats(self) -> dict[str, float]:
+        """Return the hedging counters."""
+        return {
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'deadlines_exceeded': self.deadlines_exceeded,
+            'hedge_delay_seconds': self.hedge_delay(),
+        }
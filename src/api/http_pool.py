@@ -0,0 +1,86 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from typing import Optional
+
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+
+
+class HttpConnectionPool:
+    """
+    The pool of HTTP connections, shared by the Azure SDK clients of the worker.
+
+    Every client gets its own transport, but all transports send the requests through one
+    aiohttp session, so the connections, the TLS sessions and the resolved addresses are
+    reused by all clients. The transports do not own the session, closing the client does
+    not close it; the pool must be closed when all clients are closed.
+
+    :param limit: The maximal number of open connections, 0 for no limit.
+    :param limit_per_host: The maximal number of open connections to one host, 0 for no limit.
+    :param keepalive_timeout: The time in seconds an idle connection is kept open.
+    :param dns_cache_ttl: The time in seconds the resolved addresses are cached.
+    """
+
+    def __init__(
+            self,
+            limit: int = 100,
+            limit_per_host: int = 0,
+            keepalive_timeout: float = 30,
+            dns_cache_ttl: int = 300
+        ) -> None:
+        """Constructor."""
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.transports = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Create the session if it is absent, it must be done in the running event loop."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+                use_dns_cache=True,
+                ttl_dns_cache=self._dns_cache_ttl)
+            # The same settings as the session, created by AioHttpTransport itself.
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                cookie_jar=aiohttp.DummyCookieJar(),
+                auto_decompress=False,
+                trust_env=True)
+        return self._session
+
+    def transport(self) -> AioHttpTransport:
+        """
+        Create the transport for the new client.
+
+        :return: The transport, sending the requests through the shared session.
+        """
+        self.transports += 1
+        return AioHttpTransport(session=self._get_session(), session_owner=False)
+
+    def stats(self) -> dict[str, int]:
+        """Return the number of connections in use and idle, and the limits."""
+        acquired = idle = 0
+        if self._session is not None and not self._session.closed:
+            connector = self._session.connector
+            # aiohttp does not expose the pool state, these are the attributes of BaseConnector.
+            acquired = len(getattr(connector, '_acquired', ()))
+            idle = sum(len(connections) for connections in getattr(connector, '_conns', {}).values())
+        return {
+            'limit': self._limit,
+            'limit_per_host': self._limit_per_host,
+            'acquired': acquired,
+            'idle': idle,
+            'transports': self.transports,
+        }
+
+    async def close(self) -> None:
+        """Close the session and all its connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
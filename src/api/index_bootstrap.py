@@ -0,0 +1,219 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Create the search index in the background and share its state with the workers.
+
+The gunicorn master starts the bootstrap process, which creates the index and uploads
+the documents if the index does not exist, and writes the progress to the state file.
+The workers start serving the requests right away, without the retrieval, and poll the
+state file until the index is ready instead of querying the search service themselves.
+While the index is being created, the bootstrap process updates the heartbeat in the state,
+so that the workers get the index themselves if the bootstrap has died.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Any, Optional
+
+from .manifest import load_manifest, save_manifest
+from .util import get_logger
+
+logger = get_logger(
+    name="azureaiapp_bootstrap",
+    log_level=logging.INFO,
+    log_file_name=os.getenv("APP_LOG_FILE"),
+    log_to_console=True
+)
+
+STATUS_CREATING = 'creating'
+STATUS_READY = 'ready'
+STATUS_FAILED = 'failed'
+# The bootstrap updates the heartbeat with this interval, the state without the heartbeat
+# for STALE_AFTER seconds is left by the dead bootstrap.
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0
+
+
+def index_state_file() -> str:
+    """Return the file, the index state is shared through."""
+    return os.getenv('AZURE_AI_SEARCH_INDEX_STATE_FILE') or os.path.join(
+        tempfile.gettempdir(), f"azureaiapp-index-{os.getenv('AZURE_AI_SEARCH_INDEX_NAME', 'default')}.json")
+
+
+def write_index_state(state_file: str, status: str, **kwargs: Any) -> None:
+    """
+    Atomically replace the index state.
+
+    :param state_file: The state file.
+    :param status: One of STATUS_CREATING, STATUS_READY or STATUS_FAILED.
+    """
+    save_manifest(state_file, {'status': status, 'heartbeat': time.time(), **kwargs})
+
+
+def read_index_state(state_file: str) -> Optional[dict[str, Any]]:
+    """
+    Read the index state.
+
+    :param state_file: The state file.
+    :return: The state or None if the bootstrap was not started.
+    """
+    return load_manifest(state_file)
+
+
+def is_bootstrap_alive(state: dict[str, Any], stale_after: float = STALE_AFTER) -> bool:
+    """
+    Check if the bootstrap process, which has written the state, is still running.
+
+    :param state: The index state.
+    :param stale_after: The time in seconds without the heartbeat, after which the bootstrap is considered dead.
+    :return: True if the heartbeat is recent and the process exists.
+    """
+    heartbeat = state.get('heartbeat')
+    if heartbeat is None or time.time() - heartbeat > stale_after:
+        return False
+    pid = state.get('pid')
+    if pid is not None:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists, but belongs to another user.
+            pass
+    return True
+
+
+async def _send_heartbeats(state_file: str, index_name: Optional[str]) -> None:
+    """Update the heartbeat of the bootstrap in the state until cancelled."""
+    while True:
+        write_index_state(state_file, STATUS_CREATING, index_name=index_name, pid=os.getpid())
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+
+async def create_index_maybe(state_file: str) -> None:
+    """
+    Create the index and upload documents if the index does not exist.
+
+    rag.create_index return True if the index was created, meaning that this
+    docker node have started first and must populate index.
+    :param state_file: The file to write the index state to.
+    """
+    index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME')
+    heartbeats = asyncio.create_task(_send_heartbeats(state_file, index_name))
+    try:
+        from azure.identity.aio import DefaultAzureCredential
+
+        from .embeddings_store import default_embeddings_file
+        from .search_index_manager import SearchIndexManager
+        async with DefaultAzureCredential() as creds:
+            search_mgr = SearchIndexManager(
+                endpoint=os.environ['AZURE_AI_SEARCH_ENDPOINT'],
+                credential=creds,
+                index_name=index_name,
+                dimensions=None,
+                model=os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
+                embeddings_client=None
+            )
+            # If another application instance already have created the index,
+            # do not upload the documents.
+            if await search_mgr.create_index(
+              vector_index_dimensions=int(
+                  os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
+                embeddings_path = default_embeddings_file()
+                assert embeddings_path, f'File {embeddings_path} not found.'
+                await search_mgr.upload_documents(embeddings_path)
+            elif not await SearchIndexManager.index_exists(os.environ['AZURE_AI_SEARCH_ENDPOINT'], creds, index_name):
+                # create_index returns False on any error, not only if the index exists.
+                raise RuntimeError(f"The index {index_name} was neither created nor found.")
+            await search_mgr.close()
+    except Exception as e:
+        logger.exception("Unable to create the index %s.", index_name)
+        await _stop(heartbeats)
+        write_index_state(state_file, STATUS_FAILED, index_name=index_name, error=str(e))
+        return
+    await _stop(heartbeats)
+    write_index_state(state_file, STATUS_READY, index_name=index_name)
+
+
+async def _stop(task: asyncio.Task) -> None:
+    """Cancel the task and wait until it has stopped."""
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+
+def run_bootstrap(state_file: str) -> None:
+    """Create the index, this function is executed in the bootstrap process."""
+    asyncio.run(create_index_maybe(state_file))
+
+
+def start_bootstrap(state_file: str) -> multiprocessing.Process:
+    """
+    Start creating the index in the separate process.
+
+    :param state_file: The file to write the index state to.
+    :return: The bootstrap process.
+    """
+    write_index_state(state_file, STATUS_CREATING, index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'))
+    # The spawned process does not inherit the state of the master.
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_bootstrap, args=(state_file,), name='index-bootstrap', daemon=True)
+    process.start()
+    return process
+
+
+async def wait_for_index(
+        search_index_manager: Any,
+        state_file: str,
+        vector_index_dimensions: Optional[int] = None,
+        poll_interval: float = 1.0,
+        max_retry_delay: float = 60.0,
+        deadline: Optional[float] = 600.0,
+        stale_after: float = STALE_AFTER) -> None:
+    """
+    Make the search index manager ready as soon as the index is usable.
+
+    If the master has started the bootstrap, wait for it and use the index it has found.
+    Otherwise, or if the bootstrap has failed, has died or has not finished before the
+    deadline, get or create the index in this process, retrying on errors.
+    :param search_index_manager: The search index manager of the worker.
+    :param state_file: The index state file.
+    :param vector_index_dimensions: The number of dimensions in the vector index.
+    :param poll_interval: The time in seconds between reading the state file.
+    :param max_retry_delay: The maximal time in seconds between attempts to get the index.
+    :param deadline: The maximal time in seconds to wait for the bootstrap, None to wait while it is alive.
+    :param stale_after: The time in seconds without the heartbeat, after which the bootstrap is considered dead.
+    """
+    started = time.monotonic()
+    while True:
+        state = read_index_state(state_file)
+        if state is None or state['status'] != STATUS_CREATING:
+            break
+        if not is_bootstrap_alive(state, stale_after):
+            logger.warning("The index bootstrap is not running, getting the index in this process.")
+            break
+        if deadline is not None and time.monotonic() - started > deadline:
+            logger.warning("The index bootstrap has not finished in %.0f seconds, getting the index in this process.",
+                           deadline)
+            break
+        await asyncio.sleep(poll_interval)
+    if state is not None and state['status'] == STATUS_READY:
+        search_index_manager.attach_index()
+        logger.info("The index %s is ready.", state['index_name'])
+        return
+    delay = poll_interval
+    while True:
+        try:
+            await search_index_manager.ensure_index_created(vector_index_dimensions=vector_index_dimensions)
+            logger.info("The index is ready.")
+            return
+        except Exception:
+            logger.exception("Unable to get the index, retrying in %.0f seconds.", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
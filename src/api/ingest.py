@@ -0,0 +1,153 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Build the embeddings file from the directory with markdown files.
+
+The files are split into sentences and packed into chunks by the pool of processes,
+one file per task, and the chunks are merged in the order of sorted file names, so
+the result does not depend on the number of processes. The chunks are then embedded
+by SearchIndexManager.embed_chunks, exactly as build_embeddings_file does.
+
+Usage:
+    python -m api.ingest api/data/markdown api/data/embeddings.csv --processes 8
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+from collections.abc import Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from . import chunking
+
+
+def chunk_file(
+        file_name: str,
+        max_tokens: int = chunking.EMBEDDING_MAX_TOKENS,
+        max_sentences: Optional[int] = None,
+        overlap_tokens: int = 0) -> list[str]:
+    """
+    Split one file into chunks, this function is executed in the worker process.
+
+    :param file_name: The markdown file.
+    :param max_tokens: The maximal number of tokens in the chunk.
+    :param max_sentences: The maximal number of sentences in the chunk.
+    :param overlap_tokens: The number of tokens repeated at the beginning of the next chunk.
+    :return: The chunks of the file.
+    """
+    from nltk.tokenize import sent_tokenize
+    return list(chunking.iter_chunks(
+        chunking.iter_sentences(file_name, sent_tokenize),
+        max_tokens=max_tokens,
+        max_sentences=max_sentences,
+        overlap_tokens=overlap_tokens))
+
+
+def chunk_files(
+        files: Sequence[str],
+        processes: Optional[int] = None,
+        max_tokens: int = chunking.EMBEDDING_MAX_TOKENS,
+        max_sentences: Optional[int] = None,
+        overlap_tokens: int = 0) -> Iterator[str]:
+    """
+    Split the files into chunks in parallel.
+
+    :param files: The markdown files.
+    :param processes: The number of worker processes, by default the number of CPUs.
+    :param max_tokens: The maximal number of tokens in the chunk.
+    :param max_sentences: The maximal number of sentences in the chunk.
+    :param overlap_tokens: The number of tokens repeated at the beginning of the next chunk.
+    :return: The iterator over chunks in the order of files.
+    """
+    # Check the nltk data once, before the workers start.
+    chunking.ensure_punkt()
+    n = len(files)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # map returns the results in the order of files, whichever worker finishes first.
+        for chunks in executor.map(
+                chunk_file, files, [max_tokens] * n, [max_sentences] * n, [overlap_tokens] * n):
+            yield from chunks
+
+
+async def embed(chunks: Iterator[str], output_file: str, batch_size: int, max_concurrency: int) -> None:
+    """
+    Embed the chunks, using the embedding deployment of the AI project.
+
+    :param chunks: The chunks to be embedded.
+    :param output_file: The csv file to store embeddings.
+    :param batch_size: The number of chunks embedded in one request.
+    :param max_concurrency: The maximal number of embedding requests sent at the same time.
+    """
+    from azure.ai.projects.aio import AIProjectClient
+    from azure.identity.aio import DefaultAzureCredential
+
+    from .search_index_manager import SearchIndexManager
+
+    async with DefaultAzureCredential() as creds:
+        async with AIProjectClient.from_connection_string(
+            credential=creds,
+            conn_str=os.environ["AZURE_AIPROJECT_CONNECTION_STRING"],
+        ) as project:
+            async with (await project.inference.get_embeddings_client()) as embeddings_client:
+                dimensions = os.getenv('AZURE_AI_EMBED_DIMENSIONS')
+                search_index_manager = SearchIndexManager(
+                    endpoint=os.getenv('AZURE_AI_SEARCH_ENDPOINT'),
+                    credential=creds,
+                    index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
+                    dimensions=int(dimensions) if dimensions else None,
+                    model=os.environ['AZURE_AI_EMBED_DEPLOYMENT_NAME'],
+                    embeddings_client=embeddings_client,
+                )
+                await search_index_manager.embed_chunks(
+                    chunks, output_file, batch_size=batch_size, max_concurrency=max_concurrency)
+
+
+def main(argv: Optional[list[str]] = None) -> None:
+    """Build the embeddings file from the directory with markdown files."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('input_directory', help='The directory with *.md files.')
+    parser.add_argument('output_file', help='The csv file to store embeddings.')
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help='The number of processes splitting the files. Default: the number of CPUs.')
+    parser.add_argument(
+        '--sentences-per-embedding', type=int, default=4,
+        help='The maximal number of sentences in the chunk, 0 for no limit. Default: 4.')
+    parser.add_argument(
+        '--max-tokens', type=int, default=chunking.EMBEDDING_MAX_TOKENS,
+        help='The maximal number of tokens in the chunk.')
+    parser.add_argument(
+        '--overlap-tokens', type=int, default=0,
+        help='The number of tokens repeated at the beginning of the next chunk.')
+    parser.add_argument(
+        '--batch-size', type=int, default=2000, help='The number of chunks embedded in one request.')
+    parser.add_argument(
+        '--max-concurrency', type=int, default=4, help='The number of embedding requests sent at the same time.')
+    parser.add_argument(
+        '--chunks-only', action='store_true',
+        help='Do not embed the chunks, write them to output_file as JSON lines instead.')
+    args = parser.parse_args(argv)
+
+    files = sorted(glob.glob(os.path.join(args.input_directory, '*.md')))
+    chunks = chunk_files(
+        files,
+        processes=args.processes,
+        max_tokens=args.max_tokens,
+        max_sentences=args.sentences_per_embedding or None,
+        overlap_tokens=args.overlap_tokens)
+    if args.chunks_only:
+        with open(args.output_file, 'w') as fp:
+            for chunk in chunks:
+                fp.write(json.dumps(chunk, ensure_ascii=False) + '\n')
+    else:
+        if not os.getenv("RUNNING_IN_PRODUCTION"):
+            from dotenv import load_dotenv
+            load_dotenv(override=True)
+        asyncio.run(embed(chunks, args.output_file, args.batch_size, args.max_concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+from collections.abc import Sequence
+
+import numpy as np
+
+from .embeddings_store import EmbeddingsStore
+
+
+class LocalSearchBackend:
+    """
+    The in-process vector search over the embeddings file.
+
+    The whole corpus is kept in one contiguous float32 matrix and the top-k
+    cosine neighbours of a question are found with a single matrix-vector product,
+    so no network round trip to Azure AI Search is needed.
+
+    :param tokens: The text chunks, one per matrix row.
+    :param embeddings: The matrix of shape (len(tokens), dimensions) with the embeddings.
+    """
+
+    def __init__(self, tokens: Sequence[str], embeddings: np.ndarray) -> None:
+        """Constructor."""
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(tokens):
+            raise ValueError(
+                "The embeddings must be a two dimensional matrix with one row per token.")
+        self._tokens = tokens
+        self._embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        # Keep the row norms aside instead of normalizing the matrix in place,
+        # this way the matrix itself is never copied or written to.
+        norms = np.linalg.norm(self._embeddings, axis=1)
+        norms[norms == 0] = 1.0
+        self._inverse_norms = (1.0 / norms).astype(np.float32)
+
+    @property
+    def dimensions(self) -> int:
+        """The number of dimensions in the embeddings."""
+        return self._embeddings.shape[1]
+
+    def __len__(self) -> int:
+        return self._embeddings.shape[0]
+
+    def search(self, vector: Sequence[float], k: int) -> list[str]:
+        """
+        Return the tokens of k nearest neighbours by the cosine similarity.
+
+        :param vector: The embedded question.
+        :param k: The number of neighbours to return.
+        :return: The tokens, the most similar first.
+        """
+        return [self._tokens[i] for i in self._top_k(vector, k)]
+
+    def search_with_vectors(self, vector: Sequence[float], k: int) -> tuple[list[str], np.ndarray]:
+        """
+        Return the tokens and embeddings of k nearest neighbours by the cosine similarity.
+
+        :param vector: The embedded question.
+        :param k: The number of neighbours to return.
+        :return: The tokens, the most similar first, and the matrix of their embeddings.
+        """
+        top = self._top_k(vector, k)
+        return [self._tokens[i] for i in top], self._embeddings[top]
+
+    def _top_k(self, vector: Sequence[float], k: int) -> np.ndarray:
+        """Return the row numbers of k nearest neighbours, the most similar first."""
+        query = np.asarray(vector, dtype=np.float32)
+        if query.shape != (self.dimensions,):
+            raise ValueError(
+                f"The query has {query.size} dimensions, while the embeddings have {self.dimensions}.")
+        k = min(k, len(self))
+        if k <= 0:
+            return np.arange(0)
+        # The query norm does not change the ranking, so we do not divide by it.
+        scores = (self._embeddings @ query) * self._inverse_norms
+        if k < len(scores):
+            top = np.argpartition(scores, -k)[-k:]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind='stable')]
+
+    @staticmethod
+    def from_embeddings_file(embeddings_file: str) -> 'LocalSearchBackend':
+        """
+        Load the embeddings file, generated by SearchIndexManager.build_embeddings_file.
+
+        The binary (.npy) embeddings file is memory mapped, so the worker processes
+        share one copy of the embeddings.
+        :param embeddings_file: The csv or binary embeddings file.
+        :return: The search backend.
+        """
+        store = EmbeddingsStore.load(embeddings_file)
+        return LocalSearchBackend(store.tokens, store.vectors)
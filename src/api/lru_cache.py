@@ -0,0 +1,99 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import time
+from collections import OrderedDict
+from collections.abc import Hashable
+from typing import Any, Callable, Optional
+
+
+class LRUCache:
+    """
+    The bounded cache, evicting the least recently used entries.
+
+    :param max_size: The maximal number of entries in the cache.
+    :param ttl: The time in seconds after which the entry expires. If None, entries do not expire.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            max_size: int,
+            ttl: Optional[float] = None,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        if max_size <= 0:
+            raise ValueError("The cache size must be positive.")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._timer = timer
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Return the cached value and mark it as recently used.
+
+        :param key: The key of the entry.
+        :param default: The value to return if the entry is absent or expired.
+        :return: The cached value or default.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self._timer():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Add the value to the cache, evicting the least recently used entry if the cache is full.
+
+        :param key: The key of the entry.
+        :param value: The value to be cached.
+        """
+        expires_at = None if self._ttl is None else self._timer() + self._ttl
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Remove the entry from the cache.
+
+        :param key: The key of the entry.
+        :param default: The value to return if the entry is absent.
+        :return: The removed value or default.
+        """
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Return the cache counters."""
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
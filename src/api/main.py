@@ -1,26 +1,71 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import asyncio
 import contextlib
+import importlib
 import logging
 import os
 from typing import Union
 
 import fastapi
-from azure.ai.projects.aio import AIProjectClient
-from azure.identity import AzureDeveloperCliCredential, ManagedIdentityCredential
 from dotenv import load_dotenv
 from fastapi.staticfiles import StaticFiles
 
-from .search_index_manager import SearchIndexManager
+from .admission import AdmissionController
+from .metrics import Metrics
+from .rate_limit import RateLimitedClient, RateLimiter
+from .sessions import FileSessionStore, LocalSessionStore
 from .util import get_logger
 
 logger = None
 enable_trace = False
 
+# The Azure SDKs take seconds to import, they are imported by lifespan, when the
+# configuration is known, so that the features, which are off, do not slow down the start.
+AZURE_MODULES = (
+    'azure.ai.projects.aio',
+    'azure.identity',
+    'azure.ai.inference.prompts',
+    'api.http_pool',
+    'api.token_cache',
+)
+SEARCH_MODULES = (
+    'api.search_index_manager',
+    'api.index_bootstrap',
+)
+
+
+def is_search_enabled() -> bool:
+    """Return True if the retrieval is configured."""
+    if not os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'):
+        return False
+    if os.getenv('AZURE_AI_SEARCH_BACKEND', 'azure').lower() == 'local':
+        return True
+    return bool(os.getenv('AZURE_AI_SEARCH_ENDPOINT') and os.getenv('AZURE_AI_SEARCH_INDEX_NAME'))
+
+
+def preload_modules() -> None:
+    """
+    Import the modules, which lifespan will need, in advance.
+
+    gunicorn calls it in the master process, so the workers, forked from it, share the
+    imported modules and do not import them again every time they are restarted.
+    """
+    modules = AZURE_MODULES + (SEARCH_MODULES if is_search_enabled() else ())
+    for module in modules:
+        importlib.import_module(module)
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: fastapi.FastAPI):
-    azure_credential: Union[AzureDeveloperCliCredential, ManagedIdentityCredential]
+    from azure.ai.projects.aio import AIProjectClient
+    from azure.identity.aio import AzureDeveloperCliCredential, ManagedIdentityCredential
+
+    from .http_pool import HttpConnectionPool
+    from .token_cache import SharedTokenCredential
+
+    azure_credential: Union[AzureDeveloperCliCredential, ManagedIdentityCredential, SharedTokenCredential]
     if not os.getenv("RUNNING_IN_PRODUCTION"):
         if tenant_id := os.getenv("AZURE_TENANT_ID"):
             logger.info("Using AzureDeveloperCliCredential with tenant_id %s", tenant_id)
@@ -33,10 +78,28 @@ async def lifespan(app: fastapi.FastAPI):
         user_identity_client_id = os.getenv("AZURE_CLIENT_ID")
         logger.info("Using ManagedIdentityCredential with client_id %s", user_identity_client_id)
         azure_credential = ManagedIdentityCredential(client_id=user_identity_client_id)
+    if os.getenv('AZURE_TOKEN_CACHE', 'true').lower() == 'true':
+        # The workers share the tokens instead of requesting them one by one.
+        azure_credential = SharedTokenCredential(
+            azure_credential,
+            cache_file=os.getenv('AZURE_TOKEN_CACHE_FILE'),
+            refresh_margin=float(os.getenv('AZURE_TOKEN_REFRESH_MARGIN_SECONDS', '300')),
+            # The applications of the same user, running as other identities, do not share the tokens.
+            identity=':'.join((
+                type(azure_credential).__name__,
+                os.getenv('AZURE_CLIENT_ID', ''),
+                os.getenv('AZURE_TENANT_ID', ''))))
 
+    # All clients of the worker send their requests through one pool of connections.
+    http_pool = HttpConnectionPool(
+        limit=int(os.getenv('AZURE_HTTP_POOL_SIZE', '100')),
+        limit_per_host=int(os.getenv('AZURE_HTTP_POOL_SIZE_PER_HOST', '0')),
+        keepalive_timeout=float(os.getenv('AZURE_HTTP_KEEPALIVE_SECONDS', '30')),
+        dns_cache_ttl=int(os.getenv('AZURE_HTTP_DNS_CACHE_SECONDS', '300')))
     project = AIProjectClient.from_connection_string(
         credential=azure_credential,
         conn_str=os.environ["AZURE_AIPROJECT_CONNECTION_STRING"],
+        transport=http_pool.transport(),
     )
 
     if enable_trace:
@@ -54,40 +117,188 @@ async def lifespan(app: fastapi.FastAPI):
             from azure.monitor.opentelemetry import configure_azure_monitor
             configure_azure_monitor(connection_string=application_insights_connection_string)
 
-    chat = await project.inference.get_chat_completions_client()
-    embed = await project.inference.get_embeddings_client()
+    chat = await project.inference.get_chat_completions_client(transport=http_pool.transport())
+    embed = await project.inference.get_embeddings_client(transport=http_pool.transport())
+    # Keep the calls within the quotas of the deployments, shared by all workers.
+    workers = int(os.getenv('GUNICORN_WORKERS') or '1')
+    if os.getenv('AZURE_AI_CHAT_TPM') or os.getenv('AZURE_AI_CHAT_RPM'):
+        chat = RateLimitedClient(
+            chat,
+            RateLimiter(
+                tokens_per_minute=float(os.getenv('AZURE_AI_CHAT_TPM') or '0'),
+                requests_per_minute=float(os.getenv('AZURE_AI_CHAT_RPM') or '0'),
+                workers=workers),
+            completion_tokens=int(os.getenv('AZURE_AI_CHAT_COMPLETION_TOKENS', '1000')))
+    if os.getenv('AZURE_AI_EMBED_TPM') or os.getenv('AZURE_AI_EMBED_RPM'):
+        embed = RateLimitedClient(
+            embed,
+            RateLimiter(
+                tokens_per_minute=float(os.getenv('AZURE_AI_EMBED_TPM') or '0'),
+                requests_per_minute=float(os.getenv('AZURE_AI_EMBED_RPM') or '0'),
+                workers=workers))
 
     endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
     search_index_manager = None
+    index_task = None
     embed_dimensions = None
     if os.getenv('AZURE_AI_EMBED_DIMENSIONS'):
         embed_dimensions = int(os.getenv('AZURE_AI_EMBED_DIMENSIONS'))
+    context_packer = None
+    if is_search_enabled():
+        # The retrieval modules are imported only if the retrieval is used.
+        from .cache import SemanticCache
+        from .context_packing import ContextPacker
+        from .embeddings_store import default_embeddings_file
+        from .hedging import HedgedCall
+        from .index_bootstrap import index_state_file, wait_for_index
+        from .local_search import LocalSearchBackend
+        from .lru_cache import LRUCache
+        from .search_index_manager import SearchIndexManager
+
+        embedding_cache = None
+        embedding_cache_size = int(os.getenv('AZURE_AI_EMBED_CACHE_SIZE', '1024'))
+        if embedding_cache_size > 0:
+            embedding_cache = LRUCache(
+                max_size=embedding_cache_size,
+                ttl=float(os.getenv('AZURE_AI_EMBED_CACHE_TTL', '3600')))
+        retrieval_cache = None
+        retrieval_cache_size = int(os.getenv('AZURE_AI_SEARCH_CACHE_SIZE', '0'))
+        if retrieval_cache_size > 0 and embed_dimensions:
+            retrieval_cache = SemanticCache(
+                max_size=retrieval_cache_size,
+                dimensions=embed_dimensions,
+                similarity_threshold=float(os.getenv('AZURE_AI_SEARCH_CACHE_SIMILARITY', '0.98')),
+                ttl=float(os.getenv('AZURE_AI_SEARCH_CACHE_TTL', '600')))
+        embedding_batch_size = int(os.getenv('AZURE_AI_EMBED_BATCH_SIZE', '1'))
+        embedding_batch_delay = float(os.getenv('AZURE_AI_EMBED_BATCH_DELAY_MS', '5')) / 1000
+        collapse_identical_queries = os.getenv('AZURE_AI_SEARCH_COLLAPSE_QUERIES', 'true').lower() == 'true'
+        if int(os.getenv('AZURE_AI_SEARCH_CONTEXT_TOKENS', '0')) > 0:
+            context_packer = ContextPacker(
+                token_budget=int(os.getenv('AZURE_AI_SEARCH_CONTEXT_TOKENS')),
+                max_results=SearchIndexManager.K_NEAREST_NEIGHBORS,
+                candidates=int(os.getenv('AZURE_AI_SEARCH_CANDIDATES', '20')),
+                diversity=float(os.getenv('AZURE_AI_SEARCH_DIVERSITY', '0.3')),
+                duplicate_similarity=float(os.getenv('AZURE_AI_SEARCH_DUPLICATE_SIMILARITY', '0.95')))
         
-    if endpoint and os.getenv('AZURE_AI_SEARCH_INDEX_NAME') and os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'):
-        search_index_manager = SearchIndexManager(
-            endpoint = endpoint,
-            credential = azure_credential,
-            index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
-            dimensions = embed_dimensions,
-            model = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
-            embeddings_client=embed
-        )
-        # Create index and upload the documents only if index does not exist.
-        logger.info(f"Creating index {os.getenv('AZURE_AI_SEARCH_INDEX_NAME')}.")
-        await search_index_manager.ensure_index_created(
-            vector_index_dimensions=embed_dimensions if embed_dimensions else 100)
+        if os.getenv('AZURE_AI_SEARCH_BACKEND', 'azure').lower() == 'local':
+            # Search the bundled embeddings in process, Azure AI Search is not used.
+            embeddings_file = os.getenv('AZURE_AI_EMBEDDINGS_FILE') or default_embeddings_file()
+            logger.info(f"Using the local search backend with the embeddings file {embeddings_file}.")
+            search_index_manager = SearchIndexManager(
+                endpoint = endpoint,
+                credential = azure_credential,
+                index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
+                dimensions = embed_dimensions,
+                model = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
+                embeddings_client=embed,
+                local_search_backend=LocalSearchBackend.from_embeddings_file(embeddings_file),
+                embedding_cache=embedding_cache,
+                retrieval_cache=retrieval_cache,
+                context_packer=context_packer,
+                embedding_batch_size=embedding_batch_size,
+                embedding_batch_delay=embedding_batch_delay,
+                collapse_identical_queries=collapse_identical_queries,
+                http_pool=http_pool,
+                metrics=app.state.metrics
+            )
+        else:
+            search_hedging = None
+            hedge = os.getenv('AZURE_AI_SEARCH_HEDGE', 'false').lower() == 'true'
+            deadline = float(os.getenv('AZURE_AI_SEARCH_DEADLINE_SECONDS', '0'))
+            if hedge or deadline > 0:
+                search_hedging = HedgedCall(
+                    percentile=float(os.getenv('AZURE_AI_SEARCH_HEDGE_PERCENTILE', '95')),
+                    # Without hedging, only the deadline is applied.
+                    max_hedge_ratio=float(os.getenv('AZURE_AI_SEARCH_HEDGE_MAX_RATIO', '0.1')) if hedge else 0,
+                    deadline=deadline or None)
+            search_index_manager = SearchIndexManager(
+                endpoint = endpoint,
+                credential = azure_credential,
+                index_name = os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
+                dimensions = embed_dimensions,
+                model = os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
+                embeddings_client=embed,
+                embedding_cache=embedding_cache,
+                retrieval_cache=retrieval_cache,
+                context_packer=context_packer,
+                embedding_batch_size=embedding_batch_size,
+                embedding_batch_delay=embedding_batch_delay,
+                collapse_identical_queries=collapse_identical_queries,
+                http_pool=http_pool,
+                search_hedging=search_hedging,
+                metrics=app.state.metrics
+            )
+            # The index is created by the master in the background, the chat works without
+            # the retrieval until the index is ready.
+            logger.info(f"Waiting for the index {os.getenv('AZURE_AI_SEARCH_INDEX_NAME')}.")
+            index_task = asyncio.create_task(wait_for_index(
+                search_index_manager,
+                index_state_file(),
+                vector_index_dimensions=embed_dimensions if embed_dimensions else 100,
+                deadline=float(os.getenv('AZURE_AI_SEARCH_BOOTSTRAP_TIMEOUT_SECONDS', '600'))))
     else:
         logger.info("The RAG search will not be used.")
 
+    metrics = app.state.metrics
+    metrics_task = None
+    if metrics is not None:
+        metrics.add_collector('http_pool', http_pool.stats)
+        for name, client in (('chat_rate_limiter', chat), ('embed_rate_limiter', embed)):
+            if isinstance(client, RateLimitedClient):
+                metrics.add_collector(name, client.limiter.stats)
+        if search_index_manager is not None:
+            for name, component in (
+                    ('embedding_cache', search_index_manager.embedding_cache),
+                    ('retrieval_cache', search_index_manager.retrieval_cache),
+                    ('embedding_batcher', search_index_manager.embedding_batcher),
+                    ('single_flight', search_index_manager.single_flight),
+                    ('search_hedging', search_index_manager.search_hedging)):
+                if component is not None:
+                    metrics.add_collector(name, component.stats)
+        metrics_task = asyncio.create_task(
+            metrics.write_periodically(float(os.getenv('METRICS_WRITE_SECONDS', '5'))))
+
     app.state.chat = chat
+    app.state.http_pool = http_pool
     app.state.search_index_manager = search_index_manager
     app.state.chat_model = os.environ["AZURE_AI_CHAT_DEPLOYMENT_NAME"]
     yield
 
+    if index_task is not None and not index_task.done():
+        index_task.cancel()
+    if metrics_task is not None:
+        metrics_task.cancel()
+        # The last requests of the worker are counted before the master archives them.
+        metrics.write()
     await project.close()
     await chat.close()
+    for client in (chat, embed):
+        if isinstance(client, RateLimitedClient):
+            logger.info(f"Rate limiter: {client.limiter.stats()}")
     if search_index_manager is not None:
+        if search_index_manager.embedding_cache is not None:
+            logger.info(f"Question embeddings cache: {search_index_manager.embedding_cache.stats()}")
+        if search_index_manager.retrieval_cache is not None:
+            logger.info(f"Retrieved context cache: {search_index_manager.retrieval_cache.stats()}")
+        if search_index_manager.embedding_batcher is not None:
+            logger.info(f"Question embedding batches: {search_index_manager.embedding_batcher.stats()}")
+        if search_index_manager.single_flight is not None:
+            logger.info(f"Collapsed identical searches: {search_index_manager.single_flight.stats()}")
+        if search_index_manager.search_hedging is not None:
+            logger.info(f"Index query hedging: {search_index_manager.search_hedging.stats()}")
+        if context_packer is not None and context_packer.requests:
+            logger.info(
+                f"Context packing saved {context_packer.total_tokens_saved} tokens "
+                f"in {context_packer.requests} requests.")
         await search_index_manager.close()
+    await embed.close()
+    logger.info(f"HTTP connection pool: {http_pool.stats()}")
+    if app.state.admission_controller is not None:
+        logger.info(f"Chat admission: {app.state.admission_controller.stats()}")
+    if app.state.session_store is not None:
+        logger.info(f"Chat sessions: {app.state.session_store.stats()}")
+    await http_pool.close()
+    await azure_credential.close()
 
 
 def create_app():
@@ -121,6 +332,39 @@ def create_app():
         logger.info("Tracing is not enabled")
 
     app = fastapi.FastAPI(lifespan=lifespan)
+    max_concurrency = int(os.getenv('CHAT_MAX_CONCURRENCY', '100'))
+    app.state.admission_controller = None
+    if max_concurrency > 0:
+        app.state.admission_controller = AdmissionController(
+            max_concurrency=max_concurrency,
+            max_queue=int(os.getenv('CHAT_MAX_QUEUE', '100')),
+            max_queue_time=float(os.getenv('CHAT_MAX_QUEUE_SECONDS', '10')))
+    max_sessions = int(os.getenv('CHAT_SESSION_STORE_SIZE', '0'))
+    app.state.session_store = None
+    if max_sessions > 0:
+        session_ttl = float(os.getenv('CHAT_SESSION_TTL_SECONDS', '3600'))
+        session_store = os.getenv('CHAT_SESSION_STORE', 'local').lower()
+        if session_store == 'file':
+            # The workers of the node share the conversations.
+            app.state.session_store = FileSessionStore(
+                directory=os.getenv('CHAT_SESSION_DIR') or None, max_sessions=max_sessions, ttl=session_ttl)
+        elif session_store == 'local':
+            app.state.session_store = LocalSessionStore(max_sessions=max_sessions, ttl=session_ttl)
+            workers = int(os.getenv('GUNICORN_WORKERS') or '1')
+            if workers > 1:
+                logger.warning(
+                    f"The sessions are kept by each of the {workers} workers, the follow-up turns, served by "
+                    "another worker, resend the whole conversation. Set CHAT_SESSION_STORE=file to share them.")
+        else:
+            raise ValueError(f"Unknown CHAT_SESSION_STORE {session_store!r}, expected 'local' or 'file'.")
+    app.state.metrics = None
+    if os.getenv('METRICS_ENABLED', 'true').lower() == 'true':
+        # gunicorn sets METRICS_DIR, so that /metrics reports all workers.
+        app.state.metrics = Metrics(directory=os.getenv('METRICS_DIR') or None)
+        if app.state.admission_controller is not None:
+            app.state.metrics.add_collector('admission', app.state.admission_controller.stats)
+        if app.state.session_store is not None:
+            app.state.metrics.add_collector('sessions', app.state.session_store.stats)
     app.mount("/static", StaticFiles(directory="api/static"), name="static")
 
     from . import routes  # noqa
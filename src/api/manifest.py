@@ -0,0 +1,33 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import os
+from typing import Any, Optional
+
+
+def load_manifest(file_name: str) -> Optional[dict[str, Any]]:
+    """
+    Load the manifest file.
+
+    :param file_name: The manifest file.
+    :return: The manifest or None if the file does not exist.
+    """
+    # The file may be removed by another process at any time.
+    try:
+        with open(file_name) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def save_manifest(file_name: str, manifest: dict[str, Any]) -> None:
+    """
+    Atomically replace the manifest file.
+
+    :param file_name: The manifest file.
+    :param manifest: The manifest to be saved.
+    """
+    with open(file_name + '.tmp', 'w') as fp:
+        json.dump(manifest, fp)
+    os.replace(file_name + '.tmp', file_name)
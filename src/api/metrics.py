@@ -0,0 +1,298 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+The latency histograms and counters of the chat, exposed in the Prometheus text format.
+
+Every worker counts its own requests. If the metrics directory is set, the worker
+periodically writes its snapshot there, and /metrics, served by any worker, adds up the
+snapshots of all workers. When a worker exits, the gunicorn master moves its counters
+and histograms to the archive, so that the totals do not drop when the workers are recycled.
+"""
+import asyncio
+import bisect
+import glob
+import os
+from collections.abc import Sequence
+from typing import Any, Callable, Optional
+
+from .manifest import load_manifest, save_manifest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DELTA_RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500)
+ARCHIVE_FILE = 'archive.json'
+
+
+def _worker_file(directory: str, pid: int) -> str:
+    """Return the file with the snapshot of the worker."""
+    return os.path.join(directory, f'metrics-{pid}.json')
+
+
+def _escape(value: str) -> str:
+    """Escape the label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format(value: float) -> str:
+    """Format the sample value."""
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    The distribution of the observed values.
+
+    :param name: The name of the metric.
+    :param help: The description of the metric.
+    :param buckets: The upper bounds of the buckets in the ascending order.
+    """
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        """Constructor."""
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # The last count is for the values above the largest bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        """Count the value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def snapshot(self) -> dict[str, Any]:
+        """Return the counts and the sum."""
+        return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class Counter:
+    """
+    The number of events, counted separately for every value of the label.
+
+    :param name: The name of the metric.
+    :param help: The description of the metric.
+    :param label: The name of the label.
+    """
+
+    def __init__(self, name: str, help: str, label: str) -> None:
+        """Constructor."""
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1) -> None:
+        """Count the event."""
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def snapshot(self) -> dict[str, float]:
+        """Return the counts."""
+        return dict(self.values)
+
+
+class Gauge:
+    """
+    The current value, which goes up and down.
+
+    :param name: The name of the metric.
+    :param help: The description of the metric.
+    """
+
+    def __init__(self, name: str, help: str) -> None:
+        """Constructor."""
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increase the value."""
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrease the value."""
+        self.value -= amount
+
+
+class Metrics:
+    """
+    The metrics of the chat stream stages.
+
+    :param directory: The directory shared by the workers. If None, only the metrics of
+                      this process are reported.
+    :param prefix: The prefix of the metric names.
+    :param pid: The ID of the worker process. If None, the ID of the current process is used,
+                so the metrics can be created before gunicorn forks the workers.
+    """
+
+    def __init__(self, directory: Optional[str] = None, prefix: str = 'azureaiapp', pid: Optional[int] = None) -> None:
+        """Constructor."""
+        self._directory = directory
+        self._prefix = prefix
+        self._pid = pid
+        self.embed_seconds = Histogram('embed_seconds', 'The time to embed the question.')
+        self.search_seconds = Histogram('search_seconds', 'The time to query the index.')
+        self.time_to_first_token_seconds = Histogram(
+            'time_to_first_token_seconds', 'The time from the chat completion request to the first answer token.')
+        self.deltas_per_second = Histogram(
+            'deltas_per_second', 'The answer deltas per second after the first one.', DELTA_RATE_BUCKETS)
+        self.stream_seconds = Histogram('chat_stream_seconds', 'The duration of the chat stream.')
+        self.streams_in_flight = Gauge('chat_streams_in_flight', 'The chat streams being served.')
+        self.errors = Counter('chat_errors_total', 'The failed chat streams by the error type.', 'type')
+        self._histograms = (
+            self.embed_seconds,
+            self.search_seconds,
+            self.time_to_first_token_seconds,
+            self.deltas_per_second,
+            self.stream_seconds)
+        self._collectors: dict[str, Callable[[], dict[str, Any]]] = {}
+
+    @property
+    def pid(self) -> int:
+        """The ID of the worker process."""
+        return os.getpid() if self._pid is None else self._pid
+
+    def add_collector(self, component: str, stats: Callable[[], dict[str, Any]]) -> None:
+        """
+        Report the statistics of the component as the gauges of this worker.
+
+        :param component: The name of the component, used in the metric names.
+        :param stats: The function returning the statistics, the numeric ones are reported.
+        """
+        self._collectors[component] = stats
+
+    def snapshot(self) -> dict[str, Any]:
+        """Return the current values of all metrics of this worker."""
+        components = {}
+        for component, stats in self._collectors.items():
+            for key, value in stats().items():
+                if isinstance(value, (int, float)):
+                    components[f'{component}_{key}'] = value
+        return {
+            'pid': self.pid,
+            'histograms': {histogram.name: histogram.snapshot() for histogram in self._histograms},
+            'counters': {self.errors.name: self.errors.snapshot()},
+            'gauges': {self.streams_in_flight.name: self.streams_in_flight.value},
+            'components': components,
+        }
+
+    def write(self) -> None:
+        """Write the snapshot to the metrics directory for the other workers."""
+        if self._directory is not None:
+            save_manifest(_worker_file(self._directory, self.pid), self.snapshot())
+
+    async def write_periodically(self, interval: float) -> None:
+        """
+        Write the snapshot every interval seconds, until cancelled.
+
+        :param interval: The time in seconds between the snapshots.
+        """
+        if self._directory is None:
+            return
+        while True:
+            self.write()
+            await asyncio.sleep(interval)
+
+    def _snapshots(self) -> tuple[list[dict[str, Any]], Optional[dict[str, Any]]]:
+        """Return the snapshots of the live workers, starting with this one, and the archive."""
+        snapshots = [self.snapshot()]
+        if self._directory is None:
+            return snapshots, None
+        others = []
+        for file_name in glob.glob(os.path.join(self._directory, 'metrics-*.json')):
+            snapshot = load_manifest(file_name)
+            if snapshot is not None and snapshot['pid'] != self.pid:
+                others.append(snapshot)
+        # The archive is read last: the master adds the worker to it before removing its file.
+        archive = load_manifest(os.path.join(self._directory, ARCHIVE_FILE))
+        archived = set(archive['pids']) if archive is not None else set()
+        snapshots.extend(snapshot for snapshot in others if snapshot['pid'] not in archived)
+        return snapshots, archive
+
+    def render(self) -> str:
+        """Return the metrics of all workers in the Prometheus text format."""
+        snapshots, archive = self._snapshots()
+        totals = snapshots if archive is None else snapshots + [archive]
+        lines = []
+        for histogram in self._histograms:
+            name = f'{self._prefix}_{histogram.name}'
+            counts = [0] * (len(histogram.buckets) + 1)
+            total = 0.0
+            for snapshot in totals:
+                data = snapshot['histograms'].get(histogram.name)
+                if data is not None:
+                    counts = [a + b for a, b in zip(counts, data['counts'])]
+                    total += data['sum']
+            lines += [f'# HELP {name} {histogram.help}', f'# TYPE {name} histogram']
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{name}_sum {_format(total)}', f'{name}_count {cumulative}']
+
+        name = f'{self._prefix}_{self.errors.name}'
+        errors: dict[str, float] = {}
+        for snapshot in totals:
+            for label_value, count in snapshot['counters'].get(self.errors.name, {}).items():
+                errors[label_value] = errors.get(label_value, 0) + count
+        lines += [f'# HELP {name} {self.errors.help}', f'# TYPE {name} counter']
+        for label_value, count in sorted(errors.items()):
+            lines.append(f'{name}{{{self.errors.label}="{_escape(label_value)}"}} {_format(count)}')
+
+        # The gauges of the exited workers are not reported.
+        name = f'{self._prefix}_{self.streams_in_flight.name}'
+        lines += [f'# HELP {name} {self.streams_in_flight.help}', f'# TYPE {name} gauge']
+        lines.append(f'{name} {sum(s["gauges"].get(self.streams_in_flight.name, 0) for s in snapshots)}')
+        components: dict[str, list[str]] = {}
+        for snapshot in snapshots:
+            for key, value in snapshot['components'].items():
+                components.setdefault(key, []).append(f'{{pid="{snapshot["pid"]}"}} {_format(value)}')
+        for key, samples in sorted(components.items()):
+            name = f'{self._prefix}_{key}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.extend(name + sample for sample in samples)
+        return '\n'.join(lines) + '\n'
+
+
+def clear_metrics(directory: str) -> None:
+    """
+    Create the metrics directory or remove the snapshots, left there by the previous run.
+
+    :param directory: The metrics directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for file_name in glob.glob(os.path.join(directory, 'metrics-*.json')) + [os.path.join(directory, ARCHIVE_FILE)]:
+        try:
+            os.remove(file_name)
+        except FileNotFoundError:
+            pass
+
+
+def mark_process_dead(directory: str, pid: int) -> None:
+    """
+    Add the counters and histograms of the exited worker to the archive.
+
+    It must be called by one process only, the gunicorn master.
+    :param directory: The metrics directory.
+    :param pid: The ID of the worker process.
+    """
+    worker_file = _worker_file(directory, pid)
+    snapshot = load_manifest(worker_file)
+    if snapshot is None:
+        return
+    archive_file = os.path.join(directory, ARCHIVE_FILE)
+    archive = load_manifest(archive_file) or {'pids': [], 'histograms': {}, 'counters': {}}
+    for name, data in snapshot['histograms'].items():
+        archived = archive['histograms'].get(name)
+        if archived is None:
+            archive['histograms'][name] = data
+        else:
+            archived['counts'] = [a + b for a, b in zip(archived['counts'], data['counts'])]
+            archived['sum'] += data['sum']
+    for name, values in snapshot['counters'].items():
+        archived = archive['counters'].setdefault(name, {})
+        for label_value, count in values.items():
+            archived[label_value] = archived.get(label_value, 0) + count
+    archive['pids'].append(pid)
+    save_manifest(archive_file, archive)
+    os.remove(worker_file)
@@ -0,0 +1,230 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import time
+from collections.abc import Awaitable, Mapping
+from typing import Any, Callable, Optional
+
+from .chunking import estimate_tokens
+
+
+class TokenBucket:
+    """
+    The bucket of the quota units, refilled continuously.
+
+    :param per_minute: The number of units, which can be spent in a minute.
+    """
+
+    def __init__(self, per_minute: float, now: float) -> None:
+        """Constructor."""
+        self.capacity = per_minute
+        self.level = per_minute
+        self._rate = per_minute / 60.0
+        self._updated = now
+
+    def refill(self, now: float) -> None:
+        """Add the units, accumulated since the last refill."""
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def time_to_take(self, amount: float) -> float:
+        """Return the time in seconds until the amount can be taken."""
+        # The request, larger than the bucket, waits for the full bucket.
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self._rate)
+
+
+class RateLimiter:
+    """
+    The client side limiter of requests and tokens per minute of the model deployment.
+
+    The requests wait, in the order of arrival, until both the request and the token
+    buckets have the room for them. The buckets are kept in sync with the service:
+    the remaining quota from the x-ratelimit-remaining-requests and
+    x-ratelimit-remaining-tokens headers lowers the buckets, and the retry-after
+    header of the throttled response holds all requests for the given time.
+    The quota of the deployment is shared by the workers, every worker uses its share.
+
+    :param tokens_per_minute: The tokens per minute quota, 0 for no limit.
+    :param requests_per_minute: The requests per minute quota, 0 for no limit.
+    :param workers: The number of processes sharing the quota.
+    :param timer: The function returning the current time in seconds.
+    :param sleep: The coroutine function to wait for the given number of seconds.
+    """
+
+    def __init__(
+            self,
+            tokens_per_minute: float = 0,
+            requests_per_minute: float = 0,
+            workers: int = 1,
+            timer: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], Awaitable[Any]] = asyncio.sleep
+        ) -> None:
+        """Constructor."""
+        self._workers = max(1, workers)
+        self._timer = timer
+        self._sleep = sleep
+        now = timer()
+        self._tokens = TokenBucket(tokens_per_minute / self._workers, now) if tokens_per_minute > 0 else None
+        self._requests = TokenBucket(requests_per_minute / self._workers, now) if requests_per_minute > 0 else None
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+        self.requests = 0
+        self.delayed = 0
+        self.throttled = 0
+        self.total_delay = 0.0
+
+    async def acquire(self, tokens: float) -> None:
+        """
+        Wait until the request with the given number of tokens fits the quota and spend it.
+
+        :param tokens: The estimated number of tokens in the request.
+        """
+        async with self._lock:
+            self.requests += 1
+            delayed = False
+            while True:
+                now = self._timer()
+                wait = self._blocked_until - now
+                for bucket, amount in ((self._tokens, tokens), (self._requests, 1)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait = max(wait, bucket.time_to_take(amount))
+                if wait <= 0:
+                    break
+                delayed = True
+                self.total_delay += wait
+                await self._sleep(wait)
+            if delayed:
+                self.delayed += 1
+            for bucket, amount in ((self._tokens, tokens), (self._requests, 1)):
+                if bucket is not None:
+                    bucket.level -= min(amount, bucket.capacity)
+
+    def update(self, status_code: int, headers: Mapping[str, str]) -> None:
+        """
+        Adjust the buckets to the rate limit headers of the response.
+
+        :param status_code: The HTTP status of the response.
+        :param headers: The response headers.
+        """
+        now = self._timer()
+        for bucket, header in (
+                (self._tokens, 'x-ratelimit-remaining-tokens'),
+                (self._requests, 'x-ratelimit-remaining-requests')):
+            value = headers.get(header)
+            if bucket is not None and value is not None:
+                try:
+                    remaining = float(value) / self._workers
+                except ValueError:
+                    continue
+                bucket.refill(now)
+                bucket.level = min(bucket.level, remaining)
+        delay = None
+        if headers.get('retry-after-ms'):
+            delay = float(headers['retry-after-ms']) / 1000
+        elif headers.get('retry-after'):
+            try:
+                delay = float(headers['retry-after'])
+            except ValueError:
+                pass
+        if status_code == 429:
+            self.throttled += 1
+            if delay is not None:
+                self._blocked_until = max(self._blocked_until, now + delay)
+
+    def on_response(self, pipeline_response: Any) -> None:
+        """The raw_response_hook of Azure SDK clients, passing the response headers to update."""
+        response = pipeline_response.http_response
+        self.update(response.status_code, response.headers)
+
+    def stats(self) -> dict[str, float]:
+        """Return the limiter counters."""
+        return {
+            'requests': self.requests,
+            'delayed': self.delayed,
+            'throttled': self.throttled,
+            'total_delay_seconds': self.total_delay,
+        }
+
+
+def _count_input_tokens(value: Any, count_tokens: Callable[[str], int]) -> int:
+    """Estimate the tokens in the input of embed or in the messages of complete."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return count_tokens(value)
+    if isinstance(value, Mapping):
+        return _count_input_tokens(value.get('content'), count_tokens)
+    if isinstance(value, (list, tuple)):
+        return sum(_count_input_tokens(item, count_tokens) for item in value)
+    return _count_input_tokens(getattr(value, 'content', None), count_tokens)
+
+
+class RateLimitedClient:
+    """
+    The wrapper of ChatCompletionsClient or EmbeddingsClient, limiting the calls of complete and embed.
+
+    All other attributes are taken from the wrapped client.
+
+    :param client: The client to be wrapped.
+    :param limiter: The limiter of the model deployment.
+    :param completion_tokens: The tokens, counted for the completion if max_tokens is not given.
+    :param count_tokens: The function returning the number of tokens in the text.
+    """
+
+    def __init__(
+            self,
+            client: Any,
+            limiter: RateLimiter,
+            completion_tokens: int = 0,
+            count_tokens: Callable[[str], int] = estimate_tokens
+        ) -> None:
+        """Constructor."""
+        self._client = client
+        self._limiter = limiter
+        self._completion_tokens = completion_tokens
+        self._count_tokens = count_tokens
+
+    @property
+    def limiter(self) -> RateLimiter:
+        """The limiter of the client."""
+        return self._limiter
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+    def _hook(self, kwargs: dict[str, Any]) -> Callable[[Any], None]:
+        """Return the response hook, calling both the limiter and the hook of the caller."""
+        caller_hook: Optional[Callable[[Any], None]] = kwargs.get('raw_response_hook')
+
+        def hook(pipeline_response):
+            self._limiter.on_response(pipeline_response)
+            if caller_hook is not None:
+                caller_hook(pipeline_response)
+        return hook
+
+    async def complete(self, **kwargs: Any) -> Any:
+        """Call complete of the chat client when the quota allows."""
+        tokens = _count_input_tokens(kwargs.get('messages'), self._count_tokens)
+        # The service counts max_tokens of the completion against the quota up front.
+        tokens += kwargs.get('max_tokens') or self._completion_tokens
+        await self._limiter.acquire(tokens)
+        return await self._client.complete(**{**kwargs, 'raw_response_hook': self._hook(kwargs)})
+
+    async def embed(self, **kwargs: Any) -> Any:
+        """Call embed of the embeddings client when the quota allows."""
+        await self._limiter.acquire(_count_input_tokens(kwargs.get('input'), self._count_tokens))
+        return await self._client.embed(**{**kwargs, 'raw_response_hook': self._hook(kwargs)})
+
+    async def close(self) -> None:
+        """Close the wrapped client."""
+        await self._client.close()
+
+    async def __aenter__(self) -> 'RateLimitedClient':
+        await self._client.__aenter__()
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self._client.__aexit__(*args)
@@ -1,20 +1,31 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
-import json
+import asyncio
 import logging
 import os
+import time
+import uuid
+from collections.abc import AsyncIterator
+from typing import TYPE_CHECKING, Optional
 
 import fastapi
-from fastapi import Request, Depends
+from fastapi import Depends, Request
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from azure.ai.inference.prompts import PromptTemplate
-from azure.ai.inference import ChatCompletionsClient
+from starlette.background import BackgroundTask
 
-from .util import get_logger, ChatRequest
-from .search_index_manager import SearchIndexManager
-from azure.core.exceptions import HttpResponseError
+from .admission import AdmissionController, AdmissionRejected
+from .metrics import Metrics
+from .sessions import SessionStore, trim_history
+from .stream_encoder import DeltaEncoder, encode_line
+from .util import ChatRequest, get_logger
+
+if TYPE_CHECKING:
+    # The SDKs are slow to import, they are imported by main.lifespan when they are used.
+    from azure.ai.inference import ChatCompletionsClient
+
+    from .search_index_manager import SearchIndexManager
 
 
 logger = get_logger(
@@ -27,9 +38,48 @@ logger = get_logger(
 router = fastapi.APIRouter()
 templates = Jinja2Templates(directory="api/templates")
 
+# While the context is being retrieved, the heartbeat is sent with this interval, so that
+# the proxies and load balancers do not close the connection as idle.
+HEARTBEAT_INTERVAL = float(os.getenv("CHAT_STREAM_HEARTBEAT_SECONDS", "5"))
+CONTEXT_SEPARATOR = "\n------\n"
+# The answer deltas are merged into one line per this interval or this number of characters.
+STREAM_FLUSH_INTERVAL = float(os.getenv("CHAT_STREAM_FLUSH_MS", "20")) / 1000
+STREAM_FLUSH_CHARS = int(os.getenv("CHAT_STREAM_FLUSH_CHARS", "1024"))
+# The tokens of the conversation history, kept in the session and sent to the model.
+SESSION_TOKEN_BUDGET = int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", "4000"))
+
+
+def status_frame(status: str, **kwargs) -> bytes:
+    """
+    Return the status line of the response stream.
+
+    The status lines have no "delta" key, so the clients, reading only the deltas, skip them.
+    :param status: The stage of the request processing.
+    :return: The JSON line with the status.
+    """
+    return encode_line({"status": status, **kwargs})
+
+
+async def measured_stream(stream: AsyncIterator[bytes], metrics: Metrics) -> AsyncIterator[bytes]:
+    """
+    Count the stream as in flight and measure its duration.
+
+    :param stream: The response stream.
+    :param metrics: The metrics to update.
+    :return: The lines of the stream.
+    """
+    metrics.streams_in_flight.inc()
+    started = time.perf_counter()
+    try:
+        async for line in stream:
+            yield line
+    finally:
+        metrics.streams_in_flight.dec()
+        metrics.stream_seconds.observe(time.perf_counter() - started)
+
 
 # Accessors to get app state
-def get_chat_client(request: Request) -> ChatCompletionsClient:
+def get_chat_client(request: Request) -> 'ChatCompletionsClient':
     return request.app.state.chat
 
 
@@ -37,32 +87,114 @@ def get_chat_model(request: Request) -> str:
     return request.app.state.chat_model
 
 
-def get_search_index_namager(request: Request) -> SearchIndexManager:
+def get_search_index_namager(request: Request) -> 'SearchIndexManager':
     return request.app.state.search_index_manager
 
 
+def get_admission_controller(request: Request) -> Optional[AdmissionController]:
+    return getattr(request.app.state, 'admission_controller', None)
+
+
+def get_session_store(request: Request) -> Optional[SessionStore]:
+    return getattr(request.app.state, 'session_store', None)
+
+
+def get_metrics(request: Request) -> Optional[Metrics]:
+    return getattr(request.app.state, 'metrics', None)
+
+
 @router.get("/", response_class=HTMLResponse)
 async def index_name(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 
+@router.get("/healthz/live")
+async def liveness():
+    """Report that the worker is running."""
+    return {"status": "alive"}
+
+
+@router.get("/healthz/ready")
+async def readiness(
+    search_index_manager: 'SearchIndexManager' = Depends(get_search_index_namager),
+    admission_controller: Optional[AdmissionController] = Depends(get_admission_controller)
+):
+    """Report if the retrieval is ready, the chat is served without it in the meantime."""
+    admission = admission_controller.stats() if admission_controller is not None else None
+    if search_index_manager is not None and not search_index_manager.is_ready:
+        return fastapi.responses.JSONResponse(
+            {"status": "starting", "rag": False, "admission": admission}, status_code=503)
+    return {"status": "ready", "rag": search_index_manager is not None, "admission": admission}
+
+
+@router.get("/metrics")
+async def metrics_handler(metrics: Optional[Metrics] = Depends(get_metrics)):
+    """Report the metrics of all workers in the Prometheus text format."""
+    if metrics is None:
+        raise fastapi.HTTPException(status_code=404, detail="The metrics are disabled.")
+    return fastapi.responses.PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @router.post("/chat/stream")
 async def chat_stream_handler(
     chat_request: ChatRequest,
-    chat_client: ChatCompletionsClient = Depends(get_chat_client),
+    chat_client: 'ChatCompletionsClient' = Depends(get_chat_client),
     model_deployment_name: str = Depends(get_chat_model),
-    search_index_manager: SearchIndexManager = Depends(get_search_index_namager)
+    search_index_manager: 'SearchIndexManager' = Depends(get_search_index_namager),
+    admission_controller: Optional[AdmissionController] = Depends(get_admission_controller),
+    session_store: Optional[SessionStore] = Depends(get_session_store),
+    metrics: Optional[Metrics] = Depends(get_metrics)
 ) -> fastapi.responses.StreamingResponse:
     if chat_client is None:
         raise Exception("Chat client not initialized")
 
+    # In the session mode, the client sends only the new messages with the session ID.
+    session_id = None
+    history = []
+    if session_store is not None:
+        if chat_request.session_id:
+            history = await session_store.get(chat_request.session_id)
+            if history is None:
+                # The client starts the new session, sending the whole conversation.
+                return fastapi.responses.JSONResponse({"error": "The session has expired."}, status_code=404)
+            session_id = chat_request.session_id
+        else:
+            session_id = uuid.uuid4().hex
+
+    ticket = None
+    if admission_controller is not None:
+        try:
+            ticket = await admission_controller.acquire()
+        except AdmissionRejected as e:
+            logger.warning(f"The request was rejected: {e.reason}, {admission_controller.stats()}")
+            if metrics is not None:
+                metrics.errors.inc(e.reason)
+            return fastapi.responses.JSONResponse(
+                {"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
     async def response_stream():
+        from azure.ai.inference.prompts import PromptTemplate
         messages = [{"role": message.role, "content": message.content} for message in chat_request.messages]
+        if session_id is not None:
+            messages = trim_history(history + messages, SESSION_TOKEN_BUDGET)
+            yield status_frame("session", session_id=session_id)
 
         prompt_messages = PromptTemplate.from_string('You are a helpful assistant').create_messages()
         # Use RAG model, only if we were provided index and we have found a context there.
-        if search_index_manager is not None:
-            context = await search_index_manager.search(chat_request)
+        # Until the index is ready, the questions are answered without the context.
+        if search_index_manager is not None and search_index_manager.is_ready:
+            # Send the first byte right away, the retrieval may take a while.
+            yield status_frame("searching")
+            search_task = asyncio.ensure_future(search_index_manager.search(chat_request))
+            try:
+                while not (await asyncio.wait({search_task}, timeout=HEARTBEAT_INTERVAL))[0]:
+                    yield status_frame("heartbeat")
+            finally:
+                # The client has disconnected.
+                if not search_task.done():
+                    search_task.cancel()
+            context = search_task.result()
+            yield status_frame("sources", count=len(context.split(CONTEXT_SEPARATOR)) if context else 0)
             if context:
                 prompt_messages = PromptTemplate.from_string(
                     'You are a helpful assistant that answers some questions '
@@ -71,25 +203,58 @@ async def chat_stream_handler(
                 logger.info(f"{prompt_messages=}")
             else:
                 logger.info("Unable to find the relevant information in the index for the request.")
+        yield status_frame("generating")
+        encoder = DeltaEncoder(flush_interval=STREAM_FLUSH_INTERVAL, flush_chars=STREAM_FLUSH_CHARS)
+        answer = []
+        started = time.perf_counter()
+        first_token_time = None
         try:
             chat_coroutine = await chat_client.complete(
                 model=model_deployment_name, messages=prompt_messages + messages, stream=True
             )
-            async for event in chat_coroutine:
-                if event.choices:
-                    first_choice = event.choices[0]
-                    yield (
-                        json.dumps(
-                            {
-                                "delta": {
-                                    "content": first_choice.delta.content,
-                                    "role": first_choice.delta.role,
-                                }
-                            },
-                            ensure_ascii=False,
-                        )
-                        + "\n"
-                    )
+            events = chat_coroutine.__aiter__()
+            next_event = None
+            try:
+                while True:
+                    if next_event is None:
+                        next_event = asyncio.ensure_future(events.__anext__())
+                    # If the model pauses, the collected deltas are sent once the flush interval passes.
+                    if not (await asyncio.wait({next_event}, timeout=encoder.time_to_flush()))[0]:
+                        line = encoder.flush()
+                        if line:
+                            yield line
+                        continue
+                    try:
+                        event = next_event.result()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_event = None
+                    if event.choices:
+                        first_choice = event.choices[0]
+                        if first_choice.delta.content:
+                            answer.append(first_choice.delta.content)
+                            if first_token_time is None:
+                                first_token_time = time.perf_counter()
+                                if metrics is not None:
+                                    metrics.time_to_first_token_seconds.observe(first_token_time - started)
+                        line = encoder.add(first_choice.delta.content, first_choice.delta.role)
+                        if line:
+                            yield line
+            finally:
+                # The client has disconnected.
+                if next_event is not None:
+                    next_event.cancel()
+            line = encoder.flush()
+            if line:
+                yield line
+            if metrics is not None and len(answer) > 1:
+                generation_time = time.perf_counter() - first_token_time
+                if generation_time > 0:
+                    metrics.deltas_per_second.observe((len(answer) - 1) / generation_time)
+            if session_id is not None:
+                messages.append({"role": "assistant", "content": ''.join(answer)})
+                await session_store.put(session_id, trim_history(messages, SESSION_TOKEN_BUDGET))
         except BaseException as e:
             error_processed = False
             response = "<div class=\"error\">Error: {}</div>"
@@ -113,17 +278,23 @@ async def chat_stream_handler(
                 error_text = str(e)
                 logger.error(error_text)
                 response = response.format(error_text)
-            yield (
-                json.dumps(
-                    {
-                        "delta": {
-                            "content": response,
-                            "role": "agent",
-                        }
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
+            if metrics is not None:
+                metrics.errors.inc('content_filter' if error_processed else type(e).__name__)
+            # The answer, received before the error, is sent first.
+            yield encoder.flush() + encode_line({"delta": {"content": response, "role": "agent"}})
+
+    stream = response_stream()
+    if metrics is not None:
+        stream = measured_stream(stream, metrics)
+    if ticket is None:
+        return fastapi.responses.StreamingResponse(stream)
+
+    async def admitted_stream():
+        try:
+            async for line in stream:
+                yield line
+        finally:
+            ticket.release()
 
-    return fastapi.responses.StreamingResponse(response_stream())
+    # The background task releases the slot if the client has gone before the stream started.
+    return fastapi.responses.StreamingResponse(admitted_stream(), background=BackgroundTask(ticket.release))
@@ -1,24 +1,65 @@
-from typing import Optional
-
-import glob
+import asyncio
+import collections
 import csv
+import glob
+import hashlib
+import itertools
 import json
+import logging
+import os
+import random
+import time
+from collections.abc import Iterable, Iterator, Mapping
+from typing import Any, NamedTuple, Optional
 
+import numpy as np
+from azure.ai.inference.aio import EmbeddingsClient
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import AsyncHttpTransport
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
-from azure.search.documents.models import VectorizedQuery 
 from azure.search.documents.indexes.models import (
+    HnswAlgorithmConfiguration,
     SearchField,
-    SearchFieldDataType,  
-    SimpleField,
+    SearchFieldDataType,
     SearchIndex,
+    SimpleField,
     VectorSearch,
     VectorSearchProfile,
-    HnswAlgorithmConfiguration)
-from azure.ai.inference.aio import EmbeddingsClient
-from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
-from .util import ChatRequest
+)
+from azure.search.documents.models import VectorizedQuery
+
+from . import chunking
+from .cache import SemanticCache, normalize_text
+from .context_packing import ContextPacker
+from .embedding_batcher import EmbeddingBatcher
+from .embeddings_store import CsvEmbeddings, content_id, iter_embeddings_file, manifest_file
+from .hedging import DeadlineExceeded, HedgedCall
+from .http_pool import HttpConnectionPool
+from .local_search import LocalSearchBackend
+from .lru_cache import LRUCache
+from .manifest import load_manifest, save_manifest
+from .metrics import Metrics
+from .single_flight import SingleFlight
+from .util import ChatRequest, get_logger
+
+logger = get_logger(
+    name="azureaiapp_search",
+    log_level=logging.INFO,
+    log_file_name=os.getenv("APP_LOG_FILE"),
+    log_to_console=True
+)
+
+
+class UploadBatchResult(NamedTuple):
+    """The result of uploading one batch of documents to the index."""
+    batch: int
+    documents: int
+    succeeded: int
+    attempts: int
+    seconds: float
+    action: str = 'upload'
 
 
 class SearchIndexManager:
@@ -33,10 +74,40 @@ class SearchIndexManager:
     :param model: The embedding model to be used,
                   must be the same as one use to build the file with embeddings.
     :param embeddings_client: The embedding client.
+    :param local_search_backend: The in-process search backend. If provided, the search is
+                                 done locally and Azure AI Search is not queried.
+    :param embedding_cache: The cache of question embeddings. If provided, the embeddings of
+                            the repeated questions are taken from the cache.
+    :param retrieval_cache: The cache of retrieved contexts. If provided, the context found for
+                            the similar question is returned without searching the index again.
+    :param context_packer: The selection of search results for the context. If provided, more
+                           candidates are retrieved, deduplicated and packed into the token budget.
+    :param embedding_batch_size: The maximal number of concurrent questions embedded in one
+                                 request. If greater than 1, the questions, arriving within
+                                 embedding_batch_delay seconds, are embedded together.
+    :param embedding_batch_delay: The time in seconds the question waits for the others to be
+                                  embedded in the same request.
+    :param collapse_identical_queries: If True, the concurrent searches of the same question
+                                       share one embedding and search call.
+    :param http_pool: The pool of connections, shared with the other clients. If None, every
+                      search client opens its own connections.
+    :param search_hedging: The hedging of slow index queries. If provided, the slow query is
+                           repeated, and if the deadline is exceeded, the question is answered
+                           without the context.
+    :param metrics: The metrics, the embedding and index query latencies are counted in.
     """
     
-    MIN_DIFF_CHARACTERS_IN_LINE = 5
-    MIN_LINE_LENGTH = 5
+    MIN_DIFF_CHARACTERS_IN_LINE = chunking.MIN_DIFF_CHARACTERS_IN_LINE
+    MIN_LINE_LENGTH = chunking.MIN_LINE_LENGTH
+    K_NEAREST_NEIGHBORS = 5
+    # Azure AI Search accepts up to 1000 documents and 16 MB per indexing request.
+    UPLOAD_BATCH_SIZE = 1000
+    UPLOAD_BATCH_BYTES = 15 * 1024 * 1024
+    UPLOAD_CONCURRENCY = 4
+    UPLOAD_RETRIES = 5
+    UPLOAD_RETRY_STATUS_CODES = (429, 503)
+    EMBEDDING_BATCH_SIZE = 2000
+    EMBEDDING_CONCURRENCY = 4
     
     def __init__(
             self,
@@ -46,6 +117,16 @@ class SearchIndexManager:
             dimensions: Optional[int],
             model: str,
             embeddings_client: EmbeddingsClient,
+            local_search_backend: Optional[LocalSearchBackend] = None,
+            embedding_cache: Optional[LRUCache] = None,
+            retrieval_cache: Optional[SemanticCache] = None,
+            context_packer: Optional[ContextPacker] = None,
+            embedding_batch_size: int = 1,
+            embedding_batch_delay: float = 0.005,
+            collapse_identical_queries: bool = True,
+            http_pool: Optional[HttpConnectionPool] = None,
+            search_hedging: Optional[HedgedCall] = None,
+            metrics: Optional[Metrics] = None,
         ) -> None:
         """Constructor."""
         self._dimensions = dimensions
@@ -56,14 +137,37 @@ class SearchIndexManager:
         self._index = None
         self._model = model
         self._client = None
+        self._local_search_backend = local_search_backend
+        self._embedding_cache = embedding_cache
+        self._retrieval_cache = retrieval_cache
+        self._context_packer = context_packer
+        self._embedding_batcher = None
+        if embedding_batch_size > 1:
+            self._embedding_batcher = EmbeddingBatcher(
+                self._embed_texts, max_batch_size=embedding_batch_size, max_delay=embedding_batch_delay)
+        self._single_flight = SingleFlight() if collapse_identical_queries else None
+        self._http_pool = http_pool
+        self._search_hedging = search_hedging
+        self._metrics = metrics
+        # Incremented every time the index contents change.
+        self._index_generation = 0
 
     def _get_client(self):
         """Get search client if it is absent."""
         if self._client is None:
             self._client = SearchClient(
-                endpoint=self._endpoint, index_name=self._index.name, credential=self._credential)
+                endpoint=self._endpoint,
+                index_name=self._index.name,
+                credential=self._credential,
+                transport=self._get_transport())
         return self._client
 
+    def _get_transport(self) -> Optional[AsyncHttpTransport]:
+        """Return the transport for the new client or None to use the default one."""
+        if self._http_pool is None:
+            return None
+        return self._http_pool.transport()
+
     async def search(self, message: ChatRequest) -> str:
         """
         Search the message in the vector store.
@@ -71,41 +175,426 @@ class SearchIndexManager:
         :param message: The customer question.
         :return: The context for the question.
         """
-        self._raise_if_no_index()
-        embedded_question = (await self._embeddings_client.embed(
-            input=message.messages[-1].content,
+        if self._local_search_backend is None:
+            self._raise_if_no_index()
+        if self._single_flight is None:
+            return await self._retrieve(message)
+        # The searches, started after the index has changed, do not join the earlier ones.
+        key = (normalize_text(message.messages[-1].content), self._index_generation)
+        return await self._single_flight.do(key, lambda: self._retrieve(message))
+
+    async def _retrieve(self, message: ChatRequest) -> str:
+        """
+        Embed the message and search the context for it.
+
+        :param message: The customer question.
+        :return: The context for the question.
+        """
+        embedded_question = await self._embed_question(message)
+        if self._retrieval_cache is not None:
+            context = self._retrieval_cache.get(embedded_question)
+            if context is not None:
+                return context
+        generation = self._index_generation
+        started = time.perf_counter()
+        try:
+            if self._context_packer is None:
+                results = await self._search_vector(embedded_question)
+            else:
+                results = await self._search_and_pack(embedded_question)
+        except DeadlineExceeded:
+            logger.warning("The index query has exceeded the deadline, the context is not used.")
+            return ""
+        if self._metrics is not None:
+            self._metrics.search_seconds.observe(time.perf_counter() - started)
+        context = "\n------\n".join(results)
+        # Do not cache the context if the index has changed while we were searching.
+        if self._retrieval_cache is not None and generation == self._index_generation:
+            self._retrieval_cache.put(embedded_question, context)
+        return context
+
+    async def _embed_question(self, message: ChatRequest) -> list[float]:
+        """
+        Get the embedding of the last message in the request.
+
+        :param message: The customer question.
+        :return: The embedding vector.
+        """
+        question = message.messages[-1].content
+        if self._embedding_cache is None:
+            return await self._embed(question)
+        key = (normalize_text(question), self._model, self._dimensions)
+        embedding = self._embedding_cache.get(key)
+        if embedding is None:
+            embedding = await self._embed(question)
+            self._embedding_cache.put(key, embedding)
+        return embedding
+
+    async def _embed(self, text: str) -> list[float]:
+        """
+        Get the embedding of the text from the embeddings client.
+
+        :param text: The text to be embedded.
+        :return: The embedding vector.
+        """
+        started = time.perf_counter()
+        if self._embedding_batcher is not None:
+            embedding = await self._embedding_batcher.embed(text)
+        else:
+            embedding = (await self._embeddings_client.embed(
+                input=text,
+                dimensions=self._dimensions,
+                model=self._model
+            ))['data'][0]['embedding']
+        if self._metrics is not None:
+            self._metrics.embed_seconds.observe(time.perf_counter() - started)
+        return embedding
+
+    async def _embed_texts(self, texts: list[str]) -> list[list[float]]:
+        """
+        Get the embeddings of several texts in one request to the embeddings client.
+
+        :param texts: The texts to be embedded.
+        :return: The embedding vectors in the same order as texts.
+        """
+        data = (await self._embeddings_client.embed(
+            input=texts,
             dimensions=self._dimensions,
             model=self._model
-        ))['data'][0]['embedding']
-        vector_query = VectorizedQuery(vector=embedded_question, k_nearest_neighbors=5, fields="embedding")
-        response = await self._get_client().search(
-            vector_queries=[vector_query],
-            select=['token'],
-        )
-        results = [result['token'] async for result in response]
-        return "\n------\n".join(results)
+        ))['data']
+        return [item['embedding'] for item in sorted(data, key=lambda item: item['index'])]
+
+    @property
+    def embedding_cache(self) -> Optional[LRUCache]:
+        """The cache of question embeddings if any."""
+        return self._embedding_cache
+
+    @property
+    def retrieval_cache(self) -> Optional[SemanticCache]:
+        """The cache of retrieved contexts if any."""
+        return self._retrieval_cache
+
+    @property
+    def single_flight(self) -> Optional[SingleFlight]:
+        """The collapsing of concurrent identical searches if enabled."""
+        return self._single_flight
+
+    @property
+    def embedding_batcher(self) -> Optional[EmbeddingBatcher]:
+        """The coalescer of concurrent question embeddings if any."""
+        return self._embedding_batcher
+
+    def _on_index_changed(self) -> None:
+        """Invalidate the retrieved contexts, the index contents have changed."""
+        self._index_generation += 1
+        if self._retrieval_cache is not None:
+            self._retrieval_cache.invalidate()
+
+    async def _search_vector(self, vector: list[float]) -> list[str]:
+        """
+        Get the tokens closest to the vector.
+
+        :param vector: The embedded question.
+        :return: The list of tokens found.
+        """
+        if self._local_search_backend is not None:
+            return self._local_search_backend.search(vector, SearchIndexManager.K_NEAREST_NEIGHBORS)
+        vector_query = VectorizedQuery(
+            vector=vector, k_nearest_neighbors=SearchIndexManager.K_NEAREST_NEIGHBORS, fields="embedding")
+        results = await self._query_index(vector_query, select=['token'])
+        return [result['token'] for result in results]
+
+    async def _query_index(self, vector_query: VectorizedQuery, **kwargs: Any) -> list[dict[str, Any]]:
+        """
+        Query the index, hedging the slow queries if configured.
+
+        :param vector_query: The vector query.
+        :param kwargs: The other arguments of SearchClient.search.
+        :return: The list of the search results.
+        """
+        async def query():
+            response = await self._get_client().search(vector_queries=[vector_query], **kwargs)
+            return [result async for result in response]
+
+        if self._search_hedging is None:
+            return await query()
+        return await self._search_hedging.call(query)
+
+    @property
+    def search_hedging(self) -> Optional[HedgedCall]:
+        """The hedging of index queries if any."""
+        return self._search_hedging
+
+    async def _search_and_pack(self, vector: list[float]) -> list[str]:
+        """
+        Get more candidates than needed and select the context from them.
+
+        :param vector: The embedded question.
+        :return: The list of tokens selected.
+        """
+        k = self._context_packer.candidates
+        if self._local_search_backend is not None:
+            tokens, vectors = self._local_search_backend.search_with_vectors(vector, k)
+        else:
+            vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields="embedding")
+            results = await self._query_index(vector_query, select=['token', 'embedding'], top=k)
+            tokens = [result['token'] for result in results]
+            vectors = None
+            # The embeddings are absent if the field is not retrievable.
+            if results and all(result.get('embedding') for result in results):
+                vectors = np.array([result['embedding'] for result in results], dtype=np.float32)
+        packed = self._context_packer.pack(vector, tokens, vectors)
+        logger.info(
+            f"Packed {len(packed.chunks)} of {packed.candidates} candidates ({packed.duplicates} duplicates) "
+            f"into {packed.tokens} tokens, {packed.tokens_saved} tokens saved.")
+        return packed.chunks
     
-    async def upload_documents(self, embeddings_file: str) -> None:
+    async def upload_documents(
+            self,
+            embeddings_file: str,
+            batch_size: int = UPLOAD_BATCH_SIZE,
+            max_batch_bytes: int = UPLOAD_BATCH_BYTES,
+            max_concurrency: int = UPLOAD_CONCURRENCY,
+            max_retries: int = UPLOAD_RETRIES,
+            index_manifest_file: Optional[str] = None,
+        ) -> list[UploadBatchResult]:
         """
         Upload the embeggings file to index search.
 
-        :param embeddings_file: The embeddings file to upload.
+        The file is read lazily and uploaded in batches, bounded by the number of
+        documents and by the size of the request. The throttled batches are retried
+        with the exponential backoff.
+        :param embeddings_file: The embeddings file to upload, either csv or binary (.npy).
+        :param batch_size: The maximal number of documents in one request.
+        :param max_batch_bytes: The maximal size of documents in one request.
+        :param max_concurrency: The maximal number of requests sent at the same time.
+        :param max_retries: The number of retries of throttled batch.
+        :param index_manifest_file: If provided, the identifiers of uploaded documents are saved
+               to this file to be used by sync_documents.
+        :return: The results of uploading of each batch.
         """
         self._raise_if_no_index()
-        documents = []
-        index = 0
-        with open(embeddings_file, newline='') as fp:
-            reader = csv.DictReader(fp)
-            for row in reader:
-                documents.append(
-                    {
-                        'embedId': str(index),
-                        'token': row['token'],
-                        'embedding': json.loads(row['embedding'])
-                    }
-                )
-                index += 1
-        await self._get_client().upload_documents(documents)
+        ids = []
+
+        def documents():
+            for document in SearchIndexManager._iter_documents(embeddings_file):
+                ids.append(document['embedId'])
+                yield document
+
+        results = await self._index_documents(
+            documents(), 'upload', batch_size, max_batch_bytes, max_concurrency, max_retries)
+        if index_manifest_file:
+            save_manifest(index_manifest_file, {'index': self._index_name, 'ids': sorted(ids)})
+        return results
+
+    async def sync_documents(
+            self,
+            embeddings_file: str,
+            index_manifest_file: str,
+            batch_size: int = UPLOAD_BATCH_SIZE,
+            max_batch_bytes: int = UPLOAD_BATCH_BYTES,
+            max_concurrency: int = UPLOAD_CONCURRENCY,
+            max_retries: int = UPLOAD_RETRIES,
+        ) -> list[UploadBatchResult]:
+        """
+        Bring the index in line with the embeddings file, sending only the changes.
+
+        The document identifiers are the hashes of the document contents, so the documents,
+        absent from the index manifest are new or changed and are merged or uploaded, while
+        the documents, absent from the embeddings file are deleted. The unchanged documents
+        are not sent. If the manifest does not exist, all documents are merged or uploaded.
+        :param embeddings_file: The embeddings file, either csv or binary (.npy).
+        :param index_manifest_file: The file with identifiers of the documents in the index.
+               It is updated after the index was synchronized.
+        :param batch_size: The maximal number of documents in one request.
+        :param max_batch_bytes: The maximal size of documents in one request.
+        :param max_concurrency: The maximal number of requests sent at the same time.
+        :param max_retries: The number of retries of throttled batch.
+        :return: The results of each batch.
+        """
+        self._raise_if_no_index()
+        manifest = load_manifest(index_manifest_file)
+        previous_ids = set()
+        if manifest is not None and manifest.get('index') == self._index_name:
+            previous_ids = set(manifest['ids'])
+        else:
+            logger.warning(
+                f"The index manifest {index_manifest_file} was not found, all the documents will be uploaded.")
+        current_ids = set()
+
+        def changed_documents():
+            for document in SearchIndexManager._iter_documents(embeddings_file):
+                current_ids.add(document['embedId'])
+                if document['embedId'] not in previous_ids:
+                    yield document
+
+        results = await self._index_documents(
+            changed_documents(), 'merge_or_upload', batch_size, max_batch_bytes, max_concurrency, max_retries)
+        deleted = ({'embedId': i} for i in sorted(previous_ids - current_ids))
+        results.extend(await self._index_documents(
+            deleted, 'delete', batch_size, max_batch_bytes, max_concurrency, max_retries))
+        save_manifest(index_manifest_file, {'index': self._index_name, 'ids': sorted(current_ids)})
+        return results
+
+    async def _index_documents(
+            self,
+            documents: Iterable[dict[str, Any]],
+            action: str,
+            batch_size: int,
+            max_batch_bytes: int,
+            max_concurrency: int,
+            max_retries: int,
+        ) -> list[UploadBatchResult]:
+        """
+        Send the documents to the index in batches.
+
+        :param documents: The documents to be sent.
+        :param action: The indexing action, 'upload', 'merge_or_upload' or 'delete'.
+        :param batch_size: The maximal number of documents in one request.
+        :param max_batch_bytes: The maximal size of documents in one request.
+        :param max_concurrency: The maximal number of requests sent at the same time.
+        :param max_retries: The number of retries of throttled batch.
+        :return: The results of each batch.
+        """
+        start = time.perf_counter()
+        results = []
+        pending = set()
+        try:
+            batches = SearchIndexManager._iter_batches(documents, batch_size, max_batch_bytes)
+            for number, batch in enumerate(batches):
+                if len(pending) >= max_concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    results.extend(task.result() for task in done)
+                pending.add(asyncio.create_task(self._upload_batch(number, batch, max_retries, action)))
+            results.extend(await asyncio.gather(*pending))
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            raise
+        finally:
+            # Even the partial upload changes the index.
+            if results or pending:
+                self._on_index_changed()
+        results.sort(key=lambda r: r.batch)
+        seconds = time.perf_counter() - start
+        count = sum(r.documents for r in results)
+        logger.info(
+            f"Sent {count} documents ({action}) in {len(results)} batches in {seconds:.2f} s "
+            f"({count / seconds if seconds else 0:.0f} documents/s), "
+            f"{count - sum(r.succeeded for r in results)} documents failed.")
+        return results
+
+    async def _upload_batch(
+            self,
+            number: int,
+            batch: list[dict[str, Any]],
+            max_retries: int,
+            action: str = 'upload') -> UploadBatchResult:
+        """
+        Send one batch of documents, retrying if the service is throttling.
+
+        :param number: The number of the batch.
+        :param batch: The documents to be sent.
+        :param max_retries: The number of retries.
+        :param action: The indexing action, 'upload', 'merge_or_upload' or 'delete'.
+        :return: The result of the upload.
+        """
+        client = self._get_client()
+        send = {
+            'upload': client.upload_documents,
+            'merge_or_upload': client.merge_or_upload_documents,
+            'delete': client.delete_documents,
+        }[action]
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                indexing_results = await send(batch)
+                break
+            except HttpResponseError as e:
+                if e.status_code not in SearchIndexManager.UPLOAD_RETRY_STATUS_CODES or attempt > max_retries:
+                    raise
+                delay = SearchIndexManager._get_retry_delay(e, attempt)
+                logger.warning(
+                    f"Batch {number} was throttled with status {e.status_code}, retrying in {delay:.1f} s.")
+                await asyncio.sleep(delay)
+        result = UploadBatchResult(
+            batch=number,
+            documents=len(batch),
+            succeeded=sum(1 for r in indexing_results if r.succeeded),
+            attempts=attempt,
+            seconds=time.perf_counter() - start,
+            action=action)
+        logger.info(
+            f"Batch {number}: {result.succeeded} of {result.documents} documents sent ({action}) "
+            f"in {result.seconds:.2f} s, {result.attempts} attempt(s).")
+        return result
+
+    @staticmethod
+    def _get_retry_delay(error: HttpResponseError, attempt: int) -> float:
+        """
+        Return the delay before the next attempt.
+
+        :param error: The error returned by the service.
+        :param attempt: The number of the failed attempt, starting from 1.
+        :return: The delay in seconds, requested by the service or the exponential backoff with jitter.
+        """
+        retry_after = None
+        if error.response is not None:
+            retry_after = error.response.headers.get('Retry-After')
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return min(2 ** attempt, 60) * (0.5 + random.random() / 2)
+
+    @staticmethod
+    def _iter_documents(embeddings_file: str) -> Iterator[dict[str, Any]]:
+        """
+        Read the documents from the embeddings file lazily.
+
+        The document identifier is the hash of its content, so it does not change when
+        the document moves in the file. The duplicate documents are skipped.
+        :param embeddings_file: The embeddings file, either csv or binary (.npy).
+        :return: The iterator over the documents.
+        """
+        seen = set()
+        for token, embedding in iter_embeddings_file(embeddings_file):
+            document_id = content_id(token)
+            if document_id in seen:
+                continue
+            seen.add(document_id)
+            yield {
+                'embedId': document_id,
+                'token': token,
+                'embedding': embedding
+            }
+
+    @staticmethod
+    def _iter_batches(
+            documents: Iterable[dict[str, Any]],
+            batch_size: int,
+            max_batch_bytes: int) -> Iterator[list[dict[str, Any]]]:
+        """
+        Group the documents into batches.
+
+        :param documents: The documents to be grouped.
+        :param batch_size: The maximal number of documents in the batch.
+        :param max_batch_bytes: The maximal size of the serialized documents in the batch.
+        :return: The iterator over the batches.
+        """
+        batch = []
+        batch_bytes = 0
+        for document in documents:
+            document_bytes = len(json.dumps(document).encode('utf-8'))
+            if batch and (len(batch) >= batch_size or batch_bytes + document_bytes > max_batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            yield batch
 
     async def is_index_empty(self) -> bool:
         """
@@ -131,12 +620,24 @@ class SearchIndexManager:
                 "Unable to perform the operation as the index is absent. "
                 "To create index please call create_index")
 
+    @property
+    def is_ready(self) -> bool:
+        """True if the search can be done: the index is known or the local backend is used."""
+        return self._local_search_backend is not None or self._index is not None
+
+    def attach_index(self) -> None:
+        """Use the index, which is known to exist, without querying the search service."""
+        if self._index is None:
+            self._index = SearchIndex(name=self._index_name, fields=[])
+
     async def delete_index(self):
         """Delete the index from vector store."""
         self._raise_if_no_index()
-        async with SearchIndexClient(endpoint=self._endpoint, credential=self._credential) as ix_client:
+        async with SearchIndexClient(
+                endpoint=self._endpoint, credential=self._credential, transport=self._get_transport()) as ix_client:
             await ix_client.delete_index(self._index.name)
         self._index = None
+        self._on_index_changed()
 
     def _check_dimensions(self, vector_index_dimensions: Optional[int] = None) -> int:
         """
@@ -149,7 +650,8 @@ class SearchIndexManager:
         if vector_index_dimensions is None:
             if self._dimensions is None:
                 raise ValueError(
-                    "No embedding dimensions were provided in neither dimensions in the constructor nor in vector_index_dimensions"
+                    "No embedding dimensions were provided in neither dimensions in the constructor "
+                    "nor in vector_index_dimensions"
                     "Dimensions are needed to build the search index, please provide the vector_index_dimensions.")
             vector_index_dimensions = self._dimensions
         if self._dimensions is not None and vector_index_dimensions != self._dimensions:
@@ -176,23 +678,26 @@ class SearchIndexManager:
                 self._endpoint,
                 self._credential,
                 self._index_name,
-                vector_index_dimensions)
+                vector_index_dimensions,
+                transport=self._get_transport())
 
     @staticmethod
     async def index_exists(
         endpoint: str,
         credential: AsyncTokenCredential,
-        index_name: str) -> bool:
+        index_name: str,
+        transport: Optional[AsyncHttpTransport] = None) -> bool:
         """
         Check if index exists.
 
         :param endpoint: The search end point to be used.
         :param credential: The credential to be used for the search.
         :param index_name: The name of an index to get or to create.
+        :param transport: The transport to send the requests through, by default a new one.
         :return: True if index already exists.
         """
         exists = False
-        async with SearchIndexClient(endpoint=endpoint, credential=credential) as ix_client:
+        async with SearchIndexClient(endpoint=endpoint, credential=credential, transport=transport) as ix_client:
             try:
                 await ix_client.get_index(index_name)
                 exists = True
@@ -206,6 +711,7 @@ class SearchIndexManager:
             credential: AsyncTokenCredential,
             index_name: str,
             dimensions: int,
+            transport: Optional[AsyncHttpTransport] = None,
         ) -> SearchIndex:
         """
         Get o create the search index.
@@ -215,10 +721,11 @@ class SearchIndexManager:
         :param credential: The credential to be used for the search.
         :param index_name: The name of an index to get or to create.
         :param dimensions: The number of dimensions in the embedding.
+        :param transport: The transport to send the requests through, by default a new one.
         :return: the search index object.
         """
         index = None
-        async with SearchIndexClient(endpoint=endpoint, credential=credential) as ix_client:
+        async with SearchIndexClient(endpoint=endpoint, credential=credential, transport=transport) as ix_client:
             try:
                 index = await ix_client.get_index(index_name)
             except ResourceNotFoundError:
@@ -228,7 +735,8 @@ class SearchIndexManager:
                 endpoint=endpoint,
                 credential=credential,
                 index_name=index_name,
-                dimensions=dimensions
+                dimensions=dimensions,
+                transport=transport
             )
         return index
 
@@ -255,8 +763,10 @@ class SearchIndexManager:
                 endpoint=self._endpoint,
                 credential=self._credential,
                 index_name=self._index_name,
-                dimensions=vector_index_dimensions
+                dimensions=vector_index_dimensions,
+                transport=self._get_transport()
             )
+            self._on_index_changed()
             return True
         except HttpResponseError:
             return False
@@ -267,9 +777,10 @@ class SearchIndexManager:
         endpoint: str,
         credential: AsyncTokenCredential,
         index_name: str,
-        dimensions: int) -> SearchIndex:
+        dimensions: int,
+        transport: Optional[AsyncHttpTransport] = None) -> SearchIndex:
         """Create the index."""
-        async with SearchIndexClient(endpoint=endpoint, credential=credential) as ix_client:
+        async with SearchIndexClient(endpoint=endpoint, credential=credential, transport=transport) as ix_client:
             fields = [
                 SimpleField(name="embedId", type=SearchFieldDataType.String, key=True),
                 SearchField(
@@ -295,7 +806,13 @@ class SearchIndexManager:
             self,
             input_directory: str,
             output_file: str,
-            sentences_per_embedding: int=4
+            sentences_per_embedding: Optional[int]=4,
+            max_tokens_per_embedding: int=chunking.EMBEDDING_MAX_TOKENS,
+            overlap_tokens: int=0,
+            batch_size: int=EMBEDDING_BATCH_SIZE,
+            max_concurrency: int=EMBEDDING_CONCURRENCY,
+            resume: bool=True,
+            incremental: bool=True
             ) -> None:
         """
         In this method we do lazy loading of nltk and download the needed data set to split
@@ -309,48 +826,232 @@ class SearchIndexManager:
         :param output_file: The file csv file to store embeddings.
         :param embeddings_client: The embedding client, used to create embeddings. 
                 Must be the same as the one used for SearchIndexManager creation.
-        :param sentences_per_embedding: The number of sentences used to build embedding.
+        :param sentences_per_embedding: The maximal number of sentences used to build embedding.
+               If None, the chunks are limited only by max_tokens_per_embedding.
         :param model: The embedding model to be used.
+        :param max_tokens_per_embedding: The maximal number of tokens in the chunk. The sentences
+               longer than this limit are split, so that no chunk is rejected by the embedding model.
+        :param overlap_tokens: The number of tokens at the end of the chunk, repeated at the beginning
+               of the next chunk of the same file.
+        :param batch_size: The number of tokens embedded in one request.
+        :param max_concurrency: The maximal number of embedding requests sent at the same time.
+        :param resume: If True and the previous run was interrupted, continue it from the
+               last finished batch. The progress is kept in the <output_file>.checkpoint file.
+        :param incremental: If True and the output_file was built before with the same model
+               and dimensions, only the new and changed chunks are embedded, the embeddings of
+               other chunks are taken from the output_file. The chunk hashes are kept in the
+               <output_file>.manifest.json file, and the previous build is kept in the
+               <output_file>.previous file until the new one is written.
         """
-        import nltk
-        nltk.download('punkt')
-        
+        chunking.ensure_punkt()
         from nltk.tokenize import sent_tokenize
-        # Split the data to sentence tokens.
-        sentence_tokens = []
-        globs = glob.glob(input_directory + '/*.md', recursive=True)
-        index = 0
-        for fle in globs:
-            with open(fle) as f:
-                for line in f:
-                    line = line.strip()
-                    # Skip non informative lines.
-                    if len(line) < SearchIndexManager.MIN_LINE_LENGTH or len(set(line)) < SearchIndexManager.MIN_DIFF_CHARACTERS_IN_LINE:
-                        continue
-                    for sentence in sent_tokenize(line):
-                        if index % sentences_per_embedding == 0:
-                            sentence_tokens.append(sentence)
-                        else:
-                            sentence_tokens[-1] += ' '
-                            sentence_tokens[-1] += sentence
-                        index += 1
-        
-        
+        # Split the files into chunks lazily, so that they are embedded as they are read.
+        def chunks():
+            for file_name in sorted(glob.glob(input_directory + '/*.md', recursive=True)):
+                yield from chunking.iter_chunks(
+                    chunking.iter_sentences(file_name, sent_tokenize),
+                    max_tokens=max_tokens_per_embedding,
+                    max_sentences=sentences_per_embedding,
+                    overlap_tokens=overlap_tokens)
+
         # For each token build the embedding, which will be used in the search.
-        batch_size = 2000
-        with open(output_file, 'w') as fp:
+        await self.embed_chunks(chunks(), output_file, batch_size, max_concurrency, resume, incremental)
+
+    async def embed_chunks(
+            self,
+            chunks: Iterable[str],
+            output_file: str,
+            batch_size: int=EMBEDDING_BATCH_SIZE,
+            max_concurrency: int=EMBEDDING_CONCURRENCY,
+            resume: bool=True,
+            incremental: bool=True
+            ) -> None:
+        """
+        Build the embeddings of the chunks and write them to the csv file.
+
+        :param chunks: The chunks of text to be embedded, they are consumed lazily.
+        :param output_file: The file csv file to store embeddings.
+        :param batch_size: The number of tokens embedded in one request.
+        :param max_concurrency: The maximal number of embedding requests sent at the same time.
+        :param resume: If True and the previous run was interrupted, continue it from the
+               last finished batch.
+        :param incremental: If True, embed only the chunks absent from the previous build of output_file.
+        """
+        reused = self._load_reusable_embeddings(output_file, resume) if incremental else None
+        try:
+            ids = await self._write_embeddings(
+                chunks, output_file, batch_size, max_concurrency, resume, reused)
+        finally:
+            if reused is not None:
+                reused.close()
+        save_manifest(
+            manifest_file(output_file),
+            {'model': self._model, 'dimensions': self._dimensions, 'ids': ids})
+        if reused is not None:
+            os.remove(output_file + '.previous')
+
+    def _load_reusable_embeddings(self, output_file: str, resume: bool) -> Optional[CsvEmbeddings]:
+        """
+        Open the embeddings of the previous build.
+
+        The previous build is moved to <output_file>.previous, so that its embeddings are
+        read from there, while the new build is written. If the run was interrupted,
+        the previous build of the first run is used.
+        :param output_file: The csv file with embeddings.
+        :param resume: If True, the interrupted run is resumed and the output_file is not moved.
+        :return: The embeddings as JSON strings by chunk hash or None if the file was not built
+                 or was built with the different model or dimensions.
+        """
+        manifest = load_manifest(manifest_file(output_file))
+        if (manifest is None
+                or manifest.get('model') != self._model or manifest.get('dimensions') != self._dimensions):
+            return None
+        previous_file = output_file + '.previous'
+        if not os.path.isfile(previous_file):
+            interrupted = resume and os.path.isfile(output_file + '.checkpoint')
+            if interrupted or not os.path.isfile(output_file):
+                return None
+            os.replace(output_file, previous_file)
+        return CsvEmbeddings(previous_file)
+
+    async def _write_embeddings(
+            self,
+            tokens: Iterable[str],
+            output_file: str,
+            batch_size: int,
+            max_concurrency: int,
+            resume: bool,
+            reused: Optional[Mapping[str, str]] = None) -> list[str]:
+        """
+        Embed the tokens and write them to the csv file.
+
+        The batches are embedded concurrently, but written in order. After each batch
+        is written, the checkpoint is saved, so that the interrupted run can be resumed.
+        :param tokens: The tokens to be embedded.
+        :param output_file: The csv file to store embeddings.
+        :param batch_size: The number of tokens embedded in one request.
+        :param max_concurrency: The maximal number of embedding requests sent at the same time.
+        :param resume: If True, continue the run, saved in the checkpoint.
+        :param reused: The embeddings as JSON strings by chunk hash, which do not need to be computed.
+        :return: The hashes of the chunks written.
+        """
+        reused = reused or {}
+        ids = []
+        embedded = 0
+        checkpoint_file = output_file + '.checkpoint'
+        checkpoint = SearchIndexManager._load_checkpoint(checkpoint_file, output_file, batch_size) if resume else None
+        batches = SearchIndexManager._iter_token_batches(tokens, batch_size)
+        digest = hashlib.sha256()
+        if checkpoint is None:
+            checkpoint = {'batch_size': batch_size, 'batches': 0, 'bytes': 0, 'sha256': digest.hexdigest()}
+            mode = 'w'
+        else:
+            # Make sure that the input did not change since the checkpoint was saved.
+            for batch in itertools.islice(batches, checkpoint['batches']):
+                SearchIndexManager._update_digest(digest, batch)
+                ids.extend(content_id(token) for token in batch)
+            if digest.hexdigest() != checkpoint['sha256']:
+                raise ValueError(
+                    f"The input has changed since the checkpoint {checkpoint_file} was saved, "
+                    "please delete the checkpoint or set resume to False.")
+            logger.info(f"Resuming from the batch {checkpoint['batches']}.")
+            os.truncate(output_file, checkpoint['bytes'])
+            mode = 'a'
+
+        with open(output_file, mode) as fp:
             writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
-            writer.writeheader()
-            for i in range(0, len(sentence_tokens), batch_size):
-                emedding = (await self._embeddings_client.embed(
-                    input=sentence_tokens[i:i+min(batch_size, len(sentence_tokens))],
-                    dimensions=self._dimensions,
-                    model=self._model
-                ))["data"]
-                for token, float_data in zip(sentence_tokens, emedding):
-                    writer.writerow({'token': token, 'embedding': json.dumps(float_data['embedding'])})
+            if mode == 'w':
+                writer.writeheader()
+            pending = collections.deque()
+
+            async def write_oldest_batch():
+                done_batch, task = pending[0]
+                for token, embedding in zip(done_batch, await task):
+                    writer.writerow({'token': token, 'embedding': embedding})
+                    ids.append(content_id(token))
+                pending.popleft()
+                fp.flush()
+                SearchIndexManager._update_digest(digest, done_batch)
+                checkpoint['batches'] += 1
+                checkpoint['bytes'] = os.path.getsize(output_file)
+                checkpoint['sha256'] = digest.hexdigest()
+                SearchIndexManager._save_checkpoint(checkpoint_file, checkpoint)
+
+            try:
+                for batch in batches:
+                    missing = sum(1 for token in batch if content_id(token) not in reused)
+                    embedded += missing
+                    pending.append((batch, asyncio.create_task(self._embed_batch(batch, reused))))
+                    if len(pending) >= max_concurrency:
+                        await write_oldest_batch()
+                while pending:
+                    await write_oldest_batch()
+            except BaseException:
+                for _, task in pending:
+                    task.cancel()
+                raise
+        if os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+        logger.info(f"Embedded {embedded} chunks, reused the embeddings of {len(ids) - embedded} chunks.")
+        return ids
+
+    async def _embed_batch(self, batch: list[str], reused: Mapping[str, str]) -> list[str]:
+        """
+        Embed the batch of tokens.
+
+        :param batch: The tokens to be embedded.
+        :param reused: The embeddings as JSON strings by chunk hash, which do not need to be computed.
+        :return: The embeddings as JSON strings in the same order as tokens.
+        """
+        ids = [content_id(token) for token in batch]
+        missing = [token for token, i in zip(batch, ids) if i not in reused]
+        # The embeddings are paired with the tokens by the index, not by the order of the response.
+        embeddings = iter(await self._embed_texts(missing) if missing else [])
+        return [reused[i] if i in reused else json.dumps(next(embeddings)) for i in ids]
+
+    @staticmethod
+    def _iter_token_batches(tokens: Iterable[str], batch_size: int) -> Iterator[list[str]]:
+        """Group the tokens into the batches of batch_size."""
+        iterator = iter(tokens)
+        while batch := list(itertools.islice(iterator, batch_size)):
+            yield batch
+
+    @staticmethod
+    def _update_digest(digest: Any, batch: list[str]) -> None:
+        """Add the tokens of the batch to the digest of the input."""
+        for token in batch:
+            digest.update(token.encode('utf-8'))
+            digest.update(b'\0')
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_file: str, output_file: str, batch_size: int) -> Optional[dict[str, Any]]:
+        """
+        Load the checkpoint if the run can be resumed from it.
+
+        :param checkpoint_file: The checkpoint file.
+        :param output_file: The csv file to store embeddings.
+        :param batch_size: The number of tokens embedded in one request.
+        :return: The checkpoint or None, if the run has to be started from the beginning.
+        """
+        if not os.path.isfile(checkpoint_file) or not os.path.isfile(output_file):
+            return None
+        with open(checkpoint_file) as fp:
+            checkpoint = json.load(fp)
+        if checkpoint.get('batch_size') != batch_size or os.path.getsize(output_file) < checkpoint['bytes']:
+            logger.warning(f"The checkpoint {checkpoint_file} does not match the output, starting over.")
+            return None
+        return checkpoint
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_file: str, checkpoint: dict[str, Any]) -> None:
+        """Atomically replace the checkpoint file."""
+        with open(checkpoint_file + '.tmp', 'w') as fp:
+            json.dump(checkpoint, fp)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
 
     async def close(self):
         """Close the closeable resources, associated with SearchIndexManager."""
+        if self._embedding_batcher is not None:
+            await self._embedding_batcher.close()
         if self._client:
             await self._client.close()
@@ -0,0 +1,267 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Callable, Optional, Protocol
+
+from .chunking import estimate_tokens
+from .lru_cache import LRUCache
+
+# The session IDs, which can be used as the file names.
+SESSION_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]{1,64}')
+
+
+def trim_history(
+        messages: list[dict[str, str]],
+        token_budget: int,
+        count_tokens: Callable[[str], int] = estimate_tokens) -> list[dict[str, str]]:
+    """
+    Drop the oldest messages, which do not fit the token budget.
+
+    The last message is always kept.
+    :param messages: The messages of the conversation, from the oldest to the newest.
+    :param token_budget: The maximal number of tokens in the messages, 0 for no limit.
+    :param count_tokens: The function returning the number of tokens in the text.
+    :return: The most recent messages fitting the budget.
+    """
+    if token_budget <= 0 or not messages:
+        return messages
+    tokens = count_tokens(messages[-1]['content'])
+    start = len(messages) - 1
+    while start > 0:
+        tokens += count_tokens(messages[start - 1]['content'])
+        if tokens > token_budget:
+            break
+        start -= 1
+    return messages[start:]
+
+
+class SessionStore(Protocol):
+    """The store of the conversation histories, used by the chat in the session mode."""
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, str]]]:
+        """Return the messages or None if the session is unknown or has expired."""
+        ...
+
+    async def put(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        """Save the history of the conversation."""
+        ...
+
+    async def delete(self, session_id: str) -> None:
+        """Forget the conversation."""
+        ...
+
+    def stats(self) -> dict[str, int]:
+        """Return the store counters."""
+        ...
+
+
+class LocalSessionStore:
+    """
+    The in-process store of the conversation histories.
+
+    The conversations are kept in the LRU cache, so the least recently used and idle
+    ones are dropped. The store of the worker is not shared with the other workers,
+    so with several workers the requests of a session must be routed to the same worker,
+    or the FileSessionStore or another SessionStore must be used.
+
+    :param max_sessions: The maximal number of conversations in the store.
+    :param ttl: The time in seconds after the last turn, when the conversation expires.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            max_sessions: int,
+            ttl: Optional[float] = 3600,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        self._sessions = LRUCache(max_size=max_sessions, ttl=ttl, timer=timer)
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, str]]]:
+        """
+        Return the history of the conversation.
+
+        :param session_id: The ID of the session.
+        :return: The messages or None if the session is unknown or has expired.
+        """
+        messages = self._sessions.get(session_id)
+        return None if messages is None else list(messages)
+
+    async def put(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        """
+        Save the history of the conversation.
+
+        :param session_id: The ID of the session.
+        :param messages: The messages of the conversation.
+        """
+        self._sessions.put(session_id, list(messages))
+
+    async def delete(self, session_id: str) -> None:
+        """
+        Forget the conversation.
+
+        :param session_id: The ID of the session.
+        """
+        self._sessions.pop(session_id)
+
+    def stats(self) -> dict[str, int]:
+        """Return the store counters."""
+        return self._sessions.stats()
+
+
+def default_session_directory() -> str:
+    """Return the directory of the sessions in the private directory of the current user."""
+    from .token_cache import default_token_cache_file
+    return os.path.join(os.path.dirname(default_token_cache_file()), 'sessions')
+
+
+class FileSessionStore:
+    """
+    The store of the conversation histories in the directory, shared by the workers of the node.
+
+    Every conversation is kept in its own file, which is replaced atomically, so every worker
+    can continue any session. The conversation expires ttl seconds after its last turn.
+    Every prune_interval writes the expired conversations and the least recently saved ones
+    above max_sessions are removed, so the store may briefly hold more conversations.
+
+    :param directory: The directory of the conversations, readable only by its owner.
+                      By default, the sessions directory next to the token cache.
+    :param max_sessions: The maximal number of conversations in the store.
+    :param ttl: The time in seconds after the last turn, when the conversation expires.
+    :param prune_interval: The number of writes between the removals of the old conversations.
+    :param timer: The function returning the current time in seconds since the epoch.
+    """
+
+    def __init__(
+            self,
+            directory: Optional[str],
+            max_sessions: int,
+            ttl: Optional[float] = 3600,
+            prune_interval: int = 64,
+            timer: Callable[[], float] = time.time
+        ) -> None:
+        """Constructor."""
+        if max_sessions <= 0:
+            raise ValueError("The store size must be positive.")
+        self._directory = directory or default_session_directory()
+        os.makedirs(self._directory, mode=0o700, exist_ok=True)
+        self._max_sessions = max_sessions
+        self._ttl = ttl
+        self._prune_interval = prune_interval
+        self._timer = timer
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _file(self, session_id: str) -> Optional[str]:
+        """Return the file of the session or None if the ID can not be a file name."""
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            return None
+        return os.path.join(self._directory, session_id + '.json')
+
+    def _is_expired(self, modified: float) -> bool:
+        """Return True if the conversation, saved at the given time, has expired."""
+        return self._ttl is not None and modified + self._ttl <= self._timer()
+
+    async def get(self, session_id: str) -> Optional[list[dict[str, str]]]:
+        """
+        Return the history of the conversation.
+
+        :param session_id: The ID of the session.
+        :return: The messages or None if the session is unknown or has expired.
+        """
+        file_name = self._file(session_id)
+        try:
+            if file_name is None:
+                raise FileNotFoundError(session_id)
+            if self._is_expired(os.path.getmtime(file_name)):
+                os.remove(file_name)
+                self.expirations += 1
+                raise FileNotFoundError(file_name)
+            with open(file_name) as fp:
+                messages = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return messages
+
+    async def put(self, session_id: str, messages: list[dict[str, str]]) -> None:
+        """
+        Save the history of the conversation.
+
+        :param session_id: The ID of the session.
+        :param messages: The messages of the conversation.
+        """
+        file_name = self._file(session_id)
+        if file_name is None:
+            raise ValueError(f"Invalid session ID {session_id!r}.")
+        fd, temp_file = tempfile.mkstemp(dir=self._directory, prefix='.session-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(messages, fp)
+            os.replace(temp_file, file_name)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+        self._writes += 1
+        if self._writes % self._prune_interval == 0:
+            self._prune()
+
+    async def delete(self, session_id: str) -> None:
+        """
+        Forget the conversation.
+
+        :param session_id: The ID of the session.
+        """
+        file_name = self._file(session_id)
+        if file_name is not None:
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+
+    def _sessions(self) -> list[tuple[float, str]]:
+        """Return the modification times and the files of the conversations."""
+        sessions = []
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.json'):
+                    try:
+                        sessions.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        pass
+        return sessions
+
+    def _prune(self) -> None:
+        """Remove the expired conversations and the oldest ones above max_sessions."""
+        sessions = sorted(self._sessions(), reverse=True)
+        for i, (modified, file_name) in enumerate(sessions):
+            expired = self._is_expired(modified)
+            if expired or i >= self._max_sessions:
+                try:
+                    os.remove(file_name)
+                except FileNotFoundError:
+                    continue
+                if expired:
+                    self.expirations += 1
+                else:
+                    self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        """Return the store counters of this worker and the number of conversations of all workers."""
+        return {
+            'size': len(self._sessions()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
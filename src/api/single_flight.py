@@ -0,0 +1,75 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+from collections.abc import Awaitable, Hashable
+from typing import Any, Callable
+
+
+class _Flight:
+    """The call in flight and the number of callers waiting for it."""
+
+    def __init__(self, task: asyncio.Task) -> None:
+        """Constructor."""
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    The collapsing of concurrent identical calls.
+
+    While the call with the given key is in flight, the other callers with the same key
+    wait for its result instead of making their own call. The result or the exception of
+    the call is returned to all of them. The call is cancelled only when all its callers
+    are cancelled. The result is not kept after the call completes, the next call with the
+    same key is made again.
+    """
+
+    def __init__(self) -> None:
+        """Constructor."""
+        self._flights: dict[Hashable, _Flight] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Call the function or join the call with the same key in flight.
+
+        :param key: The key, identifying the call.
+        :param function: The coroutine function to be called.
+        :return: The result of the call.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(function()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self.calls += 1
+        else:
+            self.shared += 1
+        flight.waiters += 1
+        try:
+            # The shield keeps the call running for the other callers if this one is cancelled.
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._forget(key, flight)
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        """Remove the completed or abandoned call, so that the next caller makes a new one."""
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict[str, int]:
+        """Return the counters of the calls made and the calls joined."""
+        return {
+            'in_flight': len(self._flights),
+            'calls': self.calls,
+            'shared': self.shared,
+        }
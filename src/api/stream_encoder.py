@@ -0,0 +1,106 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import time
+from typing import Any, Callable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialize the value to compact JSON.
+
+    orjson is used if it is installed, otherwise the standard json module.
+    :param value: The value to be serialized.
+    :return: The UTF-8 encoded JSON.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def encode_line(value: Any) -> bytes:
+    """Return the value as the line of the NDJSON stream."""
+    return dumps(value) + b"\n"
+
+
+class DeltaEncoder:
+    """
+    The encoder of the answer deltas into the lines of the NDJSON stream.
+
+    The model streams the answer token by token. Instead of writing a line for every
+    token, the deltas are collected and written as one {"delta": {"content", "role"}} line
+    once flush_interval seconds have passed since the previous line or flush_chars characters of
+    content are collected. The first delta is written right away, the deltas without
+    content are dropped. The collected deltas are only written by add, so the stream must
+    call flush once time_to_flush seconds pass without the next delta, and when it ends.
+
+    :param flush_interval: The minimal time in seconds between the lines, 0 to write every delta.
+    :param flush_chars: The size in characters of the collected content, which is written without waiting.
+    :param timer: The function returning the current time in seconds.
+    """
+
+    def __init__(
+            self,
+            flush_interval: float = 0.02,
+            flush_chars: int = 1024,
+            timer: Callable[[], float] = time.monotonic
+        ) -> None:
+        """Constructor."""
+        self._flush_interval = flush_interval
+        self._flush_chars = flush_chars
+        self._timer = timer
+        self._parts: list[str] = []
+        self._size = 0
+        self._role: Optional[str] = None
+        self._flushed = None
+        self.deltas = 0
+        self.lines = 0
+
+    def add(self, content: Optional[str], role: Optional[str] = None) -> Optional[bytes]:
+        """
+        Add the delta to the stream.
+
+        :param content: The text of the delta.
+        :param role: The role of the delta, the deltas of the different roles are not merged.
+        :return: The lines to be written, or None if the delta was collected.
+        """
+        if not content:
+            return None
+        self.deltas += 1
+        output = b''
+        if self._parts and role is not None and self._role is not None and role != self._role:
+            output = self.flush()
+        if not self._parts or self._role is None:
+            self._role = role
+        self._parts.append(content)
+        self._size += len(content)
+        now = self._timer()
+        if (self._flushed is None or self._size >= self._flush_chars
+                or now - self._flushed >= self._flush_interval):
+            output += self.flush()
+        return output or None
+
+    def time_to_flush(self) -> Optional[float]:
+        """Return the time in seconds left until the collected deltas are due, or None if there are none."""
+        if not self._parts:
+            return None
+        if self._flushed is None:
+            return 0.0
+        return max(0.0, self._flushed + self._flush_interval - self._timer())
+
+    def flush(self) -> bytes:
+        """Return the line with the collected deltas, or empty bytes if there are none."""
+        if not self._parts:
+            return b''
+        content = self._parts[0] if len(self._parts) == 1 else ''.join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._flushed = self._timer()
+        self.lines += 1
+        return encode_line({"delta": {"content": content, "role": self._role}})
@@ -0,0 +1,209 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+from typing import Any, Optional
+
+from azure.core.credentials import AccessToken
+from azure.core.credentials_async import AsyncTokenCredential
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # The file locks are not available on Windows, the tokens are cached in process only.
+    fcntl = None
+
+
+def default_token_cache_file() -> str:
+    """
+    Return the token cache file, shared by the processes of the current user.
+
+    The file is kept in the directory, which only the current user can access.
+    :return: The path to the cache file.
+    :raises: PermissionError if the directory belongs to another user.
+    """
+    user = os.getuid() if hasattr(os, 'getuid') else os.getenv('USERNAME', 'user')
+    directory = os.path.join(tempfile.gettempdir(), f'azureaiapp-{user}')
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+            raise PermissionError(f"The token cache directory {directory} belongs to another user.")
+        os.chmod(directory, 0o700)
+    return os.path.join(directory, 'tokens.json')
+
+
+def credential_identity(credential: Any) -> str:
+    """
+    Return the identity of the credential, so that the tokens of different identities are not mixed.
+
+    :param credential: The credential.
+    :return: The class of the credential with its client and tenant IDs, if they are known.
+    """
+    parts = [f'{type(credential).__module__}.{type(credential).__qualname__}']
+    # The Azure credentials keep the IDs in themselves or in the credential they wrap.
+    for source in (credential, getattr(credential, '_credential', None)):
+        for name in ('client_id', '_client_id', 'tenant_id', '_tenant_id'):
+            value = getattr(source, name, None) if source is not None else None
+            if isinstance(value, str):
+                parts.append(f'{name.lstrip("_")}={value}')
+    return ';'.join(parts)
+
+
+class SharedTokenCredential:
+    """
+    The async credential, sharing the access tokens between the processes through the file.
+
+    The gunicorn workers wrap their credentials into this class with the same cache file.
+    The token is requested from the wrapped credential by only one worker, holding the file
+    lock, the others read it from the file. The lock is polled, so the event loop of the
+    waiting worker keeps serving the other requests. The token is refreshed refresh_margin
+    seconds before it expires; if the refresh fails, the cached token is used until it expires.
+    The file is readable only by its owner.
+
+    :param credential: The async credential to get the tokens from.
+    :param cache_file: The file with cached tokens. By default, the file in the private
+                       directory of the current user.
+    :param refresh_margin: The time in seconds before the expiration when the token is refreshed.
+    :param timer: The function returning the current time in seconds since the epoch.
+    :param identity: The identity the tokens are issued to, it is a part of the cache key.
+                     By default, it is taken from the credential.
+    :param lock_poll_interval: The time in seconds between the attempts to take the file lock.
+    """
+
+    def __init__(
+            self,
+            credential: AsyncTokenCredential,
+            cache_file: Optional[str] = None,
+            refresh_margin: float = 300,
+            timer=time.time,
+            identity: Optional[str] = None,
+            lock_poll_interval: float = 0.05
+        ) -> None:
+        """Constructor."""
+        self._credential = credential
+        self._identity = identity if identity is not None else credential_identity(credential)
+        self._cache_file = cache_file or default_token_cache_file()
+        self._refresh_margin = refresh_margin
+        self._timer = timer
+        self._lock_poll_interval = lock_poll_interval
+        self._tokens: dict[str, AccessToken] = {}
+        # The coroutines of this worker wait for each other instead of polling the file lock.
+        self._lock = asyncio.Lock()
+        self.fetches = 0
+
+    async def get_token(
+            self,
+            *scopes: str,
+            claims: Optional[str] = None,
+            tenant_id: Optional[str] = None,
+            **kwargs: Any) -> AccessToken:
+        """
+        Get the access token from the memory, the cache file or the wrapped credential.
+
+        :param scopes: The scopes of the token.
+        :param claims: The additional claims, the tokens with claims are never cached.
+        :param tenant_id: The tenant to get the token for.
+        :return: The access token.
+        """
+        if claims:
+            # The claims are requested after the token was rejected, it can not be reused.
+            return await self._credential.get_token(*scopes, claims=claims, tenant_id=tenant_id, **kwargs)
+        key = self._key(scopes, tenant_id)
+        token = self._tokens.get(key)
+        if self._is_fresh(token):
+            return token
+        async with self._lock:
+            # The token may have been refreshed while we were waiting for the lock.
+            token = self._tokens.get(key, token)
+            if self._is_fresh(token):
+                return token
+            if fcntl is None:
+                token = await self._fetch(scopes, tenant_id, kwargs, token)
+                self._tokens[key] = token
+                return token
+            with open(self._cache_file + '.lock', 'a') as lock:
+                await self._lock_file(lock)
+                try:
+                    # Another worker may have refreshed the token while we were waiting for the lock.
+                    cached = self._read().get(key)
+                    token = AccessToken(*cached) if cached else token
+                    if not self._is_fresh(token):
+                        token = await self._fetch(scopes, tenant_id, kwargs, token)
+                        self._write(key, token)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            self._tokens[key] = token
+            return token
+
+    async def _lock_file(self, lock) -> None:
+        """Take the exclusive lock of the file without blocking the event loop."""
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                await asyncio.sleep(self._lock_poll_interval)
+
+    def _key(self, scopes, tenant_id: Optional[str]) -> str:
+        """Return the cache key for the identity, scopes and tenant."""
+        return hashlib.sha256(json.dumps([self._identity, sorted(scopes), tenant_id]).encode('utf-8')).hexdigest()
+
+    def _is_fresh(self, token: Optional[AccessToken]) -> bool:
+        """Return True if the token does not need to be refreshed yet."""
+        return token is not None and token.expires_on - self._refresh_margin > self._timer()
+
+    async def _fetch(
+            self,
+            scopes,
+            tenant_id: Optional[str],
+            kwargs: dict[str, Any],
+            stale: Optional[AccessToken]) -> AccessToken:
+        """Get the new token from the wrapped credential, falling back to the stale one."""
+        try:
+            self.fetches += 1
+            return await self._credential.get_token(*scopes, tenant_id=tenant_id, **kwargs)
+        except Exception:
+            if stale is not None and stale.expires_on > self._timer():
+                return stale
+            raise
+
+    def _read(self) -> dict[str, Any]:
+        """Read the cache file, the broken file is treated as empty."""
+        try:
+            with open(self._cache_file) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, key: str, token: AccessToken) -> None:
+        """Atomically replace the cache file, dropping the expired tokens."""
+        now = self._timer()
+        tokens = {k: v for k, v in self._read().items() if v[1] > now}
+        tokens[key] = [token.token, token.expires_on]
+        # mkstemp creates the new file, readable only by its owner, and never follows links.
+        fd, temp_file = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self._cache_file)), prefix='.tokens-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(tokens, fp)
+            os.replace(temp_file, self._cache_file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+    async def close(self) -> None:
+        """Close the wrapped credential."""
+        await self._credential.close()
+
+    async def __aenter__(self) -> 'SharedTokenCredential':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
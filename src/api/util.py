@@ -1,11 +1,11 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import logging
+import sys
 from typing import Optional
 
-import logging
 import pydantic
-import sys
 
 
 def get_logger(name: str,
@@ -47,4 +47,8 @@ class Message(pydantic.BaseModel):
 
 
 class ChatRequest(pydantic.BaseModel):
+    # The clients of the chat protocol send the session ID as sessionState.
+    model_config = pydantic.ConfigDict(populate_by_name=True)
+
     messages: list[Message]
+    session_id: Optional[str] = pydantic.Field(default=None, alias="sessionState")
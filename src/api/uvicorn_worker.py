@@ -0,0 +1,35 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+from collections.abc import Mapping
+from typing import Any, Optional
+
+from uvicorn.workers import UvicornWorker
+
+
+def worker_config(environ: Optional[Mapping[str, str]] = None) -> dict[str, Any]:
+    """
+    Read the uvicorn settings of the gunicorn worker from the environment.
+
+    :param environ: The environment variables, by default os.environ.
+    :return: The keyword arguments of uvicorn.Config.
+    """
+    if environ is None:
+        environ = os.environ
+    config = {
+        # "auto" selects uvloop and httptools, which are installed with uvicorn[standard].
+        'loop': environ.get('UVICORN_LOOP', 'auto'),
+        'http': environ.get('UVICORN_HTTP', 'auto'),
+    }
+    limit_concurrency = int(environ.get('UVICORN_LIMIT_CONCURRENCY', '0'))
+    if limit_concurrency > 0:
+        # The requests above the limit get 503 instead of slowing down all the others.
+        config['limit_concurrency'] = limit_concurrency
+    return config
+
+
+class AppUvicornWorker(UvicornWorker):
+    """The uvicorn worker, configured by UVICORN_LOOP, UVICORN_HTTP and UVICORN_LIMIT_CONCURRENCY."""
+
+    CONFIG_KWARGS = worker_config()
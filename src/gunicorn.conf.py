@@ -1,49 +1,72 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
-import asyncio
 import multiprocessing
 import os
+import resource
+import shutil
+import tempfile
 
-from azure.identity.aio import DefaultAzureCredential
 
-
-async def create_index_maybe():
+def on_starting(server):
     """
-    Create the index and upload documents if the index does not exist.
+    Server hook, called just before the master process is initialized.
 
-    This code is executed only once, when called on_starting hook is being
-    called. This code ensures that the index is being populated only once.
-    rag.create_index return True if the index was created, meaning that this
-    docker node have started first and must populate index.
+    The index is created and the documents are uploaded by the separate process,
+    only once per node, so the workers start serving the requests right away and
+    wait for the index state, written to the shared file, in the background.
     """
-    from api.search_index_manager import SearchIndexManager
-    async with DefaultAzureCredential() as creds:
-        endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
-        if endpoint:
-            search_mgr = SearchIndexManager(
-                endpoint=endpoint,
-                credential=creds,
-                index_name=os.getenv('AZURE_AI_SEARCH_INDEX_NAME'),
-                dimensions=None,
-                model=os.getenv('AZURE_AI_EMBED_DEPLOYMENT_NAME'),
-                embeddings_client=None
-            )
-            # If another application instance already have created the index,
-            # do not upload the documents.
-            if await search_mgr.create_index(
-              vector_index_dimensions=int(
-                  os.getenv('AZURE_AI_EMBED_DIMENSIONS'))):
-                embeddings_path = os.path.join(
-                    os.path.dirname(__file__), 'api', 'data', 'embeddings.csv')
-                assert embeddings_path, f'File {embeddings_path} not found.'
-                await search_mgr.upload_documents(embeddings_path)
-                await search_mgr.close()
+    # The application is preloaded, the modules, imported here, are shared by the workers.
+    from api.main import preload_modules
+    from api.metrics import clear_metrics
+    preload_modules()
+    clear_metrics(metrics_dir)
+    endpoint = os.environ.get('AZURE_AI_SEARCH_ENDPOINT')
+    # The local search backend does not need the index.
+    if endpoint and os.getenv('AZURE_AI_SEARCH_BACKEND', 'azure').lower() != 'local':
+        from api.index_bootstrap import index_state_file, start_bootstrap
+        start_bootstrap(index_state_file())
 
 
-def on_starting(server):
-    """Server hook, called just before the master process is initialized."""
-    asyncio.get_event_loop().run_until_complete(create_index_maybe())
+def post_worker_init(worker):
+    """Server hook, called after the worker has loaded the application."""
+    # ru_maxrss is in kilobytes on Linux.
+    worker.log.info(
+        "Worker %s started, peak RSS %.1f MB, uvicorn settings %s.",
+        worker.pid,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        getattr(worker, 'CONFIG_KWARGS', {}))
+
+
+def child_exit(server, worker):
+    """Server hook, called in the master after the worker has exited."""
+    # The requests, served by the worker, stay in the totals of /metrics.
+    from api.metrics import mark_process_dead
+    mark_process_dead(metrics_dir, worker.pid)
+
+
+def on_exit(server):
+    """Server hook, called just before the master process exits."""
+    if metrics_dir_is_temporary:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def get_workers(num_cpus: int) -> int:
+    """
+    Return the number of workers.
+
+    GUNICORN_WORKERS sets the number explicitly. Otherwise GUNICORN_SIZING selects
+    the heuristic: "async" (default) runs min(cores, 2) + 1 workers, at most 3 on any
+    machine. The application mostly waits for Azure services, so one event loop serves
+    many streams at once, while every extra worker holds its own copy of the application
+    in memory and takes a smaller share of the model quotas. "cpu" is the classic
+    (2 x cores) + 1 sizing of the synchronous workers.
+    """
+    if os.getenv('GUNICORN_WORKERS'):
+        return int(os.getenv('GUNICORN_WORKERS'))
+    if os.getenv('GUNICORN_SIZING', 'async').lower() == 'cpu':
+        return (num_cpus * 2) + 1
+    return min(num_cpus, 2) + 1
 
 
 max_requests = 1000
@@ -60,7 +83,16 @@ if not os.getenv("RUNNING_IN_PRODUCTION"):
 # https://docs.gunicorn.org/en/stable/settings.html
 preload_app = True
 num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
-worker_class = "uvicorn.workers.UvicornWorker"
+workers = get_workers(num_cpus)
+# The workers divide the model quotas between them.
+if not os.getenv('GUNICORN_WORKERS'):
+    os.environ['GUNICORN_WORKERS'] = str(workers)
+# The workers share their metrics through this directory.
+metrics_dir = os.getenv('METRICS_DIR')
+metrics_dir_is_temporary = not metrics_dir
+if metrics_dir_is_temporary:
+    metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='azureaiapp-metrics-')
+# UvicornWorker, configured by UVICORN_LOOP, UVICORN_HTTP and UVICORN_LIMIT_CONCURRENCY.
+worker_class = "api.uvicorn_worker.AppUvicornWorker"
 
 timeout = 120
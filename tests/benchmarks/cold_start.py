@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Measure the cold start of the application.
+
+Every run starts a new interpreter and measures:
+* import_seconds: the time to import api.main and api.routes;
+* first_request_seconds: the time from starting uvicorn with create_app() to the first
+  served request of /healthz/live.
+
+By default the lifespan is off, so the benchmark does not need Azure resources; use
+--lifespan to include the creation of the clients, configured by the environment.
+
+Usage:
+    python tests/benchmarks/cold_start.py --runs 5 --output cold_start.json --max-seconds 3
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src')
+
+
+def measure_import() -> float:
+    """Return the time to import the application in the new interpreter."""
+    code = (
+        "import time; started = time.perf_counter(); "
+        "import api.main, api.routes; print(time.perf_counter() - started)"
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', code], cwd=SRC_DIRECTORY, check=True, capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_request(lifespan: bool, timeout: float) -> float:
+    """Return the time from the start of uvicorn to the first served request."""
+    port = _free_port()
+    url = f'http://127.0.0.1:{port}/healthz/live'
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'api.main:create_app', '--factory',
+         '--port', str(port), '--lifespan', 'on' if lifespan else 'off', '--log-level', 'warning'],
+        cwd=SRC_DIRECTORY, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"The server has exited with the code {server.returncode}.")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.01)
+        raise TimeoutError(f"The server has not answered in {timeout} seconds.")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Return the statistics of the samples."""
+    return {
+        'median': statistics.median(samples),
+        'min': min(samples),
+        'max': max(samples),
+        'samples': samples,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the cold start of the application.')
+    parser.add_argument('--runs', type=int, default=5, help='The number of runs. Default: 5.')
+    parser.add_argument('--lifespan', action='store_true', help='Run the lifespan, it needs the Azure resources.')
+    parser.add_argument('--timeout', type=float, default=120, help='The time to wait for the server, seconds.')
+    parser.add_argument('--output', help='The JSON file to write the results to.')
+    parser.add_argument(
+        '--max-seconds', type=float,
+        help='Exit with the code 1 if the median time to the first request exceeds this value.')
+    args = parser.parse_args()
+
+    imports = [measure_import() for _ in range(args.runs)]
+    first_requests = [measure_first_request(args.lifespan, args.timeout) for _ in range(args.runs)]
+    results = {
+        'python': sys.version.split()[0],
+        'lifespan': args.lifespan,
+        'import_seconds': summarize(imports),
+        'first_request_seconds': summarize(first_requests),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.max_seconds is not None and results['first_request_seconds']['median'] > args.max_seconds:
+        print(f"The cold start exceeds {args.max_seconds} seconds.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
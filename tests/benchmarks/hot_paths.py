@@ -0,0 +1,323 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+"""
+Measure the hot paths of SearchIndexManager.
+
+The benchmarks run offline, on the corpus built from the bundled embeddings.csv,
+repeated 1, 10 and 100 times, with the mock Azure AI Search and embeddings clients:
+* upload_documents: reading the embeddings file and sending the documents in batches;
+* build_embeddings: splitting the markdown files into chunks and writing their
+  embeddings, as build_embeddings_file does. The sentences are split by nltk if its
+  punkt data set (punkt_tab for the newer nltk) is installed, otherwise by punctuation, so nothing is downloaded;
+* search: embedding the question and querying the mock index;
+* local_search: embedding the question and searching the corpus in process.
+
+Every benchmark is timed --runs times, then run once more under tracemalloc to measure
+the peak memory. The results can be saved and compared with the results of another commit.
+
+Usage:
+    python tests/benchmarks/hot_paths.py --output after.json --baseline before.json
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Coroutine
+from typing import Any, Callable, Optional
+from unittest.mock import patch
+
+SRC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'src')
+sys.path.insert(0, SRC_DIRECTORY)
+
+from api import chunking  # noqa: E402
+from api.embeddings_store import iter_embeddings_file  # noqa: E402
+from api.local_search import LocalSearchBackend  # noqa: E402
+from api.search_index_manager import SearchIndexManager  # noqa: E402
+from api.util import ChatRequest, Message  # noqa: E402
+
+BUNDLED_EMBEDDINGS_FILE = os.path.join(SRC_DIRECTORY, 'api', 'data', 'embeddings.csv')
+BENCHMARKS = ('upload_documents', 'build_embeddings', 'search', 'local_search')
+
+
+class MockIndexingResult:
+
+    succeeded = True
+
+
+class MockSearchResults:
+
+    def __init__(self, results: list[dict[str, Any]]) -> None:
+        self._results = results
+
+    async def __aiter__(self):
+        for result in self._results:
+            yield result
+
+
+class MockSearchClient:
+    """The search client, answering without the network."""
+
+    def __init__(self, tokens: list[str]) -> None:
+        self._results = [{'token': token} for token in tokens[:SearchIndexManager.K_NEAREST_NEIGHBORS]]
+
+    async def search(self, **kwargs: Any) -> MockSearchResults:
+        return MockSearchResults(self._results)
+
+    async def upload_documents(self, documents: list[dict[str, Any]]) -> list[MockIndexingResult]:
+        return [MockIndexingResult()] * len(documents)
+
+    merge_or_upload_documents = delete_documents = upload_documents
+
+    async def close(self) -> None:
+        pass
+
+
+class MockEmbeddingsClient:
+    """The embeddings client, returning the vectors of the bundled corpus in turn."""
+
+    def __init__(self, vectors: list[list[float]]) -> None:
+        self._vectors = vectors
+        self._calls = 0
+
+    async def embed(self, input: Any, **kwargs: Any) -> dict[str, Any]:
+        texts = [input] if isinstance(input, str) else input
+        data = []
+        for index in range(len(texts)):
+            data.append({'index': index, 'embedding': self._vectors[(self._calls + index) % len(self._vectors)]})
+        self._calls += len(texts)
+        return {'data': data}
+
+
+def get_sent_tokenize() -> Callable[[str], list[str]]:
+    """Return nltk.sent_tokenize if its data set is installed, otherwise the punctuation based splitter."""
+    try:
+        import nltk
+        nltk.data.find(f'tokenizers/{chunking.punkt_resource()}')
+        return nltk.sent_tokenize
+    except (ImportError, LookupError):
+        return lambda text: re.split(r'(?<=[.!?])\s+', text)
+
+
+class Corpus:
+    """
+    The bundled corpus, repeated the given number of times.
+
+    :param directory: The directory to write the corpus files to.
+    :param scale: The number of copies of the bundled corpus.
+    """
+
+    def __init__(self, directory: str, scale: int) -> None:
+        """Constructor."""
+        rows = list(iter_embeddings_file(BUNDLED_EMBEDDINGS_FILE))
+        self.vectors = [embedding for _, embedding in rows]
+        self.tokens = []
+        self.embeddings_file = os.path.join(directory, f'embeddings-{scale}.csv')
+        self.markdown_directory = os.path.join(directory, f'markdown-{scale}')
+        os.makedirs(self.markdown_directory)
+        with open(self.embeddings_file, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+            writer.writeheader()
+            for copy in range(scale):
+                # The copies must differ, the duplicate documents are not uploaded.
+                tokens = [f'{token} (copy {copy})' for token, _ in rows]
+                self.tokens.extend(tokens)
+                for token, vector in zip(tokens, self.vectors):
+                    writer.writerow({'token': token, 'embedding': json.dumps(vector)})
+                with open(os.path.join(self.markdown_directory, f'products-{copy}.md'), 'w') as md:
+                    md.write('\n\n'.join(tokens))
+        self.documents = len(self.tokens)
+
+
+def create_search_index_manager(
+        corpus: Corpus, local_search_backend: Optional[LocalSearchBackend] = None) -> SearchIndexManager:
+    """Return the search index manager, which uses the mock clients."""
+    search_index_manager = SearchIndexManager(
+        endpoint='https://mock.search.windows.net',
+        credential=None,
+        index_name='benchmark',
+        dimensions=len(corpus.vectors[0]),
+        model='mock-embedding-model',
+        embeddings_client=MockEmbeddingsClient(corpus.vectors),
+        local_search_backend=local_search_backend)
+    search_index_manager.attach_index()
+    return search_index_manager
+
+
+async def run_upload_documents(corpus: Corpus, directory: str) -> int:
+    search_index_manager = create_search_index_manager(corpus)
+    await search_index_manager.upload_documents(corpus.embeddings_file)
+    await search_index_manager.close()
+    return corpus.documents
+
+
+async def run_build_embeddings(corpus: Corpus, directory: str) -> int:
+    search_index_manager = create_search_index_manager(corpus)
+    sent_tokenize = get_sent_tokenize()
+    count = 0
+
+    def iter_chunks():
+        nonlocal count
+        for file_name in sorted(os.listdir(corpus.markdown_directory)):
+            for chunk in chunking.iter_chunks(
+                    chunking.iter_sentences(os.path.join(corpus.markdown_directory, file_name), sent_tokenize),
+                    max_tokens=chunking.EMBEDDING_MAX_TOKENS,
+                    max_sentences=4):
+                count += 1
+                yield chunk
+
+    await search_index_manager.embed_chunks(
+        iter_chunks(), os.path.join(directory, 'built-embeddings.csv'), resume=False, incremental=False)
+    await search_index_manager.close()
+    return count
+
+
+async def _run_searches(search_index_manager: SearchIndexManager, queries: int) -> int:
+    for number in range(queries):
+        await search_index_manager.search(ChatRequest(messages=[Message(content=f'Question {number}')]))
+    await search_index_manager.close()
+    return queries
+
+
+async def run_search(corpus: Corpus, directory: str, queries: int) -> int:
+    return await _run_searches(create_search_index_manager(corpus), queries)
+
+
+async def run_local_search(
+        corpus: Corpus, directory: str, queries: int, local_search_backend: LocalSearchBackend) -> int:
+    return await _run_searches(create_search_index_manager(corpus, local_search_backend), queries)
+
+
+def measure(
+        benchmark: Callable[[], Coroutine[Any, Any, int]],
+        runs: int) -> dict[str, Any]:
+    """
+    Time the benchmark and measure its peak memory.
+
+    :param benchmark: The function returning the coroutine, which returns the number of processed items.
+    :param runs: The number of timed runs.
+    :return: The statistics of the runs.
+    """
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        items = asyncio.run(benchmark())
+        samples.append(time.perf_counter() - started)
+    # tracemalloc slows the code down, so the memory is measured in the separate run.
+    tracemalloc.start()
+    try:
+        asyncio.run(benchmark())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    median = statistics.median(samples)
+    return {
+        'items': items,
+        'median_seconds': median,
+        'min_seconds': min(samples),
+        'items_per_second': items / median if median else None,
+        'peak_memory_mb': peak / 2 ** 20,
+        'samples': samples,
+    }
+
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], max_regression: float) -> list[str]:
+    """
+    Compare the median times with the baseline.
+
+    :param results: The results of this run.
+    :param baseline: The results of the other commit.
+    :param max_regression: The allowed slowdown, 0.2 for 20%.
+    :return: The descriptions of the regressions.
+    """
+    regressions = []
+    for name, scales in results['benchmarks'].items():
+        for scale, result in scales.items():
+            before = baseline.get('benchmarks', {}).get(name, {}).get(scale)
+            if before is None:
+                continue
+            change = result['median_seconds'] / before['median_seconds'] - 1
+            memory_change = result['peak_memory_mb'] - before['peak_memory_mb']
+            print(f"{name} x{scale}: {before['median_seconds']:.3f} s -> {result['median_seconds']:.3f} s "
+                  f"({change:+.0%}), peak memory {memory_change:+.1f} MB")
+            if change > max_regression:
+                regressions.append(f"{name} x{scale} is {change:.0%} slower")
+    return regressions
+
+
+def get_commit() -> Optional[str]:
+    """Return the current git commit, if the benchmark is run from the repository."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=SRC_DIRECTORY, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the hot paths of SearchIndexManager.')
+    parser.add_argument(
+        '--scales', default='1,10,100', help='The comma separated numbers of corpus copies. Default: 1,10,100.')
+    parser.add_argument(
+        '--benchmarks', default=','.join(BENCHMARKS), help='The comma separated benchmarks. Default: all.')
+    parser.add_argument('--runs', type=int, default=3, help='The number of timed runs. Default: 3.')
+    parser.add_argument('--queries', type=int, default=200, help='The number of questions searched. Default: 200.')
+    parser.add_argument('--output', help='The JSON file to write the results to.')
+    parser.add_argument('--baseline', help='The JSON file with the results of another commit to compare with.')
+    parser.add_argument(
+        '--max-regression', type=float, default=0.2,
+        help='Exit with the code 1 if any median time exceeds the baseline by this share. Default: 0.2.')
+    args = parser.parse_args()
+    # The progress of every batch is logged, it is not needed here.
+    logging.getLogger('azureaiapp_search').setLevel(logging.WARNING)
+
+    benchmarks = {
+        'upload_documents': run_upload_documents,
+        'build_embeddings': run_build_embeddings,
+        'search': lambda corpus, directory: run_search(corpus, directory, args.queries),
+        'local_search': lambda corpus, directory: run_local_search(
+            corpus, directory, args.queries, local_search_backend),
+    }
+    names = args.benchmarks.split(',')
+    results = {
+        'python': sys.version.split()[0],
+        'commit': get_commit(),
+        'runs': args.runs,
+        'queries': args.queries,
+        'benchmarks': {name: {} for name in names},
+    }
+    for scale in (int(scale) for scale in args.scales.split(',')):
+        with tempfile.TemporaryDirectory() as directory:
+            corpus = Corpus(directory, scale)
+            # Loading the embeddings is the start of the worker, not the search.
+            local_search_backend = LocalSearchBackend.from_embeddings_file(corpus.embeddings_file)
+            # The mock search client is used by every SearchIndexManager.
+            with patch('api.search_index_manager.SearchClient', return_value=MockSearchClient(corpus.tokens)):
+                for name in names:
+                    result = measure(lambda: benchmarks[name](corpus, directory), args.runs)
+                    results['benchmarks'][name][str(scale)] = result
+                    print(f"{name} x{scale}: {result['median_seconds']:.3f} s, {result['items']} items, "
+                          f"peak memory {result['peak_memory_mb']:.1f} MB", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = compare(results, json.load(fp), args.max_regression)
+        if regressions:
+            print('\n'.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
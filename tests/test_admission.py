@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+    """Tests for the admission control."""
+
+    async def test_queue(self):
+        """Test that the requests wait for a slot in the order of arrival."""
+        controller = AdmissionController(max_concurrency=1, max_queue=2)
+        first = await controller.acquire()
+        second = asyncio.ensure_future(controller.acquire())
+        third = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        self.assertEqual(controller.queue_depth, 2)
+        with self.assertRaises(AdmissionRejected) as context:
+            await controller.acquire()
+        self.assertEqual(context.exception.reason, 'queue_full')
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+
+        first.release()
+        first.release()
+        ticket = await second
+        self.assertFalse(third.done())
+        self.assertEqual(controller.active, 1)
+        ticket.release()
+        (await third).release()
+        stats = controller.stats()
+        self.assertEqual(stats['active'], 0)
+        self.assertEqual(stats['admitted'], 3)
+        self.assertEqual(stats['rejected'], 1)
+        self.assertGreater(stats['max_wait_seconds'], 0)
+
+    async def test_queue_timeout(self):
+        """Test that the request is rejected after waiting for too long and the slot is not lost."""
+        controller = AdmissionController(max_concurrency=1, max_queue=1, max_queue_time=0.01)
+        ticket = await controller.acquire()
+        with self.assertRaises(AdmissionRejected) as context:
+            await controller.acquire()
+        self.assertEqual(context.exception.reason, 'queue_timeout')
+        self.assertEqual(controller.queue_depth, 0)
+        ticket.release()
+        (await controller.acquire()).release()
+        self.assertEqual(controller.active, 0)
+
+    async def test_cancelled_waiter(self):
+        """Test that the cancelled request leaves the queue."""
+        controller = AdmissionController(max_concurrency=1, max_queue=2)
+        ticket = await controller.acquire()
+        waiter = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiter
+        self.assertEqual(controller.queue_depth, 0)
+        ticket.release()
+        self.assertEqual(controller.active, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from cache import SemanticCache, normalize_text
+from lru_cache import LRUCache
+
+
+class MockTimer:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    """Tests for the caches."""
+
+    def test_eviction(self):
+        """Test that the least recently used entry is evicted."""
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertDictEqual(
+            cache.stats(),
+            {'size': 2, 'hits': 3, 'misses': 1, 'evictions': 1, 'expirations': 0})
+
+    def test_ttl(self):
+        """Test that the entries expire."""
+        timer = MockTimer()
+        cache = LRUCache(max_size=2, ttl=10, timer=timer)
+        cache.put('a', 1)
+        timer.now = 9.9
+        self.assertEqual(cache.get('a'), 1)
+        timer.now = 10
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_wrong_size(self):
+        """Test that the cache can not be created with non positive size."""
+        with self.assertRaisesRegex(ValueError, "The cache size must be positive."):
+            LRUCache(max_size=0)
+
+    def test_normalize_text(self):
+        """Test the normalization of cache keys."""
+        self.assertEqual(normalize_text("  What tents\n do you   SELL "), "what tents do you sell")
+
+
+class TestSemanticCache(unittest.TestCase):
+    """Tests for the cache of similar vectors."""
+
+    def test_similarity(self):
+        """Test that the value is returned for the similar vectors only."""
+        cache = SemanticCache(max_size=2, dimensions=2, similarity_threshold=0.99)
+        cache.put([1, 0], 'east')
+        self.assertEqual(cache.get([10, 0.1]), 'east')
+        self.assertIsNone(cache.get([1, 1]))
+        self.assertIsNone(cache.get([0, 0]))
+        self.assertIsNone(cache.get([1, 0, 0]))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 3)
+
+    def test_eviction_and_ttl(self):
+        """Test that the least recently used and the expired entries are replaced."""
+        timer = MockTimer()
+        cache = SemanticCache(max_size=2, dimensions=2, ttl=10, timer=timer)
+        cache.put([1, 0], 'east')
+        timer.now = 1
+        cache.put([0, 1], 'north')
+        timer.now = 2
+        self.assertEqual(cache.get([1, 0]), 'east')
+        cache.put([-1, 0], 'west')
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get([0, 1]))
+        self.assertEqual(cache.get([-1, 0]), 'west')
+        timer.now = 11
+        self.assertIsNone(cache.get([1, 0]))
+        cache.put([0, -1], 'south')
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.get([0, -1]), 'south')
+        self.assertEqual(cache.get([-1, 0]), 'west')
+
+    def test_invalidate(self):
+        """Test that nothing is found after the invalidation."""
+        cache = SemanticCache(max_size=2, dimensions=2)
+        cache.put([1, 0], 'east')
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get([1, 0]))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
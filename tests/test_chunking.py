@@ -0,0 +1,92 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+from chunking import estimate_tokens, iter_chunks, iter_sentences, punkt_resource
+from ddt import data, ddt
+from ingest import chunk_file, chunk_files
+
+
+def has_punkt():
+    """Return True if the nltk sentence tokenizer data is installed."""
+    try:
+        import nltk
+        nltk.data.find(f'tokenizers/{punkt_resource()}')
+        return True
+    except (ImportError, LookupError):
+        return False
+
+
+def count_words(text):
+    """Count every word as a token to make the tests readable."""
+    return len(text.split())
+
+
+@ddt
+class TestChunking(unittest.TestCase):
+    """Tests for the streaming chunker."""
+
+    SENTENCES = [f"Sentence {i} ." for i in range(7)]
+
+    def test_max_sentences(self):
+        """Test that the chunks have no more than max_sentences sentences."""
+        chunks = list(iter_chunks(TestChunking.SENTENCES, max_sentences=3, count_tokens=count_words))
+        self.assertListEqual(chunks, [
+            'Sentence 0 . Sentence 1 . Sentence 2 .',
+            'Sentence 3 . Sentence 4 . Sentence 5 .',
+            'Sentence 6 .'])
+
+    @data(0, 4, 8)
+    def test_max_tokens(self, overlap_tokens):
+        """Test that no chunk exceeds the token limit and that all sentences are used."""
+        chunks = list(iter_chunks(
+            TestChunking.SENTENCES, max_tokens=10, overlap_tokens=overlap_tokens, count_tokens=count_words))
+        for chunk in chunks:
+            self.assertLessEqual(count_words(chunk), 10)
+        for sentence in TestChunking.SENTENCES:
+            self.assertTrue(any(sentence in chunk for chunk in chunks))
+        if overlap_tokens:
+            self.assertTrue(chunks[1].startswith(chunks[0].split(' . ')[-1]))
+
+    def test_long_sentence(self):
+        """Test that the sentence longer than the limit is split."""
+        chunks = list(iter_chunks(['a ' * 25, 'b'], max_tokens=10, count_tokens=count_words))
+        self.assertListEqual([count_words(c) for c in chunks], [10, 10, 6])
+        chunks = list(iter_chunks(['x' * 100], max_tokens=10))
+        self.assertEqual(''.join(chunks), 'x' * 100)
+        for chunk in chunks:
+            self.assertLessEqual(estimate_tokens(chunk), 10)
+
+    def test_wrong_overlap(self):
+        """Test that overlap must be less than the chunk."""
+        with self.assertRaisesRegex(ValueError, "The overlap must be less.+"):
+            list(iter_chunks(TestChunking.SENTENCES, max_tokens=10, overlap_tokens=10))
+
+    def test_iter_sentences(self):
+        """Test that the non informative lines are skipped."""
+        with tempfile.TemporaryDirectory() as d:
+            file_name = os.path.join(d, 'input.md')
+            with open(file_name, 'w') as f:
+                f.write("# Title of the document\n\n-----\nFirst sentence. Second sentence.\nab\n")
+            sentences = list(iter_sentences(file_name, lambda line: line.split('. ')))
+        self.assertListEqual(sentences, ['# Title of the document', 'First sentence', 'Second sentence.'])
+
+    @unittest.skipUnless(has_punkt(), "Requires nltk with the punkt data set.")
+    def test_chunk_files_deterministic(self):
+        """Test that the parallel chunking gives the same result as the sequential one."""
+        with tempfile.TemporaryDirectory() as d:
+            files = []
+            for i in range(5):
+                files.append(os.path.join(d, f'input{i}.md'))
+                with open(files[-1], 'w') as f:
+                    f.write('\n'.join(f"File {i}, line {j}. Some more text." for j in range(20)))
+            chunks = list(chunk_files(files, processes=3, max_sentences=4))
+            self.assertListEqual(chunks, [c for f in files for c in chunk_file(f, max_sentences=4)])
+        self.assertTrue(chunks[0].startswith('File 0, line 0.'))
+
+
+if __name__ == "__main__":
+    unittest.main()
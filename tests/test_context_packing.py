@@ -0,0 +1,57 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+import numpy as np
+from context_packing import ContextPacker
+
+
+def count_words(text):
+    """Count every word as a token to make the tests readable."""
+    return len(text.split())
+
+
+class TestContextPacker(unittest.TestCase):
+    """Tests for the context selection."""
+
+    CHUNKS = ['tent one', 'tent one copy', 'tent two', 'stove', 'long description of the boots']
+    VECTORS = np.array([[1, 0.1, 0], [1, 0.1, 0], [1, 0.2, 0], [0.6, 0, 0.8], [0.5, 0, -0.8]], dtype=np.float32)
+
+    def test_duplicates_removed(self):
+        """Test that the near duplicates are not selected."""
+        packer = ContextPacker(token_budget=100, max_results=5, diversity=0, count_tokens=count_words)
+        result = packer.pack([1, 0, 0], TestContextPacker.CHUNKS, TestContextPacker.VECTORS)
+        self.assertNotIn('tent one copy', result.chunks)
+        self.assertEqual(result.duplicates, 2)
+        self.assertListEqual(result.chunks, ['tent one', 'stove', 'long description of the boots'])
+
+    def test_diversity(self):
+        """Test that MMR prefers the chunk, different from the selected ones."""
+        packer = ContextPacker(
+            token_budget=100, max_results=2, diversity=0.5, duplicate_similarity=1.0, count_tokens=count_words)
+        result = packer.pack([1, 0, 0], TestContextPacker.CHUNKS, TestContextPacker.VECTORS)
+        self.assertListEqual(result.chunks, ['tent one', 'stove'])
+        packer = ContextPacker(
+            token_budget=100, max_results=2, diversity=0, duplicate_similarity=1.0, count_tokens=count_words)
+        result = packer.pack([1, 0, 0], TestContextPacker.CHUNKS[::2], TestContextPacker.VECTORS[::2])
+        self.assertListEqual(result.chunks, ['tent one', 'tent two'])
+
+    def test_token_budget(self):
+        """Test that the context fits the budget and the saving is reported."""
+        packer = ContextPacker(token_budget=4, max_results=5, diversity=0, count_tokens=count_words)
+        result = packer.pack([0.5, 0, -0.8], TestContextPacker.CHUNKS, TestContextPacker.VECTORS)
+        self.assertListEqual(result.chunks, ['tent one', 'stove'])
+        self.assertEqual(result.tokens, 3)
+        self.assertEqual(result.tokens_saved, 13 - 3)
+        self.assertEqual(packer.total_tokens_saved, 10)
+
+    def test_without_vectors(self):
+        """Test that without embeddings the chunks are deduplicated by text and taken by rank."""
+        packer = ContextPacker(token_budget=100, max_results=2, count_tokens=count_words)
+        result = packer.pack([1, 0, 0], ['b', 'B ', 'a', 'c'])
+        self.assertListEqual(result.chunks, ['b', 'a'])
+
+
+if __name__ == "__main__":
+    unittest.main()
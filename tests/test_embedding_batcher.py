@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from embedding_batcher import EmbeddingBatcher
+
+
+class MockEmbedder:
+    """The embedding function, which records the batches."""
+
+    def __init__(self, error=None):
+        self.batches = []
+        self.error = error
+
+    async def __call__(self, texts):
+        self.batches.append(texts)
+        await asyncio.sleep(0.01)
+        if self.error is not None:
+            raise self.error
+        return [[float(len(text))] for text in texts]
+
+
+class TestEmbeddingBatcher(unittest.IsolatedAsyncioTestCase):
+    """Tests for the coalescing of embedding requests."""
+
+    async def test_batching(self):
+        """Test that concurrent requests are sent in one batch and get their own embeddings."""
+        embedder = MockEmbedder()
+        batcher = EmbeddingBatcher(embedder, max_batch_size=10, max_delay=0.01)
+        results = await asyncio.gather(*[batcher.embed(text) for text in ['a', 'bb', 'a', 'ccc']])
+        self.assertListEqual(results, [[1.0], [2.0], [1.0], [3.0]])
+        self.assertListEqual(embedder.batches, [['a', 'bb', 'ccc']])
+        self.assertEqual(batcher.stats()['mean_batch_size'], 4)
+
+    async def test_max_batch_size(self):
+        """Test that the full batch is sent without waiting."""
+        embedder = MockEmbedder()
+        batcher = EmbeddingBatcher(embedder, max_batch_size=2, max_delay=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(*[batcher.embed(text) for text in ['a', 'bb', 'ccc', 'dddd']]), 1)
+        self.assertListEqual(results, [[1.0], [2.0], [3.0], [4.0]])
+        self.assertListEqual(embedder.batches, [['a', 'bb'], ['ccc', 'dddd']])
+
+    async def test_error(self):
+        """Test that the error is propagated to every caller in the batch."""
+        batcher = EmbeddingBatcher(MockEmbedder(error=RuntimeError("throttled")), max_delay=0.01)
+        results = await asyncio.gather(batcher.embed('a'), batcher.embed('b'), return_exceptions=True)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+    async def test_cancellation(self):
+        """Test that the cancelled caller does not affect the others."""
+        embedder = MockEmbedder()
+        batcher = EmbeddingBatcher(embedder, max_delay=0.01)
+        cancelled = asyncio.ensure_future(batcher.embed('a'))
+        other = asyncio.ensure_future(batcher.embed('bb'))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        self.assertListEqual(await other, [2.0])
+        self.assertListEqual(embedder.batches, [['bb']])
+        await batcher.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from embeddings_store import EmbeddingsStore, convert_csv_to_binary, default_embeddings_file, iter_embeddings_file
+
+
+class TestEmbeddingsStore(unittest.TestCase):
+    """Tests for the binary embeddings store."""
+
+    ROWS = [
+        ('The first token', [0.5, -1.0, 2.0]),
+        ('Второй токен, not ASCII', [1.0, 0.0, 0.25]),
+        ('', [0.0, 0.0, 0.0]),
+    ]
+
+    def _write_csv(self, directory):
+        """Write the rows to the csv embeddings file."""
+        csv_file = os.path.join(directory, 'embeddings.csv')
+        with open(csv_file, 'w', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['token', 'embedding'])
+            writer.writeheader()
+            for token, embedding in TestEmbeddingsStore.ROWS:
+                writer.writerow({'token': token, 'embedding': json.dumps(embedding)})
+        return csv_file
+
+    def test_convert_and_open(self):
+        """Test that the converted store has the same contents as csv file."""
+        with tempfile.TemporaryDirectory() as d:
+            csv_file = self._write_csv(d)
+            npy_file = os.path.join(d, 'embeddings.npy')
+            convert_csv_to_binary(csv_file, npy_file)
+            for use_mmap in (True, False):
+                store = EmbeddingsStore.open(npy_file, use_mmap=use_mmap)
+                self.assertEqual(len(store), len(TestEmbeddingsStore.ROWS))
+                self.assertEqual(store.vectors.dtype, np.float32)
+                self.assertEqual(store.tokens[-1], TestEmbeddingsStore.ROWS[-1][0])
+                self.assertListEqual(store.tokens[:2], [r[0] for r in TestEmbeddingsStore.ROWS[:2]])
+                with self.assertRaises(IndexError):
+                    store.tokens[3]
+                del store
+            self.assertListEqual(
+                list(iter_embeddings_file(npy_file)),
+                list(iter_embeddings_file(csv_file)))
+
+    def test_open_is_memory_mapped(self):
+        """Test that the embeddings are not read into memory."""
+        with tempfile.TemporaryDirectory() as d:
+            npy_file = os.path.join(d, 'embeddings.npy')
+            convert_csv_to_binary(self._write_csv(d), npy_file)
+            store = EmbeddingsStore.open(npy_file)
+            self.assertIsInstance(store.vectors, np.memmap)
+            self.assertFalse(store.vectors.flags.writeable)
+            del store
+
+    def test_default_embeddings_file(self):
+        """Test that the binary file is not used after the csv file has changed."""
+        with tempfile.TemporaryDirectory() as d:
+            csv_file = self._write_csv(d)
+            self.assertEqual(default_embeddings_file(d), csv_file)
+            npy_file = os.path.join(d, 'embeddings.npy')
+            convert_csv_to_binary(csv_file, npy_file)
+            self.assertEqual(default_embeddings_file(d), npy_file)
+            mtime = os.path.getmtime(npy_file)
+            os.utime(csv_file, (mtime + 10, mtime + 10))
+            self.assertEqual(default_embeddings_file(d), csv_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
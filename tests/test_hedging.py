@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from hedging import DeadlineExceeded, HedgedCall
+
+
+class SlowService:
+    """The service, which answers with the given delays, one per call."""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.calls = 0
+        self.cancelled = 0
+
+    async def __call__(self):
+        delay = self.delays[self.calls]
+        self.calls += 1
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return delay
+
+
+class TestHedgedCall(unittest.IsolatedAsyncioTestCase):
+    """Tests for the hedging of slow calls."""
+
+    async def test_hedge_wins(self):
+        """Test that the slow call is repeated and the first result is used."""
+        hedging = HedgedCall(max_delay=0.01, max_hedge_ratio=1.0)
+        service = SlowService([1.0, 0.01])
+        self.assertEqual(await asyncio.wait_for(hedging.call(service), 0.5), 0.01)
+        self.assertEqual(service.calls, 2)
+        self.assertEqual(service.cancelled, 1)
+        self.assertEqual(hedging.hedge_wins, 1)
+
+    async def test_hedge_ratio(self):
+        """Test that the hedges are limited to the share of calls."""
+        hedging = HedgedCall(max_delay=0.01, max_hedge_ratio=0.5)
+        service = SlowService([0.02] * 10)
+        for _ in range(4):
+            await hedging.call(service)
+        self.assertEqual(hedging.hedges, 2)
+        self.assertEqual(service.calls, 6)
+
+    async def test_percentile_delay(self):
+        """Test that the hedge delay follows the recent latencies."""
+        hedging = HedgedCall(percentile=50, min_delay=0.001, max_delay=1.0, min_samples=3)
+        self.assertEqual(hedging.hedge_delay(), 1.0)
+        for _ in range(3):
+            await hedging.call(SlowService([0.01]))
+        self.assertLess(hedging.hedge_delay(), 0.1)
+
+    async def test_failed_attempt(self):
+        """Test that the result of the hedge is used if the first attempt fails."""
+        attempts = []
+
+        async def flaky():
+            attempts.append(1)
+            if len(attempts) == 1:
+                await asyncio.sleep(0.02)
+                raise ConnectionError()
+            return 'results'
+
+        hedging = HedgedCall(max_delay=0.01, max_hedge_ratio=1.0)
+        self.assertEqual(await hedging.call(flaky), 'results')
+
+    async def test_deadline(self):
+        """Test that the call is cancelled after the deadline."""
+        hedging = HedgedCall(max_delay=0.01, max_hedge_ratio=1.0, deadline=0.05)
+        service = SlowService([1.0, 1.0])
+        with self.assertRaises(DeadlineExceeded):
+            await hedging.call(service)
+        self.assertEqual(service.cancelled, 2)
+        self.assertEqual(hedging.deadlines_exceeded, 1)
+
+    async def test_timeout_is_not_deadline(self):
+        """Test that the timeout of the call itself is not reported as the exceeded deadline."""
+        async def timeout():
+            raise asyncio.TimeoutError()
+
+        hedging = HedgedCall(deadline=1.0)
+        with self.assertRaises(asyncio.TimeoutError) as raised:
+            await hedging.call(timeout)
+        self.assertNotIsInstance(raised.exception, DeadlineExceeded)
+        self.assertEqual(hedging.deadlines_exceeded, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from aiohttp import web
+from azure.core.rest import HttpRequest
+from http_pool import HttpConnectionPool
+
+
+async def handle(request):
+    return web.Response(text='ok')
+
+
+class TestHttpConnectionPool(unittest.IsolatedAsyncioTestCase):
+    """Tests for the shared connection pool."""
+
+    async def asyncSetUp(self):
+        app = web.Application()
+        app.router.add_get('/', handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}/'
+
+    async def asyncTearDown(self):
+        await self.runner.cleanup()
+
+    async def test_connections_reused(self):
+        """Test that the transports share connections and closing them does not close the pool."""
+        pool = HttpConnectionPool(limit=10)
+        for _ in range(3):
+            async with pool.transport() as transport:
+                response = await transport.send(HttpRequest('GET', self.url))
+                await response.read()
+                self.assertEqual(response.status_code, 200)
+        stats = pool.stats()
+        self.assertEqual(stats['transports'], 3)
+        self.assertEqual(stats['acquired'], 0)
+        self.assertEqual(stats['idle'], 1)
+        await pool.close()
+        self.assertEqual(pool.stats()['idle'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
+
+from index_bootstrap import (
+    STATUS_CREATING,
+    STATUS_FAILED,
+    STATUS_READY,
+    create_index_maybe,
+    is_bootstrap_alive,
+    read_index_state,
+    wait_for_index,
+    write_index_state,
+)
+
+
+class TestWaitForIndex(unittest.IsolatedAsyncioTestCase):
+    """Tests for the index state, shared with the workers."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.state_file = os.path.join(self.directory.name, 'index.json')
+        self.search_index_manager = Mock()
+        self.search_index_manager.ensure_index_created = AsyncMock()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    async def test_ready_after_bootstrap(self):
+        """Test that the worker uses the index, created by the master, without querying it."""
+        write_index_state(self.state_file, STATUS_CREATING, index_name='index')
+        task = asyncio.ensure_future(wait_for_index(self.search_index_manager, self.state_file, poll_interval=0.01))
+        await asyncio.sleep(0.05)
+        self.assertFalse(task.done())
+        write_index_state(self.state_file, STATUS_READY, index_name='index')
+        await asyncio.wait_for(task, 1)
+        self.search_index_manager.attach_index.assert_called_once()
+        self.search_index_manager.ensure_index_created.assert_not_called()
+
+    async def test_no_bootstrap(self):
+        """Test that the worker gets the index itself if the master has not started the bootstrap."""
+        await wait_for_index(self.search_index_manager, self.state_file, vector_index_dimensions=100)
+        self.search_index_manager.ensure_index_created.assert_awaited_once_with(vector_index_dimensions=100)
+        self.search_index_manager.attach_index.assert_not_called()
+
+    async def test_bootstrap_failed(self):
+        """Test that the worker retries to get the index if the bootstrap has failed."""
+        write_index_state(self.state_file, STATUS_FAILED, index_name='index', error='Forbidden')
+        self.search_index_manager.ensure_index_created.side_effect = [ValueError('Unavailable'), None]
+        await wait_for_index(self.search_index_manager, self.state_file, poll_interval=0.01)
+        self.assertEqual(self.search_index_manager.ensure_index_created.await_count, 2)
+
+    async def test_bootstrap_dead(self):
+        """Test that the worker gets the index itself if the bootstrap has stopped updating the state."""
+        write_index_state(self.state_file, STATUS_CREATING, index_name='index')
+        state = read_index_state(self.state_file)
+        self.assertTrue(is_bootstrap_alive(state))
+        self.assertFalse(is_bootstrap_alive({**state, 'heartbeat': time.time() - 120}))
+        self.assertFalse(is_bootstrap_alive({'status': STATUS_CREATING}))
+        await asyncio.wait_for(
+            wait_for_index(self.search_index_manager, self.state_file, poll_interval=0.01, stale_after=0.05), 1)
+        self.search_index_manager.ensure_index_created.assert_awaited_once()
+        self.search_index_manager.attach_index.assert_not_called()
+
+    async def test_deadline(self):
+        """Test that the worker stops waiting for the bootstrap after the deadline."""
+        write_index_state(self.state_file, STATUS_CREATING, index_name='index', pid=os.getpid())
+        await asyncio.wait_for(
+            wait_for_index(self.search_index_manager, self.state_file, poll_interval=0.01, deadline=0.05), 1)
+        self.search_index_manager.ensure_index_created.assert_awaited_once()
+
+    async def test_create_index_error(self):
+        """Test that the bootstrap reports the failure if the index was neither created nor found."""
+        manager = AsyncMock()
+        manager.create_index.return_value = False
+        environ = {
+            'AZURE_AI_SEARCH_ENDPOINT': 'https://mock.search.windows.net',
+            'AZURE_AI_SEARCH_INDEX_NAME': 'index',
+            'AZURE_AI_EMBED_DIMENSIONS': '100',
+        }
+        with patch.dict(os.environ, environ), \
+                patch('azure.identity.aio.DefaultAzureCredential', MagicMock()), \
+                patch('search_index_manager.SearchIndexManager') as manager_class:
+            manager_class.return_value = manager
+            manager_class.index_exists = AsyncMock(return_value=False)
+            await create_index_maybe(self.state_file)
+            self.assertEqual(read_index_state(self.state_file)['status'], STATUS_FAILED)
+            manager_class.index_exists.return_value = True
+            await create_index_maybe(self.state_file)
+            self.assertEqual(read_index_state(self.state_file)['status'], STATUS_READY)
+        manager.upload_documents.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
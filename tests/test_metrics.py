@@ -0,0 +1,83 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from metrics import Metrics, clear_metrics, mark_process_dead
+
+
+def parse(text):
+    """Return the samples of the Prometheus text format."""
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+    return samples
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for the metrics of the chat."""
+
+    def test_render(self):
+        """Test the histograms, counters and component statistics."""
+        metrics = Metrics(pid=1)
+        metrics.search_seconds.observe(0.02)
+        metrics.search_seconds.observe(0.3)
+        metrics.search_seconds.observe(100)
+        metrics.errors.inc('TimeoutError')
+        metrics.streams_in_flight.inc()
+        metrics.add_collector('cache', lambda: {'hits': 3, 'name': 'skipped'})
+        samples = parse(metrics.render())
+        self.assertEqual(samples['azureaiapp_search_seconds_bucket{le="0.01"}'], 0)
+        self.assertEqual(samples['azureaiapp_search_seconds_bucket{le="0.025"}'], 1)
+        self.assertEqual(samples['azureaiapp_search_seconds_bucket{le="30.0"}'], 2)
+        self.assertEqual(samples['azureaiapp_search_seconds_bucket{le="+Inf"}'], 3)
+        self.assertEqual(samples['azureaiapp_search_seconds_count'], 3)
+        self.assertAlmostEqual(samples['azureaiapp_search_seconds_sum'], 100.32)
+        self.assertEqual(samples['azureaiapp_chat_errors_total{type="TimeoutError"}'], 1)
+        self.assertEqual(samples['azureaiapp_chat_streams_in_flight'], 1)
+        self.assertEqual(samples['azureaiapp_cache_hits{pid="1"}'], 3)
+        self.assertNotIn('azureaiapp_cache_name{pid="1"}', samples)
+
+    def test_workers(self):
+        """Test that the metrics of all workers are added up and kept after the worker exits."""
+        with tempfile.TemporaryDirectory() as directory:
+            clear_metrics(directory)
+            first = Metrics(directory, pid=1)
+            second = Metrics(directory, pid=2)
+            for metrics in (first, second):
+                metrics.embed_seconds.observe(0.1)
+                metrics.errors.inc('content_filter')
+                metrics.streams_in_flight.inc()
+            second.write()
+            samples = parse(first.render())
+            self.assertEqual(samples['azureaiapp_embed_seconds_count'], 2)
+            self.assertEqual(samples['azureaiapp_chat_errors_total{type="content_filter"}'], 2)
+            self.assertEqual(samples['azureaiapp_chat_streams_in_flight'], 2)
+
+            mark_process_dead(directory, 2)
+            self.assertFalse(os.path.exists(os.path.join(directory, 'metrics-2.json')))
+            samples = parse(first.render())
+            self.assertEqual(samples['azureaiapp_embed_seconds_count'], 2)
+            self.assertEqual(samples['azureaiapp_chat_errors_total{type="content_filter"}'], 2)
+            self.assertEqual(samples['azureaiapp_chat_streams_in_flight'], 1)
+
+    def test_worker_exited(self):
+        """Test that the snapshot, removed while the metrics are rendered, is skipped."""
+        with tempfile.TemporaryDirectory() as directory:
+            clear_metrics(directory)
+            metrics = Metrics(directory, pid=1)
+            metrics.embed_seconds.observe(0.1)
+            removed = os.path.join(directory, 'metrics-2.json')
+            # The file is listed and then removed by the master.
+            with patch('glob.glob', return_value=[removed]), patch('os.path.isfile', return_value=True):
+                samples = parse(metrics.render())
+            self.assertEqual(samples['azureaiapp_embed_seconds_count'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+from unittest.mock import AsyncMock, Mock
+
+from rate_limit import RateLimitedClient, RateLimiter
+
+
+class MockClock:
+    """The timer and the sleep function, which advances the timer instead of sleeping."""
+
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+    """Tests for the client side rate limiter."""
+
+    async def test_token_bucket(self):
+        """Test that the requests are delayed when the tokens per minute are spent."""
+        clock = MockClock()
+        limiter = RateLimiter(tokens_per_minute=1200, workers=2, timer=clock, sleep=clock.sleep)
+        await limiter.acquire(400)
+        await limiter.acquire(200)
+        self.assertListEqual(clock.sleeps, [])
+        # The share of the worker is 600 tokens, refilled at 10 tokens per second.
+        await limiter.acquire(100)
+        self.assertListEqual(clock.sleeps, [10.0])
+        self.assertEqual(limiter.stats()['delayed'], 1)
+
+    async def test_requests_bucket(self):
+        """Test that the requests per minute are limited."""
+        clock = MockClock()
+        limiter = RateLimiter(requests_per_minute=60, timer=clock, sleep=clock.sleep)
+        for _ in range(61):
+            await limiter.acquire(1000)
+        self.assertListEqual(clock.sleeps, [1.0])
+
+    async def test_headers(self):
+        """Test that the limiter follows the remaining quota and retry-after of the service."""
+        clock = MockClock()
+        limiter = RateLimiter(tokens_per_minute=600, timer=clock, sleep=clock.sleep)
+        limiter.update(200, {'x-ratelimit-remaining-tokens': '100'})
+        await limiter.acquire(100)
+        self.assertListEqual(clock.sleeps, [])
+        limiter.update(429, {'retry-after-ms': '5000'})
+        await limiter.acquire(1)
+        self.assertListEqual(clock.sleeps, [5.0])
+        self.assertEqual(limiter.throttled, 1)
+
+    async def test_client(self):
+        """Test that the wrapper estimates the tokens and passes the responses to the limiter."""
+        limiter = RateLimiter(tokens_per_minute=600)
+        limiter.acquire = AsyncMock()
+        client = AsyncMock()
+        caller_hook = Mock()
+        wrapped = RateLimitedClient(client, limiter, completion_tokens=50, count_tokens=len)
+        await wrapped.complete(messages=[{'role': 'user', 'content': 'hello'}], raw_response_hook=caller_hook)
+        limiter.acquire.assert_awaited_with(55)
+        await wrapped.embed(input=['abc', 'de'])
+        limiter.acquire.assert_awaited_with(5)
+
+        hook = client.complete.call_args.kwargs['raw_response_hook']
+        hook(Mock(http_response=Mock(status_code=429, headers={'retry-after': '1'})))
+        self.assertEqual(limiter.throttled, 1)
+        caller_hook.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
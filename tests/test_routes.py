@@ -0,0 +1,152 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import json
+import unittest
+from unittest.mock import AsyncMock, Mock, patch
+
+import fastapi
+import routes
+from admission import AdmissionController
+from fastapi.testclient import TestClient
+from metrics import Metrics
+from sessions import LocalSessionStore
+
+
+class MockChatStream:
+
+    def __init__(self, contents, delays=None):
+        self._contents = contents
+        self._delays = delays or {}
+
+    async def __aiter__(self):
+        for i, content in enumerate(self._contents):
+            await asyncio.sleep(self._delays.get(i, 0))
+            yield Mock(choices=[Mock(delta=Mock(content=content, role='assistant'))])
+
+
+class TestRoutes(unittest.TestCase):
+    """Tests for the chat stream."""
+
+    def _get_client(
+            self, search_index_manager=None, contents=('Hello', ' world'), admission_controller=None,
+            session_store=None, delays=None):
+        """Return the test client of the application with mock chat client."""
+        app = fastapi.FastAPI()
+        app.state.admission_controller = admission_controller
+        app.state.session_store = session_store
+        app.include_router(routes.router)
+        app.state.chat = AsyncMock()
+        app.state.chat.complete.return_value = MockChatStream(list(contents), delays)
+        app.state.chat_model = 'mock_chat_model'
+        app.state.search_index_manager = search_index_manager
+        return TestClient(app)
+
+    def _post(self, client, **kwargs):
+        """Send the question and return the parsed lines of the response."""
+        response = client.post('/chat/stream', json={'messages': [{'content': 'test'}], **kwargs})
+        self.assertEqual(response.status_code, 200)
+        return [json.loads(line) for line in response.text.splitlines()]
+
+    def test_stream_without_rag(self):
+        """Test that the deltas are streamed after the status line."""
+        lines = self._post(self._get_client())
+        self.assertDictEqual(lines[0], {'status': 'generating'})
+        self.assertListEqual([line['delta']['content'] for line in lines[1:]], ['Hello', ' world'])
+
+    def test_stream_pause(self):
+        """Test that the collected deltas are sent when the model pauses, not with the next delta."""
+        client = self._get_client(contents=('Hello', ' wor', 'ld'), delays={2: 0.2})
+        with patch('routes.STREAM_FLUSH_INTERVAL', 0.05):
+            lines = self._post(client)
+        self.assertListEqual([line['delta']['content'] for line in lines[1:]], ['Hello', ' wor', 'ld'])
+
+    def test_stream_with_rag_heartbeat(self):
+        """Test that the status and heartbeats are sent while the context is being retrieved."""
+        search_index_manager = AsyncMock()
+
+        async def search(message):
+            await asyncio.sleep(0.05)
+            return 'a\n------\nb'
+
+        search_index_manager.search.side_effect = search
+        with patch('routes.HEARTBEAT_INTERVAL', 0.01):
+            lines = self._post(self._get_client(search_index_manager))
+        statuses = [line['status'] for line in lines if 'status' in line]
+        self.assertEqual(statuses[0], 'searching')
+        self.assertIn('heartbeat', statuses)
+        self.assertEqual(statuses[-2:], ['sources', 'generating'])
+        self.assertIn({'status': 'sources', 'count': 2}, lines)
+        self.assertListEqual(
+            [line['delta']['content'] for line in lines if 'delta' in line], ['Hello', ' world'])
+
+    def test_not_ready(self):
+        """Test that the chat works without the retrieval until the index is ready."""
+        search_index_manager = AsyncMock()
+        search_index_manager.is_ready = False
+        client = self._get_client(search_index_manager)
+        self.assertEqual(client.get('/healthz/live').status_code, 200)
+        response = client.get('/healthz/ready')
+        self.assertEqual(response.status_code, 503)
+        lines = self._post(client)
+        self.assertDictEqual(lines[0], {'status': 'generating'})
+        search_index_manager.search.assert_not_called()
+
+        search_index_manager.is_ready = True
+        response = client.get('/healthz/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(response.json(), {'status': 'ready', 'rag': True, 'admission': None})
+
+    def test_admission(self):
+        """Test that the request is rejected with 429 if the worker is busy and the slot is released."""
+        controller = AdmissionController(max_concurrency=1, max_queue=0)
+        client = self._get_client(admission_controller=controller)
+        lines = self._post(client)
+        self.assertListEqual([line['delta']['content'] for line in lines[1:]], ['Hello', ' world'])
+        self.assertEqual(controller.active, 0)
+        self.assertEqual(controller.admitted, 1)
+
+        controller.active = 1
+        response = client.post('/chat/stream', json={'messages': [{'content': 'test'}]})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(client.get('/healthz/ready').json()['admission']['rejected'], 1)
+
+    def test_session(self):
+        """Test that the server keeps the conversation and the client sends only the new message."""
+        store = LocalSessionStore(max_sessions=10)
+        client = self._get_client(session_store=store)
+        lines = self._post(client)
+        self.assertEqual(lines[0]['status'], 'session')
+        session_id = lines[0]['session_id']
+
+        client.app.state.chat.complete.return_value = MockChatStream(['Bye'])
+        lines = self._post(client, sessionState=session_id)
+        self.assertDictEqual(lines[0], {'status': 'session', 'session_id': session_id})
+        messages = client.app.state.chat.complete.call_args.kwargs['messages']
+        self.assertListEqual(
+            [message['content'] for message in messages[1:]], ['test', 'Hello world', 'test'])
+        history = asyncio.run(store.get(session_id))
+        self.assertEqual(len(history), 4)
+        self.assertDictEqual(history[-1], {'role': 'assistant', 'content': 'Bye'})
+
+        response = client.post('/chat/stream', json={'messages': [{'content': 'test'}], 'sessionState': 'unknown'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_metrics(self):
+        """Test that the stream is measured and the metrics are served."""
+        client = self._get_client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        client.app.state.metrics = Metrics()
+        self._post(client)
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('azureaiapp_chat_stream_seconds_count 1\n', response.text)
+        self.assertIn('azureaiapp_time_to_first_token_seconds_count 1\n', response.text)
+        self.assertIn('azureaiapp_deltas_per_second_count 1\n', response.text)
+        self.assertIn('azureaiapp_chat_streams_in_flight 0\n', response.text)
+
+
+if __name__ == "__main__":
+    unittest.main()
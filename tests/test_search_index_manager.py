@@ -1,19 +1,26 @@
 # Copyright (c) Microsoft. All rights reserved.
 # Licensed under the MIT license.
 # See LICENSE file in the project root for full license information.
+import asyncio
 import csv
 import json
 import os
+import tempfile
 import unittest
 from unittest.mock import AsyncMock, Mock, patch
-from azure.identity.aio import DefaultAzureCredential
 
-from util import ChatRequest, Message
-from search_index_manager import SearchIndexManager
+import numpy as np
 from azure.ai.projects.aio import AIProjectClient
-from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
-import tempfile
-from ddt import ddt, data
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.identity.aio import DefaultAzureCredential
+from cache import SemanticCache
+from ddt import data, ddt
+from embeddings_store import content_id
+from hedging import DeadlineExceeded
+from local_search import LocalSearchBackend
+from lru_cache import LRUCache
+from search_index_manager import SearchIndexManager
+from util import ChatRequest, Message
 
 
 class MockAsyncIterator:
@@ -36,6 +43,8 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
             os.path.dirname(
                 os.path.dirname(os.path.dirname(__file__)))), 'data_')
     EMBEDDINGS_FILE = os.path.join(INPUT_DIR, 'embeddings.csv')
+    BUNDLED_EMBEDDINGS_FILE = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'src', 'api', 'data', 'embeddings.csv')
 
     @classmethod
     def setUpClass(cls) -> None:
@@ -177,6 +186,247 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                 mock_serch_client.search.assert_called_once()
                 self.assertEqual(search_result, "a\n------\nb")
 
+    async def test_local_search_backend(self):
+        """Test that the local backend returns the cosine nearest tokens without the index."""
+        backend = LocalSearchBackend(
+            ['north', 'east', 'north-east', 'south'],
+            np.array([[0, 1], [1, 0], [1, 1], [0, -1]], dtype=np.float32))
+        self.assertEqual(backend.dimensions, 2)
+        self.assertListEqual(backend.search([0.1, 2.0], 2), ['north', 'north-east'])
+        self.assertListEqual(backend.search([1, 0], 10), ['east', 'north-east', 'north', 'south'])
+        with self.assertRaisesRegex(ValueError, "The query has 3 dimensions.+"):
+            backend.search([1, 0, 0], 2)
+
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [0, 2]}]
+        }
+        rag = SearchIndexManager(
+            endpoint=None,
+            credential=AsyncMock(),
+            index_name=None,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_search_backend=backend
+        )
+        with patch('search_index_manager.SearchClient') as mock_search_client:
+            search_result = await rag.search(ChatRequest(messages=[Message(content='test')]))
+            mock_search_client.assert_not_called()
+        self.assertEqual(search_result, "north\n------\nnorth-east\n------\neast\n------\nsouth")
+
+    def test_local_search_backend_from_file(self):
+        """Test loading of the bundled embeddings file."""
+        backend = LocalSearchBackend.from_embeddings_file(TestSearchIndexManager.BUNDLED_EMBEDDINGS_FILE)
+        with open(TestSearchIndexManager.BUNDLED_EMBEDDINGS_FILE, newline='') as fp:
+            rows = list(csv.DictReader(fp))
+        self.assertEqual(len(backend), len(rows))
+        self.assertEqual(backend.dimensions, len(json.loads(rows[0]['embedding'])))
+        self.assertEqual(backend.search(json.loads(rows[7]['embedding']), 1), [rows[7]['token']])
+
+    async def test_search_deadline(self):
+        """Test that only the exceeded deadline is answered without the context."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {'data': [{'embedding': [1, 0]}]}
+        rag = SearchIndexManager(
+            endpoint=None,
+            credential=AsyncMock(),
+            index_name=None,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_search_backend=LocalSearchBackend(['a'], np.array([[1, 0]], dtype=np.float32))
+        )
+        question = ChatRequest(messages=[Message(content='test')])
+        with patch.object(rag, '_search_vector', AsyncMock(side_effect=DeadlineExceeded())):
+            self.assertEqual(await rag.search(question), "")
+        with patch.object(rag, '_search_vector', AsyncMock(side_effect=asyncio.TimeoutError())):
+            with self.assertRaises(asyncio.TimeoutError):
+                await rag.search(question)
+
+    async def test_embedding_cache(self):
+        """Test that the repeated questions are not embedded twice."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'embedding': [1, 0]}]
+        }
+        backend = LocalSearchBackend(['a', 'b'], np.array([[1, 0], [0, 1]], dtype=np.float32))
+        cache = LRUCache(max_size=10)
+        rag = SearchIndexManager(
+            endpoint=None,
+            credential=AsyncMock(),
+            index_name=None,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_search_backend=backend,
+            embedding_cache=cache
+        )
+        await rag.search(ChatRequest(messages=[Message(content='What tents do you sell?')]))
+        await rag.search(ChatRequest(messages=[Message(content=' what tents  do you sell? ')]))
+        mock_embedding.embed.assert_called_once()
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        await rag.search(ChatRequest(messages=[Message(content='Do you sell backpacks?')]))
+        self.assertEqual(mock_embedding.embed.call_count, 2)
+
+    async def test_embedding_batching(self):
+        """Test that the concurrent questions are embedded in one request."""
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.return_value = {
+            'data': [{'index': 1, 'embedding': [0, 1]}, {'index': 0, 'embedding': [1, 0]}]
+        }
+        backend = LocalSearchBackend(['a', 'b'], np.array([[1, 0], [0, 1]], dtype=np.float32))
+        rag = SearchIndexManager(
+            endpoint=None,
+            credential=AsyncMock(),
+            index_name=None,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_search_backend=backend,
+            embedding_batch_size=10,
+            embedding_batch_delay=0.01
+        )
+        contexts = await asyncio.gather(
+            rag.search(ChatRequest(messages=[Message(content='What tents do you sell?')])),
+            rag.search(ChatRequest(messages=[Message(content='Do you sell backpacks?')])))
+        mock_embedding.embed.assert_called_once()
+        self.assertListEqual(
+            mock_embedding.embed.call_args.kwargs['input'], ['What tents do you sell?', 'Do you sell backpacks?'])
+        self.assertEqual(contexts[0].split("\n------\n")[0], 'a')
+        self.assertEqual(contexts[1].split("\n------\n")[0], 'b')
+        await rag.close()
+
+    async def test_identical_queries_collapsed(self):
+        """Test that the concurrent searches of the same question are done once."""
+        async def embed(**kwargs):
+            await asyncio.sleep(0.01)
+            return {'data': [{'embedding': [1, 0]}]}
+
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.side_effect = embed
+        backend = LocalSearchBackend(['a', 'b'], np.array([[1, 0], [0, 1]], dtype=np.float32))
+        rag = SearchIndexManager(
+            endpoint=None,
+            credential=AsyncMock(),
+            index_name=None,
+            dimensions=2,
+            model="mock_embedding_model",
+            embeddings_client=mock_embedding,
+            local_search_backend=backend
+        )
+        contexts = await asyncio.gather(*[
+            rag.search(ChatRequest(messages=[Message(content=question)]))
+            for question in ['What tents do you sell?', 'what tents do you sell? '] * 5])
+        mock_embedding.embed.assert_called_once()
+        self.assertEqual(len(set(contexts)), 1)
+        self.assertEqual(rag.single_flight.shared, 9)
+
+    async def test_retrieval_cache_mock(self):
+        """Test that the similar questions do not query the index and that the cache is invalidated."""
+        mock_ix_client = AsyncMock()
+        mock_aenter = AsyncMock()
+        mock_serch_client = AsyncMock()
+        mock_serch_client.search.side_effect = lambda **kwargs: MockAsyncIterator([{'token': 'a'}])
+        mock_embedding = AsyncMock()
+        mock_embedding.embed.side_effect = [
+            {'data': [{'embedding': [1, 0]}]},
+            {'data': [{'embedding': [1, 0.01]}]},
+            {'data': [{'embedding': [1, 0.01]}]},
+        ]
+        cache = SemanticCache(max_size=10, dimensions=2, similarity_threshold=0.99)
+        with patch(
+            'search_index_manager.SearchIndexClient',
+                return_value=mock_ix_client):
+            with patch(
+                'search_index_manager.SearchClient',
+                    return_value=mock_serch_client):
+                mock_ix_client.__aenter__.return_value = mock_aenter
+                rag = SearchIndexManager(
+                    endpoint=self.search_endpoint,
+                    credential=AsyncMock(),
+                    index_name=self.index_name,
+                    dimensions=2,
+                    model="mock_embedding_model",
+                    embeddings_client=mock_embedding,
+                    retrieval_cache=cache
+                )
+                await rag.ensure_index_created()
+                self.assertEqual(await rag.search(ChatRequest(messages=[Message(content='tents?')])), 'a')
+                self.assertEqual(await rag.search(ChatRequest(messages=[Message(content='tent?')])), 'a')
+                mock_serch_client.search.assert_called_once()
+                self.assertEqual(cache.hits, 1)
+
+                with tempfile.TemporaryDirectory() as d:
+                    embeddings_file = os.path.join(d, 'embeddings.csv')
+                    with open(embeddings_file, 'w') as fp:
+                        fp.write('token,embedding\nb,"[0, 1]"\n')
+                    await rag.upload_documents(embeddings_file)
+                self.assertEqual(len(cache), 0)
+                await rag.search(ChatRequest(messages=[Message(content='tent?')]))
+                self.assertEqual(mock_serch_client.search.call_count, 2)
+
+    def test_iter_batches(self):
+        """Test that the batches are bounded by the number of documents and their size."""
+        documents = [{'token': 'a' * size} for size in [10, 10, 10, 100, 10]]
+        batches = list(SearchIndexManager._iter_batches(documents, batch_size=2, max_batch_bytes=60))
+        self.assertListEqual([len(b) for b in batches], [2, 1, 1, 1])
+        self.assertIs(batches[2][0], documents[3])
+
+    async def test_upload_documents_batches_mock(self):
+        """Test that the documents are uploaded in batches and that the throttled batches are retried."""
+        mock_serch_client = AsyncMock()
+        throttled = HttpResponseError("Mock")
+        throttled.status_code = 429
+        throttled.response = Mock(headers={'Retry-After': '0'})
+        uploaded = []
+        throttled_batches = []
+
+        async def upload(batch):
+            if len(uploaded) == 1 and not throttled_batches:
+                throttled_batches.append(batch)
+                raise throttled
+            uploaded.append([d['embedId'] for d in batch])
+            return [Mock(succeeded=True) for _ in batch]
+
+        mock_serch_client.upload_documents.side_effect = upload
+        with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = Mock()
+            with tempfile.TemporaryDirectory() as d:
+                embeddings_file = os.path.join(d, 'embeddings.csv')
+                with open(embeddings_file, 'w') as fp:
+                    fp.write('token,embedding\n')
+                    for i in range(5):
+                        fp.write(f'token {i},"[{i}, 0]"\n')
+                results = await rag.upload_documents(embeddings_file, batch_size=2, max_concurrency=2)
+        self.assertListEqual([r.documents for r in results], [2, 2, 1])
+        self.assertListEqual([r.succeeded for r in results], [2, 2, 1])
+        self.assertEqual(sum(r.attempts for r in results), 4)
+        self.assertListEqual(sorted(sum(uploaded, [])), sorted(content_id(f'token {i}') for i in range(5)))
+
+    async def test_upload_documents_error_mock(self):
+        """Test that the errors, which are not throttling, are raised."""
+        mock_serch_client = AsyncMock()
+        mock_serch_client.upload_documents.side_effect = HttpResponseError("Mock")
+        with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = Mock()
+            with tempfile.TemporaryDirectory() as d:
+                embeddings_file = os.path.join(d, 'embeddings.csv')
+                with open(embeddings_file, 'w') as fp:
+                    fp.write('token,embedding\na,"[0, 1]"\n')
+                with self.assertRaisesRegex(HttpResponseError, "Mock"):
+                    await rag.upload_documents(embeddings_file)
+
+    def test_attach_index(self):
+        """Test that the search is ready after the index, created elsewhere, is attached."""
+        rag = self._get_mock_rag(AsyncMock())
+        self.assertFalse(rag.is_ready)
+        rag.attach_index()
+        self.assertTrue(rag.is_ready)
+
     async def test_is_empty_mock(self):
         """Test how we check if the index is empty."""
         mock_ix_client = AsyncMock()
@@ -300,6 +550,110 @@ class TestSearchIndexManager(unittest.IsolatedAsyncioTestCase):
                             index, index])
                     index += 1
 
+    async def test_write_embeddings_resume(self):
+        """Test that embeddings are written in order and the interrupted run is resumed."""
+        tokens = [f"token {i}" for i in range(7)]
+        calls = []
+        failures = []
+
+        async def embed(input, dimensions, model):
+            calls.append(list(input))
+            if input[0] == 'token 4' and not failures:
+                failures.append(input)
+                raise HttpResponseError("Mock")
+            # Let the later batches finish first and return the embeddings of the batch in reverse.
+            await asyncio.sleep(0.01 * (7 - int(input[0].split()[1])))
+            return {'data': [
+                {'index': i, 'embedding': [int(t.split()[1]), 0]} for i, t in reversed(list(enumerate(input)))]}
+
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            with self.assertRaisesRegex(HttpResponseError, "Mock"):
+                await rag._write_embeddings(tokens, out_file, batch_size=2, max_concurrency=2, resume=True)
+            self.assertTrue(os.path.isfile(out_file + '.checkpoint'))
+            calls.clear()
+            await rag._write_embeddings(tokens, out_file, batch_size=2, max_concurrency=2, resume=True)
+            self.assertListEqual(calls, [['token 4', 'token 5'], ['token 6']])
+            self.assertFalse(os.path.isfile(out_file + '.checkpoint'))
+            with open(out_file, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+            self.assertListEqual([row['token'] for row in rows], tokens)
+            for i, row in enumerate(rows):
+                self.assertListEqual(json.loads(row['embedding']), [i, 0])
+
+            # The checkpoint is not used if the input has changed.
+            with open(out_file + '.checkpoint', 'w') as fp:
+                json.dump({'batch_size': 2, 'batches': 1, 'bytes': 0, 'sha256': 'mock'}, fp)
+            with self.assertRaisesRegex(ValueError, "The input has changed since the checkpoint.+"):
+                await rag._write_embeddings(tokens, out_file, batch_size=2, max_concurrency=2, resume=True)
+
+    async def test_write_embeddings_reuse(self):
+        """Test that only the chunks without embeddings are embedded."""
+        embedding_client = AsyncMock()
+        embedding_client.embed.return_value = {'data': [{'index': 0, 'embedding': [2, 2]}]}
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            ids = await rag._write_embeddings(
+                ['old', 'new'], out_file, batch_size=10, max_concurrency=1, resume=False,
+                reused={content_id('old'): '[1, 1]'})
+            embedding_client.embed.assert_called_once_with(
+                input=['new'], dimensions=100, model='mock_embedding_model')
+            self.assertListEqual(ids, [content_id('old'), content_id('new')])
+            with open(out_file, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+            self.assertListEqual([json.loads(row['embedding']) for row in rows], [[1, 1], [2, 2]])
+
+    async def test_embed_chunks_incremental(self):
+        """Test that the embeddings of the previous build are read from it and not computed again."""
+        async def embed(input, dimensions, model):
+            return {'data': [{'index': i, 'embedding': [len(t), 0]} for i, t in enumerate(input)]}
+
+        embedding_client = AsyncMock()
+        embedding_client.embed.side_effect = embed
+        rag = self._get_mock_rag(embedding_client)
+        with tempfile.TemporaryDirectory() as d:
+            out_file = os.path.join(d, 'embeddings.csv')
+            await rag.embed_chunks(['a', 'b,\n"c"'], out_file, batch_size=10, max_concurrency=1, resume=False)
+            embedding_client.embed.reset_mock()
+            await rag.embed_chunks(['b,\n"c"', 'dd'], out_file, batch_size=10, max_concurrency=1, resume=False)
+            embedding_client.embed.assert_called_once_with(
+                input=['dd'], dimensions=100, model='mock_embedding_model')
+            self.assertFalse(os.path.isfile(out_file + '.previous'))
+            with open(out_file, newline='') as fp:
+                rows = list(csv.DictReader(fp))
+            self.assertListEqual([row['token'] for row in rows], ['b,\n"c"', 'dd'])
+            self.assertListEqual([json.loads(row['embedding']) for row in rows], [[6, 0], [2, 0]])
+
+    async def test_sync_documents_mock(self):
+        """Test that only the changed documents are sent to the index."""
+        mock_serch_client = AsyncMock()
+        with patch('search_index_manager.SearchClient', return_value=mock_serch_client):
+            rag = self._get_mock_rag(AsyncMock())
+            rag._index = Mock()
+            with tempfile.TemporaryDirectory() as d:
+                embeddings_file = os.path.join(d, 'embeddings.csv')
+                index_manifest = os.path.join(d, 'index.json')
+                with open(embeddings_file, 'w') as fp:
+                    fp.write('token,embedding\na,"[0, 1]"\nb,"[1, 0]"\nc,"[1, 1]"\n')
+                await rag.upload_documents(embeddings_file, index_manifest_file=index_manifest)
+                mock_serch_client.upload_documents.assert_called_once()
+                with open(embeddings_file, 'w') as fp:
+                    fp.write('token,embedding\nc,"[1, 1]"\nd,"[0, 0]"\nb,"[1, 0]"\n')
+                await rag.sync_documents(embeddings_file, index_manifest)
+                mock_serch_client.merge_or_upload_documents.assert_called_once_with(
+                    [{'embedId': content_id('d'), 'token': 'd', 'embedding': [0, 0]}])
+                mock_serch_client.delete_documents.assert_called_once_with([{'embedId': content_id('a')}])
+
+                # Nothing is sent if nothing has changed.
+                mock_serch_client.reset_mock()
+                await rag.sync_documents(embeddings_file, index_manifest)
+                mock_serch_client.merge_or_upload_documents.assert_not_called()
+                mock_serch_client.delete_documents.assert_not_called()
+
     @unittest.skip("Only for live tests.")
     async def test_build_embeddings_file(self):
         """Use this test to build the new embeddings file in the data directory."""
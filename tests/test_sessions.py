@@ -0,0 +1,84 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import os
+import tempfile
+import unittest
+
+from sessions import FileSessionStore, LocalSessionStore, trim_history
+
+
+class MockTimer:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class TestSessions(unittest.IsolatedAsyncioTestCase):
+    """Tests for the conversation sessions."""
+
+    def test_trim_history(self):
+        """Test that the oldest messages are dropped and the last one is kept."""
+        messages = [{'role': 'user', 'content': ' '.join(['word'] * n)} for n in (3, 2, 4)]
+        self.assertListEqual(trim_history(messages, 6, count_words), messages[1:])
+        self.assertListEqual(trim_history(messages, 9, count_words), messages)
+        self.assertListEqual(trim_history(messages, 1, count_words), messages[2:])
+        self.assertListEqual(trim_history(messages, 0, count_words), messages)
+
+    async def test_store(self):
+        """Test that the conversations are kept until they expire."""
+        timer = MockTimer()
+        store = LocalSessionStore(max_sessions=2, ttl=10, timer=timer)
+        history = [{'role': 'user', 'content': 'Hello'}]
+        await store.put('a', history)
+        saved = await store.get('a')
+        self.assertListEqual(saved, history)
+        saved.append({'role': 'assistant', 'content': 'Hi'})
+        self.assertEqual(len(await store.get('a')), 1)
+        await store.delete('a')
+        self.assertIsNone(await store.get('a'))
+
+        await store.put('b', history)
+        timer.now = 11
+        self.assertIsNone(await store.get('b'))
+        self.assertEqual(store.stats()['expirations'], 1)
+
+    async def test_file_store(self):
+        """Test that the workers share the conversations and the old ones are removed."""
+        timer = MockTimer()
+        history = [{'role': 'user', 'content': 'Hello'}]
+        with tempfile.TemporaryDirectory() as directory:
+            worker1 = FileSessionStore(directory, max_sessions=2, ttl=10, prune_interval=3, timer=timer)
+            worker2 = FileSessionStore(directory, max_sessions=2, ttl=10, timer=timer)
+            await worker1.put('a', history)
+            self.assertListEqual(await worker2.get('a'), history)
+            self.assertIsNone(await worker2.get('../a'))
+            with self.assertRaises(ValueError):
+                await worker1.put('../a', history)
+
+            # The least recently saved conversation is removed above max_sessions.
+            await worker1.put('b', history)
+            for i, session_id in enumerate('ab'):
+                os.utime(os.path.join(directory, session_id + '.json'), (i, i))
+            timer.now = 2
+            await worker1.put('c', history)
+            self.assertIsNone(await worker2.get('a'))
+            self.assertListEqual(await worker2.get('b'), history)
+            self.assertEqual(worker1.stats()['evictions'], 1)
+
+            timer.now += 100
+            self.assertIsNone(await worker2.get('b'))
+            self.assertEqual(worker2.stats()['expirations'], 1)
+            await worker1.delete('c')
+            self.assertEqual(worker1.stats()['size'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
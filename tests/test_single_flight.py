@@ -0,0 +1,76 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import unittest
+
+from single_flight import SingleFlight
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    """Tests for the collapsing of identical calls."""
+
+    async def asyncSetUp(self):
+        self.calls = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def _call(self, result='context', error=None):
+        self.calls += 1
+        self.started.set()
+        await self.release.wait()
+        if error is not None:
+            raise error
+        return result
+
+    async def test_shared_result(self):
+        """Test that the concurrent callers with the same key share one call."""
+        flight = SingleFlight()
+        tasks = [asyncio.ensure_future(flight.do('q', self._call)) for _ in range(5)]
+        other = asyncio.ensure_future(flight.do('other', lambda: self._call('other')))
+        await asyncio.sleep(0)
+        self.release.set()
+        self.assertListEqual(await asyncio.gather(*tasks), ['context'] * 5)
+        self.assertEqual(await other, 'other')
+        self.assertEqual(self.calls, 2)
+        self.assertDictEqual(flight.stats(), {'in_flight': 0, 'calls': 2, 'shared': 4})
+        # The result is not kept.
+        self.assertEqual(await flight.do('q', self._call), 'context')
+        self.assertEqual(self.calls, 3)
+
+    async def test_error(self):
+        """Test that the error is raised to all callers and the next call is made again."""
+        flight = SingleFlight()
+        tasks = [
+            asyncio.ensure_future(flight.do('q', lambda: self._call(error=ValueError('failed'))))
+            for _ in range(3)]
+        await asyncio.sleep(0)
+        self.release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(flight), 0)
+
+    async def test_cancellation(self):
+        """Test that the call is cancelled only when all its callers are cancelled."""
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do('q', self._call))
+        second = asyncio.ensure_future(flight.do('q', self._call))
+        await self.started.wait()
+        first.cancel()
+        await asyncio.sleep(0)
+        self.assertEqual(len(flight), 1)
+        self.release.set()
+        self.assertEqual(await second, 'context')
+
+        self.release.clear()
+        third = asyncio.ensure_future(flight.do('q', self._call))
+        await asyncio.sleep(0.01)
+        third.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await third
+        self.assertEqual(len(flight), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import json
+import unittest
+from unittest.mock import patch
+
+import stream_encoder
+from stream_encoder import DeltaEncoder, dumps
+
+
+class MockTimer:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestDeltaEncoder(unittest.TestCase):
+    """Tests for the coalescing of the answer deltas."""
+
+    def _parse(self, output):
+        """Return the contents of the delta lines."""
+        return [json.loads(line)['delta']['content'] for line in output.splitlines()]
+
+    def test_coalesce(self):
+        """Test that the deltas are merged within the flush interval."""
+        timer = MockTimer()
+        encoder = DeltaEncoder(flush_interval=0.02, timer=timer)
+        # The first delta is sent right away.
+        self.assertListEqual(self._parse(encoder.add('Hello', 'assistant')), ['Hello'])
+        self.assertIsNone(encoder.add(' big', None))
+        self.assertIsNone(encoder.add(None, None))
+        self.assertIsNone(encoder.add('', None))
+        timer.now = 0.03
+        output = encoder.add(' world', None)
+        self.assertDictEqual(
+            json.loads(output), {'delta': {'content': ' big world', 'role': None}})
+        self.assertIsNone(encoder.time_to_flush())
+        timer.now = 0.04
+        self.assertIsNone(encoder.add('!', None))
+        self.assertAlmostEqual(encoder.time_to_flush(), 0.01)
+        self.assertListEqual(self._parse(encoder.flush()), ['!'])
+        self.assertEqual(encoder.flush(), b'')
+        self.assertEqual(encoder.deltas, 4)
+        self.assertEqual(encoder.lines, 3)
+
+    def test_flush_chars(self):
+        """Test that the large content and the change of the role are sent without waiting."""
+        encoder = DeltaEncoder(flush_interval=10, flush_chars=5, timer=MockTimer())
+        encoder.add('a', 'assistant')
+        self.assertIsNone(encoder.add('bcd', None))
+        self.assertListEqual(self._parse(encoder.add('efg', None)), ['bcdefg'])
+        encoder.add('h', 'assistant')
+        self.assertListEqual(self._parse(encoder.add('i', 'tool')), ['h'])
+        self.assertDictEqual(json.loads(encoder.flush()), {'delta': {'content': 'i', 'role': 'tool'}})
+
+    def test_json_fallback(self):
+        """Test that the standard json module produces the same output as orjson."""
+        value = {'delta': {'content': 'Grüße "x"\n', 'role': None}}
+        with patch.object(stream_encoder, 'orjson', None):
+            self.assertEqual(dumps(value), json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode())
+            self.assertDictEqual(json.loads(dumps(value)), value)
+
+
+if __name__ == "__main__":
+    unittest.main()
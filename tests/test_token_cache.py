@@ -0,0 +1,105 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import asyncio
+import fcntl
+import os
+import stat
+import tempfile
+import unittest
+from unittest.mock import AsyncMock
+
+from azure.core.credentials import AccessToken
+from token_cache import SharedTokenCredential
+
+
+class MockTimer:
+
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+class TestSharedTokenCredential(unittest.IsolatedAsyncioTestCase):
+    """Tests for the token cache shared by the workers."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.directory.name, 'tokens.json')
+        self.timer = MockTimer()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _get_credential(self):
+        credential = AsyncMock()
+        credential.get_token.side_effect = lambda *scopes, **kwargs: AccessToken(
+            f'token{credential.get_token.call_count}', int(self.timer.now) + 3600)
+        return credential
+
+    async def test_shared_between_workers(self):
+        """Test that the token, fetched by one worker, is used by the other."""
+        first = self._get_credential()
+        second = self._get_credential()
+        worker1 = SharedTokenCredential(first, self.cache_file, timer=self.timer)
+        worker2 = SharedTokenCredential(second, self.cache_file, timer=self.timer)
+        self.assertEqual((await worker1.get_token('scope')).token, 'token1')
+        self.assertEqual((await worker2.get_token('scope')).token, 'token1')
+        self.assertEqual((await worker1.get_token('scope')).token, 'token1')
+        first.get_token.assert_called_once()
+        second.get_token.assert_not_called()
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache_file).st_mode), 0o600)
+        # The token for other scope is fetched separately.
+        self.assertEqual((await worker2.get_token('other')).token, 'token1')
+        second.get_token.assert_called_once()
+
+    async def test_proactive_refresh(self):
+        """Test that the token is refreshed before it expires and reused if the refresh fails."""
+        credential = self._get_credential()
+        worker = SharedTokenCredential(credential, self.cache_file, refresh_margin=300, timer=self.timer)
+        self.assertEqual((await worker.get_token('scope')).token, 'token1')
+        self.timer.now += 3600 - 300 + 1
+        self.assertEqual((await worker.get_token('scope')).token, 'token2')
+
+        credential.get_token.side_effect = RuntimeError('The identity endpoint is unavailable.')
+        self.timer.now += 3600 - 300 + 1
+        self.assertEqual((await worker.get_token('scope')).token, 'token2')
+        self.timer.now += 300
+        with self.assertRaises(RuntimeError):
+            await worker.get_token('scope')
+
+    async def test_identities(self):
+        """Test that the credentials of different identities do not share the tokens."""
+        first = self._get_credential()
+        second = self._get_credential()
+        worker1 = SharedTokenCredential(first, self.cache_file, timer=self.timer, identity='client-1')
+        worker2 = SharedTokenCredential(second, self.cache_file, timer=self.timer, identity='client-2')
+        await worker1.get_token('scope')
+        await worker2.get_token('scope')
+        first.get_token.assert_called_once()
+        second.get_token.assert_called_once()
+        self.assertListEqual(sorted(os.listdir(self.directory.name)), ['tokens.json', 'tokens.json.lock'])
+
+    async def test_lock_does_not_block_loop(self):
+        """Test that the event loop keeps serving, while another worker holds the file lock."""
+        credential = self._get_credential()
+        worker = SharedTokenCredential(credential, self.cache_file, timer=self.timer, lock_poll_interval=0.01)
+        with open(self.cache_file + '.lock', 'a') as lock:
+            # The other worker refreshes the token.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            task = asyncio.ensure_future(worker.get_token('scope'))
+            ticks = 0
+            for _ in range(5):
+                await asyncio.sleep(0.01)
+                ticks += 1
+            self.assertEqual(ticks, 5)
+            self.assertFalse(task.done())
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.assertEqual((await asyncio.wait_for(task, 1)).token, 'token1')
+        credential.get_token.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
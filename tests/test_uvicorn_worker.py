@@ -0,0 +1,27 @@
+# Copyright (c) Microsoft. All rights reserved.
+# Licensed under the MIT license.
+# See LICENSE file in the project root for full license information.
+import unittest
+
+from uvicorn_worker import worker_config
+
+
+class TestWorkerConfig(unittest.TestCase):
+    """Tests for the uvicorn settings of the gunicorn worker."""
+
+    def test_default(self):
+        """Test that by default the fastest available implementations are used without limits."""
+        self.assertDictEqual(worker_config({}), {'loop': 'auto', 'http': 'auto'})
+
+    def test_configured(self):
+        """Test that the settings are taken from the environment."""
+        config = worker_config({
+            'UVICORN_LOOP': 'uvloop',
+            'UVICORN_HTTP': 'httptools',
+            'UVICORN_LIMIT_CONCURRENCY': '200'
+        })
+        self.assertDictEqual(config, {'loop': 'uvloop', 'http': 'httptools', 'limit_concurrency': 200})
+
+
+if __name__ == "__main__":
+    unittest.main()